@@ -0,0 +1,77 @@
+"""
+Overhead of receiving and sending through the asyncio adapter
+
+Runs against a device that always has full batches ready and sends
+everything, so it measures only the Python side of the adapter, compared
+with calling rx_batch/tx_batch directly in a loop
+"""
+import time
+import asyncio
+import argparse
+
+from ixypy.aio import AsyncPort
+
+
+class ReadyDevice(object):
+    def __init__(self, batch_size):
+        self.batch = list(range(batch_size))
+
+    def rx_batch(self, queue_id, batch_size):
+        return self.batch[:batch_size]
+
+    def tx_batch(self, buffers, queue_id=0):
+        return len(buffers)
+
+
+def direct(device, count, batch_size):
+    received = 0
+    while received < count:
+        buffers = device.rx_batch(0, batch_size)
+        device.tx_batch(buffers, 0)
+        received += len(buffers)
+    return received
+
+
+async def adapter(port, count):
+    received = 0
+    sink = port.tx(0)
+    async for buffers in port.rx(0):
+        await sink.send(buffers)
+        received += len(buffers)
+        if received >= count:
+            break
+    return received
+
+
+def run(count, batch_size, max_burst):
+    device = ReadyDevice(batch_size)
+    start = time.perf_counter()
+    received = direct(device, count, batch_size)
+    direct_elapsed = time.perf_counter() - start
+
+    loop = asyncio.new_event_loop()
+    port = AsyncPort(device, batch_size=batch_size, max_burst=max_burst)
+    start = time.perf_counter()
+    received = loop.run_until_complete(adapter(port, count))
+    adapter_elapsed = time.perf_counter() - start
+    loop.close()
+    bursts = port.rx(0).bursts
+
+    print('{:<10} {:>10} {:>14}'.format('', 'Mpps', 'ns/burst'))
+    print('{:<10} {:>10.2f} {:>14.0f}'.format('direct', received / direct_elapsed / 1e6,
+                                              direct_elapsed / (received / batch_size) * 1e9))
+    print('{:<10} {:>10.2f} {:>14.0f}'.format('asyncio', received / adapter_elapsed / 1e6,
+                                              adapter_elapsed / bursts * 1e9))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', help='Packets to receive', type=int, default=10000000)
+    parser.add_argument('--batch', help='Packets per rx_batch', type=int, default=32)
+    parser.add_argument('--burst', help='Largest burst of the adapter', type=int, default=256)
+    args = parser.parse_args()
+    run(args.count, args.batch, args.burst)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Micro benchmark of the different ways of accessing a 32 bit MMIO register
+
+Runs against an anonymous mapping, so it measures only the Python side
+of the access (the cost of the bus transaction itself is not included)
+"""
+import mmap
+import argparse
+import timeit
+from struct import pack_into, unpack_from
+
+import numpy as np
+
+from ixypy.register import MmapRegister
+
+# IXGBE_TDT(0)
+OFFSET = 0x06018
+REGION_SIZE = 0x20000
+
+
+def numpy_accessors(mm):
+    reg_vals = np.frombuffer(memoryview(mm), dtype=np.uint32)
+
+    def write(value):
+        reg_vals[OFFSET//4] = value
+
+    def read():
+        return reg_vals[OFFSET//4]
+    return write, read
+
+
+def struct_accessors(mm):
+    mem = memoryview(mm)
+
+    def write(value):
+        pack_into('I', mem, OFFSET, value)
+
+    def read():
+        return unpack_from('I', mem, OFFSET)[0]
+    return write, read
+
+
+def register_accessors(mm):
+    reg = MmapRegister(mm)
+
+    def write(value):
+        reg.set(OFFSET, value)
+
+    def read():
+        return reg.get(OFFSET)
+    return write, read
+
+
+def doorbell_accessors(mm):
+    doorbell = MmapRegister(mm).doorbell(OFFSET)
+    return doorbell.set, doorbell.get
+
+
+ACCESSORS = [
+    ('numpy uint32', numpy_accessors),
+    ('struct', struct_accessors),
+    ('MmapRegister', register_accessors),
+    ('Doorbell', doorbell_accessors),
+]
+
+
+def run(number, repeat):
+    mm = mmap.mmap(-1, REGION_SIZE)
+    print('{:<14} {:>12} {:>12} {:>16}'.format('accessor', 'write [ns]', 'read [ns]', 'read & mask [ns]'))
+    for name, accessors in ACCESSORS:
+        write, read = accessors(mm)
+
+        def read_masked():
+            return (read() & 0x2) != 0
+
+        results = []
+        for func, arg in [(write, (511,)), (read, ()), (read_masked, ())]:
+            timer = timeit.Timer(lambda: func(*arg))
+            best = min(timer.repeat(repeat=repeat, number=number))
+            results.append(best / number * 1e9)
+        print('{:<14} {:>12.1f} {:>12.1f} {:>16.1f}'.format(name, *results))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', help='Accesses per measurement', type=int, default=1000000)
+    parser.add_argument('--repeat', help='Number of measurements', type=int, default=5)
+    args = parser.parse_args()
+    run(args.number, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
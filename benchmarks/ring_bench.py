@@ -0,0 +1,125 @@
+"""
+Throughput of passing packet buffer indices from one process to another
+
+Compares the shared memory PacketRing with the queues of multiprocessing,
+which pickle every item. The producer is a forked process, the consumer
+runs in this one; both poll, yielding the CPU whenever they make no
+progress so the benchmark also works with both on one core. The cost of
+the ring operations alone is measured within a single process.
+"""
+import os
+import mmap
+import time
+import timeit
+import argparse
+from multiprocessing import get_context
+
+from ixypy.ring import PacketRing
+
+RING_SIZE = 1024
+
+
+def ring_producer(ring, count, batch_size):
+    batch = list(range(batch_size))
+    sent = 0
+    while sent < count:
+        enqueued = ring.enqueue(batch[:count - sent])
+        if enqueued == 0:
+            os.sched_yield()
+        sent += enqueued
+
+
+def ring_consumer(ring, count, batch_size):
+    received = 0
+    while received < count:
+        dequeued = len(ring.dequeue(batch_size))
+        if dequeued == 0:
+            os.sched_yield()
+        received += dequeued
+
+
+def queue_producer(queue, count, batch_size):
+    for i in range(count):
+        queue.put(i)
+
+
+def queue_consumer(queue, count, batch_size):
+    for _ in range(count):
+        queue.get()
+
+
+def batched_queue_producer(queue, count, batch_size):
+    batch = list(range(batch_size))
+    for sent in range(0, count, batch_size):
+        queue.put(batch[:count - sent])
+
+
+def batched_queue_consumer(queue, count, batch_size):
+    received = 0
+    while received < count:
+        received += len(queue.get())
+
+
+def new_ring():
+    return PacketRing(mmap.mmap(-1, PacketRing.byte_size(RING_SIZE)), RING_SIZE)
+
+
+def new_queue():
+    return get_context('fork').SimpleQueue()
+
+
+TRANSPORTS = [
+    ('PacketRing', new_ring, ring_producer, ring_consumer),
+    ('SimpleQueue', new_queue, queue_producer, queue_consumer),
+    ('SimpleQueue (lists)', new_queue, batched_queue_producer, batched_queue_consumer),
+]
+
+
+def measure(new_transport, producer, consumer, count, batch_size):
+    transport = new_transport()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            producer(transport, count, batch_size)
+        finally:
+            os._exit(0)
+    start = time.perf_counter()
+    consumer(transport, count, batch_size)
+    elapsed = time.perf_counter() - start
+    os.waitpid(pid, 0)
+    return elapsed
+
+
+def measure_ring_operations(batch_size, number=100000):
+    ring = new_ring()
+    batch = list(range(batch_size))
+
+    def enqueue_dequeue():
+        ring.enqueue(batch)
+        ring.dequeue(batch_size)
+    best = min(timeit.Timer(enqueue_dequeue).repeat(repeat=5, number=number))
+    return best / number
+
+
+def run(count, batch_size):
+    elapsed = measure_ring_operations(batch_size)
+    print('Single process enqueue + dequeue of {:d} indices: {:.0f} ns ({:.1f} ns/item)'.format(
+        batch_size, elapsed * 1e9, elapsed / batch_size * 1e9))
+    print('{:<20} {:>14} {:>14}'.format('transport', 'Mitems/s', 'ns/item'))
+    for name, new_transport, producer, consumer in TRANSPORTS:
+        # The unbatched queue is too slow to run the full count
+        items = count if producer is not queue_producer else count // 10
+        elapsed = measure(new_transport, producer, consumer, items, batch_size)
+        print('{:<20} {:>14.3f} {:>14.1f}'.format(name, items / elapsed / 1e6, elapsed / items * 1e9))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', help='Indices passed per transport', type=int, default=2000000)
+    parser.add_argument('--batch', help='Indices per enqueue/dequeue', type=int, default=32)
+    args = parser.parse_args()
+    run(args.count, args.batch)
+
+
+if __name__ == '__main__':
+    main()
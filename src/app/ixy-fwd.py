@@ -1,6 +1,10 @@
-from ixypy.mempool import Mempool
-from ixypy.stats import Stats
-from ixypy import init_device
+from ixypy.stats import Stats, SharedStats
+from ixypy import init_devices
+from ixypy import trace
+from ixypy.pci import parse_cpulist
+from ixypy.affinity import CpuAllocator, apply_placement, launch_workers
+from ixypy.scheduler import PollScheduler, PollStats, IdleBackoff
+from ixypy.graph import Graph, TouchNode, TxNode, DropNode
 
 
 import copy
@@ -13,56 +17,125 @@ log.basicConfig(level=log.DEBUG, format='%(levelname)-8s %(filename)s:%(lineno)s
 
 
 BATCH_SIZE = 32 
+# Seconds between the stats updates of the worker processes
+WORKER_STATS_INTERVAL = 0.1
 
 
-def forward(rx_dev, rx_queue, tx_dev, tx_queue):
-    rx_buffers = rx_dev.rx_batch(rx_queue, BATCH_SIZE)
+def forwarding_graph(devices, queue):
+    """
+    touch-to-2 -> tx-2 -> drop for the packets received on device 1, the other way round for device 2
 
-    mempool = None
-    if rx_buffers:
-        for buff in rx_buffers:
-            buff.touch()
-        
-        tx_buffer_count = tx_dev.tx_batch(rx_buffers, tx_queue)
+    The packets that are not sent out are dropped, waiting on TX would only accumulate latency
+    """
+    dev_1, dev_2 = devices
+    return Graph([TouchNode('touch-to-2', 'tx-2'),
+                  TouchNode('touch-to-1', 'tx-1'),
+                  TxNode('tx-2', dev_2, queue),
+                  TxNode('tx-1', dev_1, queue),
+                  DropNode()])
 
-        """
-        there are two ways to handle the case that packets are not being sent
-        out: either wait on tx or drop them; in this case it's better to drop
-        them, otherwise we accumulate latency
-        """
-        for buff in rx_buffers[tx_buffer_count:]:
-            if mempool is None:
-                mempool = Mempool.pools[buff.mempool_id]
-            mempool.free_buffer(buff)
+
+def forwarding_scheduler(args, devices, queue, name):
+    """Polls the queue of both devices, forwarding to the other device"""
+    dev_1, dev_2 = devices
+    graph = forwarding_graph(devices, queue)
+    scheduler = PollScheduler(IdleBackoff(max_sleep=args.max_sleep / 1e6), name)
+    scheduler.register(dev_1, queue, graph.input('touch-to-2'), BATCH_SIZE)
+    scheduler.register(dev_2, queue, graph.input('touch-to-1'), BATCH_SIZE)
+    return scheduler, graph
+
+
+def cpu_allocator(args, devices):
+    cpus = parse_cpulist(args.cpus) if args.cpus else None
+    return CpuAllocator(cpus, [dev.pci_device for dev in devices])
 
 
 def run_packet_forwarding(args):
-    dev_1 = init_device(args.pci_1)
-    dev_2 = init_device(args.pci_2)
+    dev_1, dev_2 = init_devices([args.pci_1, args.pci_2])
+    placement = cpu_allocator(args, [dev_1, dev_2]).allocate('ixy-fwd', fifo_priority=args.fifo)
+    apply_placement(placement)
 
-    last_stats_printed = time.perf_counter()
     stats_1_new, stats_1_old = Stats(dev_1.pci_device), Stats(dev_1.pci_device)
     stats_2_new, stats_2_old = Stats(dev_2.pci_device), Stats(dev_2.pci_device)
-
-    counter = 0
-    while True:
-        forward(dev_1, 0, dev_2, 0)
-        forward(dev_2, 0, dev_1, 0)
-
-        # Don't poll the time unnecessarily
-        if (counter & 0xFF) == 0:
+    for stats in [stats_1_new, stats_1_old, stats_2_new, stats_2_old]:
+        stats.placement = placement
+    scheduler, graph = forwarding_scheduler(args, [dev_1, dev_2], 0, placement.name)
+    poll_stats_old = PollStats()
+
+    def print_stats(interval):
+        nonlocal stats_1_old, stats_2_old, poll_stats_old
+        dev_1.read_stats(stats_1_new)
+        stats_1_new.print_diff(stats_1_old, interval)
+        stats_1_old = copy.copy(stats_1_new)
+        if dev_1 != dev_2:
+            dev_2.read_stats(stats_2_new)
+            stats_2_new.print_diff(stats_2_old, interval)
+            stats_2_old = copy.copy(stats_2_new)
+        scheduler.stats.print_diff(poll_stats_old, interval)
+        poll_stats_old = copy.copy(scheduler.stats)
+        graph.print_stats()
+        graph.reset_stats()
+    scheduler.every(1, print_stats)
+    scheduler.run()
+
+
+def run_worker(args, devices, queue, shared_stats, shared_poll_stats):
+    """
+    Forwards between the queue pair with index queue of both devices,
+    the rings and mempools of the queue are only used by this process
+    """
+    stats = [Stats(dev.pci_device) for dev in devices]
+    scheduler, _ = forwarding_scheduler(args, devices, queue, 'queue{:d}'.format(queue))
+
+    def publish_stats(interval):
+        for device_index, dev in enumerate(devices):
+            dev.read_stats(stats[device_index])
+            shared_stats.publish(queue, device_index, stats[device_index])
+        shared_poll_stats.publish(queue, 0, scheduler.stats)
+    scheduler.every(WORKER_STATS_INTERVAL, publish_stats)
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        pass
+
+
+def run_multi_queue_forwarding(args):
+    """
+    The parent initializes both devices with one queue pair per worker, then
+    forks the workers and only aggregates their stats
+    """
+    devices = init_devices([args.pci_1, args.pci_2], num_queues=args.queues)
+    dev_1, dev_2 = devices
+    allocator = cpu_allocator(args, devices)
+    shared_stats = SharedStats(args.queues, len(devices))
+    shared_poll_stats = SharedStats(args.queues, 1, PollStats.fields, 'd')
+    worker_args = [(args, devices, queue, shared_stats, shared_poll_stats) for queue in range(args.queues)]
+    workers = [worker for worker, _ in launch_workers(run_worker, worker_args, allocator, args.fifo, name='queue')]
+
+    stats_new = [Stats(dev.pci_device) for dev in devices]
+    stats_old = [Stats(dev.pci_device) for dev in devices]
+    for stats in stats_new + stats_old:
+        stats.placement = allocator.summary()
+    poll_stats_new, poll_stats_old = PollStats('workers'), PollStats('workers')
+    last_stats_printed = time.perf_counter()
+    try:
+        while all(worker.is_alive() for worker in workers):
+            time.sleep(1)
             current_time = time.perf_counter()
             interval = current_time - last_stats_printed
-            if interval > 1:
-                dev_1.read_stats(stats_1_new)
-                stats_1_new.print_diff(stats_1_old, interval)
-                stats_1_old = copy.copy(stats_1_new)
-                if dev_1 != dev_2:
-                    dev_2.read_stats(stats_2_new)
-                    stats_2_new.print_diff(stats_2_old, interval)
-                    stats_2_old = copy.copy(stats_2_new)
-                last_stats_printed = current_time
-        counter += 1
+            for device_index in range(len(devices) if dev_1 != dev_2 else 1):
+                shared_stats.read(device_index, stats_new[device_index])
+                stats_new[device_index].print_diff(stats_old[device_index], interval)
+                stats_old[device_index] = copy.copy(stats_new[device_index])
+            shared_poll_stats.read(0, poll_stats_new)
+            poll_stats_new.print_diff(poll_stats_old, interval)
+            poll_stats_old = copy.copy(poll_stats_new)
+            last_stats_printed = current_time
+        log.error('A worker process exited')
+    finally:
+        for worker in workers:
+            worker.terminate()
+            worker.join()
 
 
 def main():
@@ -70,11 +143,24 @@ def main():
     pci_address_eg = '0000:00:08.0'
     parser.add_argument('pci_1', help='Pci bus id1 e.g. {}'.format(pci_address_eg), type=str)
     parser.add_argument('pci_2', help='Pci bus id2 e.g. {}'.format(pci_address_eg), type=str)
+    parser.add_argument('--trace', help='Trace register accesses, keeping the last TRACE ones', type=int, default=0)
+    parser.add_argument('--queues', help='Forward with one worker process per queue pair', type=int, default=1)
+    parser.add_argument('--cpus', help='CPUs the pollers may run on e.g. 2-5,8, one poller per CPU', type=str)
+    parser.add_argument('--fifo', help='Run the pollers with SCHED_FIFO and this priority', type=int)
+    parser.add_argument('--max-sleep', help='Longest sleep of idle pollers in microseconds, 0 to always busy poll',
+                        type=float, default=1000)
     args = parser.parse_args()
+    if args.trace > 0:
+        trace.enable_tracing(args.trace)
     try:
-        run_packet_forwarding(args)
+        if args.queues > 1:
+            run_multi_queue_forwarding(args)
+        else:
+            run_packet_forwarding(args)
     except KeyboardInterrupt:
         log.info('Packet forwarding has been stopped')
+    if trace.get_trace() is not None:
+        trace.get_trace().print_summary()
 
 
 if __name__ == "__main__":
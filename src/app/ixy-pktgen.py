@@ -1,6 +1,7 @@
-from ixypy.mempool import Mempool
 from ixypy.stats import Stats
 from ixypy import init_device
+from ixypy.pci import parse_cpulist
+from ixypy.affinity import CpuAllocator, apply_placement
 
 import copy
 import argparse
@@ -64,9 +65,9 @@ def calc_ip_checksum(msg):
     return ~s & 0xffff
 
 
-def init_mempool():
+def init_mempool(dev):
     NUM_BUFS = 2048
-    mempool = Mempool.allocate(NUM_BUFS)
+    mempool = dev.allocate_mempool(NUM_BUFS)
     buffs = []
     for _ in range(NUM_BUFS):
         buff = mempool.get_buffer()
@@ -81,11 +82,16 @@ def init_mempool():
 
 
 def run_packet_generator(args):
-    mempool = init_mempool()
     dev = init_device(args.address)
+    mempool = init_mempool(dev)
+    dev.prepare_tx_mempool(mempool)
+    allocator = CpuAllocator(parse_cpulist(args.cpus) if args.cpus else None, [dev.pci_device])
+    placement = allocator.allocate('ixy-pktgen', fifo_priority=args.fifo)
+    apply_placement(placement)
 
     stats_old = Stats(dev.pci_device)
     stats_new = Stats(dev.pci_device)
+    stats_old.placement = stats_new.placement = placement
     counter = 0
     last_stats_printed = time.perf_counter()
 
@@ -111,7 +117,9 @@ def run_packet_generator(args):
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('address', help='NIC Pci address e.g. 0000:00:08.0', type=str)
+    parser.add_argument('address', help='NIC Pci address e.g. 0000:00:08.0, or loop:<name>:<port>', type=str)
+    parser.add_argument('--cpu', help='CPU the generator runs on, e.g. 3', type=str, dest='cpus')
+    parser.add_argument('--fifo', help='Run with SCHED_FIFO and this priority', type=int)
     args = parser.parse_args()
     try:
         run_packet_generator(args)
@@ -13,6 +13,8 @@ DEF HUGE_PAGE_BITS = 21
 DEF HUGE_PAGE_SIZE = 1 << HUGE_PAGE_BITS
 DEF SIZE_PKT_BUF_HEADROOM = 40
 
+HUGEPAGE_DIR = "/mnt/huge"
+
 
 cdef uint32_t huge_pg_id = 0
 
@@ -27,6 +29,10 @@ cdef uintptr_t virt_to_phys(void* virt):
     return (phy & 0x7fffffffffffffULL) * pagesize + (<uintptr_t>virt) % pagesize
 
 
+cdef extern from *:
+    void __sync_synchronize() nogil
+
+
 cdef extern from "sys/mman.h":
     void *mmap(void *addr, size_t len, int prot, int flags, int fd, off_t offset)
     enum:
@@ -39,30 +45,68 @@ cdef extern from "sys/mman.h":
 cdef class DmaMemory:
     cdef void* virtual_address
     cdef readonly uintptr_t physical_address
+    # Path of the hugepage file of named memory, None otherwise
+    cdef readonly object path
     cdef Py_ssize_t size
     cdef Py_ssize_t shape[1]
     cdef Py_ssize_t strides[1]
 
-    def __cinit__(self, uint32_t size, bint aligned=True):
+    def __cinit__(self, uint32_t size, bint aligned=True, name=None, bint create=True):
+        """
+        Anonymous memory is only reachable through this mapping, its file is
+        removed right away. Named memory keeps its file until unlink() so other
+        processes can attach to it (create=False, size 0 maps the whole file),
+        the physical addresses are the same in all of them.
+        """
+        global huge_pg_id
+        if name is None:
+            # This is atomic thanks to the GIL
+            huge_pg_id += 1
+            path = "{}/ixypy-{:d}-{:d}".format(HUGEPAGE_DIR, huge_pg_id, os.getpid())
+        else:
+            path = "{}/ixypy-shared-{}".format(HUGEPAGE_DIR, name)
+        if create:
+            # Checked before the file exists, so a rejected size leaves nothing behind
+            DmaMemory._check_size(size, aligned)
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_RDWR, stat.S_IRWXU)
+        else:
+            fd = os.open(path, os.O_RDWR)
+            try:
+                if size == 0:
+                    size = os.fstat(fd).st_size
+                DmaMemory._check_size(size, aligned)
+            except:
+                os.close(fd)
+                raise
         self.size = <Py_ssize_t>size
         self.shape[0] = self.size
         self.strides[0] = 1
-        actual_size = DmaMemory._round_size(size)
-        if aligned and actual_size > HUGE_PAGE_SIZE:
-          raise MemoryError()
-        global huge_pg_id
-        # This is atomic thanks to the GIL
-        huge_pg_id += 1
-        page_id = huge_pg_id
-        path = "/mnt/huge/ixypy-{:d}-{:d}".format(page_id, os.getpid())
-        fd = os.open(path, os.O_CREAT | os.O_RDWR, stat.S_IRWXU)
-        # check error
-        self.virtual_address = mmap(NULL, size, PROT_READ | PROT_WRITE, MAP_SHARED | MAP_HUGETLB, fd, 0)
-        memset(self.virtual_address, 0xab, self.size)
-        os.close(fd)
-        os.unlink(path)
+        try:
+            self.virtual_address = mmap(NULL, size, PROT_READ | PROT_WRITE, MAP_SHARED | MAP_HUGETLB, fd, 0)
+            if self.virtual_address == <void*>-1:
+                raise MemoryError('Failed to map {}'.format(path))
+        except:
+            # A file left behind would make the next create with this name fail
+            if create:
+                os.unlink(path)
+            raise
+        finally:
+            os.close(fd)
+        if create:
+            memset(self.virtual_address, 0xab, self.size)
+        if name is None:
+            os.unlink(path)
+            self.path = None
+        else:
+            self.path = path
         self.physical_address = virt_to_phys(self.virtual_address)
 
+    def unlink(self):
+        """Removes the name of named memory, existing mappings stay valid"""
+        if self.path is not None:
+            os.unlink(self.path)
+            self.path = None
+
     def __getbuffer__(self, Py_buffer *buffer, int flags):
         cdef Py_ssize_t itemsize = 1
         buffer.buf = <char *>self.virtual_address
@@ -85,6 +129,12 @@ cdef class DmaMemory:
                                                                                self.physical_address, 
                                                                                self.size)
 
+    @staticmethod
+    cdef _check_size(uint32_t size, bint aligned):
+        """Aligned memory has to fit into a single huge page"""
+        if aligned and DmaMemory._round_size(size) > HUGE_PAGE_SIZE:
+            raise MemoryError()
+
     @staticmethod
     cdef uint32_t _round_size(uint32_t size):
         """
@@ -97,3 +147,10 @@ cdef class DmaMemory:
 
 cpdef wrap_ring(uint16_t index, uint16_t ring_size):
     return <uint16_t>(index + 1) & (ring_size - 1)
+
+
+cpdef memory_barrier():
+    """
+    Full memory barrier, orders ring updates before the device notification
+    """
+    __sync_synchronize()
@@ -1,17 +1,46 @@
-from ixypy.virtio.device import VirtioLegacyDevice 
+from ixypy.virtio.device import VirtioDevice, VirtioLegacyDevice
 from ixypy.ixgbe.device import IxgbeDevice
+from ixypy.loopback.device import LoopbackDevice, LOOPBACK_PREFIX
 from ixypy.pci import PCIDevice, PCIAddress, PCIVendor
 
 import logging as log
+from concurrent.futures import ThreadPoolExecutor
 
 
-def init_device(pci_address):
+def init_device(pci_address, wait_for_link=True, num_queues=1):
+    """
+    Args:
+        pci_address: e.g. 0000:00:08.0, or loop:<name>:<port> for a
+                     software loopback port (see ixypy.loopback.device)
+        num_queues: number of RX and TX queues, packets are spread over
+                    the RX queues by flow (RSS on ixgbe, the host on virtio)
+    """
+    if pci_address.startswith(LOOPBACK_PREFIX):
+        return LoopbackDevice.from_address(pci_address, num_queues, wait_for_link=wait_for_link)
     address = PCIAddress.from_address_string(pci_address)
     device = PCIDevice(address)
     log.info("Vendor = %s", device.vendor())
     if device.vendor() == PCIVendor.virt_io:
-        return VirtioLegacyDevice(device)
+        return VirtioDevice(device, num_queues, num_queues)
     elif device.vendor() == PCIVendor.intel:
-        return IxgbeDevice(device)
+        return IxgbeDevice(device, num_queues, num_queues, wait_for_link=wait_for_link)
     else:
         raise ValueError('Device <{}> not supported'.format(pci_address))
+
+
+def init_devices(pci_addresses, link_timeout=10, num_queues=1):
+    """
+    Initializes several devices, waiting for their links concurrently
+
+    The devices are reset and configured one after the other, the link
+    negotiation (which takes most of the time) then runs in parallel
+    so the total time is bounded by the slowest port.
+
+    Returns:
+        the devices in the order of the given addresses
+    """
+    devices = [init_device(pci_address, wait_for_link=False, num_queues=num_queues) for pci_address in pci_addresses]
+    with ThreadPoolExecutor(max_workers=len(devices)) as executor:
+        # wait_for_link logs a warning for every link that stays down
+        list(executor.map(lambda device: device.wait_for_link(link_timeout), devices))
+    return devices
@@ -0,0 +1,132 @@
+"""
+Placement of poll mode workers on CPUs
+
+A poll loop never blocks, so a poller that shares its core with another
+poller (or anything else) gets preempted and the NIC drops the packets
+arriving meanwhile. Every worker therefore gets a core of its own,
+preferably one on the NUMA node of the NICs it polls.
+"""
+import os
+import logging as log
+from multiprocessing import get_context
+
+from ixypy.ixy import IxyException
+
+
+class PlacementException(IxyException):
+    pass
+
+
+class Placement(object):
+    """CPU and scheduling policy a worker runs with"""
+    def __init__(self, name, cpu, fifo_priority=None, numa_local=None):
+        self.name = name
+        self.cpu = cpu
+        # SCHED_FIFO priority, None for the default policy
+        self.fifo_priority = fifo_priority
+        # None if the NUMA node of the devices is unknown
+        self.numa_local = numa_local
+
+    def __str__(self):
+        policy = 'other' if self.fifo_priority is None else 'fifo:{:d}'.format(self.fifo_priority)
+        locality = {True: 'local', False: 'remote', None: 'unknown'}[self.numa_local]
+        return '{}=cpu{:d}/{}/{}'.format(self.name, self.cpu, policy, locality)
+
+    def __repr__(self):
+        return '<Placement({})>'.format(self)
+
+
+class CpuAllocator(object):
+    """
+    Hands out CPUs to poll mode workers, at most one worker per CPU
+
+    Args:
+        cpus: CPUs that may be used, defaults to the affinity of the process
+        devices: PCIDevices whose NUMA local CPUs are handed out first
+    """
+    def __init__(self, cpus=None, devices=()):
+        self.cpus = sorted(os.sched_getaffinity(0) if cpus is None else cpus)
+        self.local_cpus = None
+        for device in devices:
+            device_cpus = device.local_cpus()
+            if device_cpus is not None:
+                self.local_cpus = device_cpus if self.local_cpus is None else self.local_cpus | device_cpus
+        self.placements = {}
+
+    def _is_local(self, cpu):
+        if self.local_cpus is None:
+            return None
+        return cpu in self.local_cpus
+
+    def allocate(self, name, cpu=None, fifo_priority=None):
+        """
+        Args:
+            cpu: a specific CPU, the first free (NUMA local) one if None
+        Raises:
+            PlacementException if the CPU is taken, not allowed or none is left
+        """
+        if cpu is None:
+            free_cpus = [cpu for cpu in self.cpus if cpu not in self.placements]
+            if not free_cpus:
+                raise PlacementException('No CPU left for {}, {} are taken'.format(name, self.summary()))
+            # Local CPUs first, otherwise keep the ascending order
+            cpu = min(free_cpus, key=lambda free_cpu: (self._is_local(free_cpu) is False, free_cpu))
+        elif cpu not in self.cpus:
+            raise PlacementException('CPU {:d} is not allowed for {}, allowed are {}'.format(cpu, name, self.cpus))
+        elif cpu in self.placements:
+            raise PlacementException('CPU {:d} already runs {}'.format(cpu, self.placements[cpu].name))
+        placement = Placement(name, cpu, fifo_priority, self._is_local(cpu))
+        if placement.numa_local is False:
+            log.warning('%s runs on CPU %d, which is not NUMA local to the devices', name, cpu)
+        self.placements[cpu] = placement
+        return placement
+
+    def release(self, placement):
+        del self.placements[placement.cpu]
+
+    def summary(self):
+        return ' '.join(str(self.placements[cpu]) for cpu in sorted(self.placements))
+
+
+def apply_placement(placement, pid=0):
+    """
+    Pins the process to the placement's CPU and sets its scheduling policy
+
+    With SCHED_FIFO the poller is never preempted by normal processes, the
+    kernel's real-time throttling still leaves the core some time for them.
+    If the policy cannot be set the process keeps the default one and the
+    placement is updated accordingly.
+
+    Args:
+        pid: process to place, 0 for the calling one
+    """
+    os.sched_setaffinity(pid, {placement.cpu})
+    if placement.fifo_priority is not None:
+        try:
+            os.sched_setscheduler(pid, os.SCHED_FIFO, os.sched_param(placement.fifo_priority))
+        except PermissionError:
+            log.warning('Not allowed to use SCHED_FIFO, %s keeps the default policy', placement.name)
+            placement.fifo_priority = None
+    log.info('Placed %s', placement)
+
+
+def launch_workers(target, worker_args, allocator, fifo_priority=None, name='worker'):
+    """
+    Forks one process per entry of worker_args running target(*args),
+    each one on a CPU of its own
+
+    The processes inherit the initialized devices and the mappings of
+    their DMA memory, so each one can poll its own queues.
+
+    Returns:
+        list of (process, placement)
+    """
+    context = get_context('fork')
+    workers = []
+    for i, args in enumerate(worker_args):
+        placement = allocator.allocate('{}{:d}'.format(name, i), fifo_priority=fifo_priority)
+        process = context.Process(target=target, args=args, daemon=True)
+        process.start()
+        apply_placement(placement, process.pid)
+        workers.append((process, placement))
+    return workers
@@ -0,0 +1,152 @@
+"""
+asyncio adapter for IxyDevices
+
+The RX queues are polled from coroutines waiting for packets, nothing
+polls while nobody reads, the RX ring absorbs the packets meanwhile.
+Bursts are handed out as they are received, as long as the queue keeps
+returning full batches they are merged into bigger bursts, so under
+load the event loop is passed through once per burst and not once per
+batch. A poller with packets waiting gives the event loop a turn at
+least every max_busy_time seconds, idle pollers back off like the
+PollScheduler does, sleeping through the event loop.
+
+    port = AsyncPort(device)
+    async for buffers in port.rx(0):
+        await port.tx(0).send(buffers)
+"""
+import asyncio
+import time
+
+from ixypy.scheduler import IdleBackoff, MAX_SLEEP
+
+BATCH_SIZE = 32
+# Largest burst handed out at once
+MAX_BURST = 256
+# Longest time a poller may run without letting other tasks run
+MAX_BUSY_TIME = 1e-3
+# Empty polls before backing off, every poll already yields to the event loop
+SPIN_ROUNDS = 100
+
+
+class RxStream(object):
+    """Async iterator over the bursts received on an RX queue"""
+    def __init__(self, device, queue, batch_size, max_burst, max_busy_time, backoff):
+        self.device = device
+        self.queue = queue
+        self.batch_size = batch_size
+        self.max_burst = max_burst
+        self.max_busy_time = max_busy_time
+        self.backoff = backoff
+        self.closed = False
+        self.last_yield = time.perf_counter()
+        self.packets = 0
+        self.bursts = 0
+        self.empty_polls = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        """
+        Returns:
+            non-empty list of buffers, which the caller then owns
+        """
+        rx_batch = self.device.rx_batch
+        queue = self.queue
+        batch_size = self.batch_size
+        backoff = self.backoff
+        while not self.closed:
+            burst = rx_batch(queue, batch_size)
+            if not burst:
+                self.empty_polls += 1
+                await asyncio.sleep(backoff.delay() or 0)
+                self.last_yield = time.perf_counter()
+                continue
+            if backoff.empty_rounds:
+                backoff.reset()
+            # Full batches mean more packets are waiting
+            batch, requested = burst, batch_size
+            while len(batch) == requested and len(burst) < self.max_burst:
+                requested = min(batch_size, self.max_burst - len(burst))
+                batch = rx_batch(queue, requested)
+                burst += batch
+            self.packets += len(burst)
+            self.bursts += 1
+            if time.perf_counter() - self.last_yield > self.max_busy_time:
+                await asyncio.sleep(0)
+                self.last_yield = time.perf_counter()
+            return burst
+        raise StopAsyncIteration
+
+    def close(self):
+        """Ends the iteration, the waiting iterator stops after its current poll"""
+        self.closed = True
+
+
+class TxSink(object):
+    """Sends bursts through a TX queue, waiting while the queue is full"""
+    def __init__(self, device, queue, backoff):
+        self.device = device
+        self.queue = queue
+        self.backoff = backoff
+        self.packets = 0
+        # Sends that had to wait for room in the queue
+        self.stalls = 0
+
+    async def send(self, buffers):
+        """Returns once all buffers are in the TX queue, which then owns them"""
+        tx_batch = self.device.tx_batch
+        sent = tx_batch(buffers, self.queue)
+        if sent < len(buffers):
+            self.stalls += 1
+            backoff = self.backoff
+            backoff.reset()
+            while sent < len(buffers):
+                await asyncio.sleep(backoff.delay() or 0)
+                sent += tx_batch(buffers[sent:], self.queue)
+        self.packets += sent
+
+
+class AsyncPort(object):
+    """
+    RX streams and TX sinks of the queues of a device
+
+    Each queue must only be used by one task at a time.
+
+    Args:
+        max_sleep: longest sleep of idle RX pollers in seconds, the event
+                   loop does not wait for less than its clock resolution
+    """
+    def __init__(self, device, batch_size=BATCH_SIZE, max_burst=MAX_BURST, max_busy_time=MAX_BUSY_TIME,
+                 max_sleep=MAX_SLEEP):
+        self.device = device
+        self.batch_size = batch_size
+        self.max_burst = max_burst
+        self.max_busy_time = max_busy_time
+        self.max_sleep = max_sleep
+        self.rx_streams = {}
+        self.tx_sinks = {}
+        self.closed = False
+
+    def _backoff(self):
+        return IdleBackoff(spin_rounds=SPIN_ROUNDS, yield_rounds=0, max_sleep=self.max_sleep)
+
+    def rx(self, queue=0):
+        """The RxStream of the queue"""
+        if queue not in self.rx_streams:
+            self.rx_streams[queue] = RxStream(self.device, queue, self.batch_size, self.max_burst,
+                                              self.max_busy_time, self._backoff())
+            self.rx_streams[queue].closed = self.closed
+        return self.rx_streams[queue]
+
+    def tx(self, queue=0):
+        """The TxSink of the queue"""
+        if queue not in self.tx_sinks:
+            self.tx_sinks[queue] = TxSink(self.device, queue, self._backoff())
+        return self.tx_sinks[queue]
+
+    def close(self):
+        """Ends the iteration over all RX streams"""
+        self.closed = True
+        for stream in self.rx_streams.values():
+            stream.close()
@@ -0,0 +1,228 @@
+"""
+Packet processing graphs in the style of VPP
+
+Every node processes a whole vector of packet buffers at once and passes
+the buffers on to the next nodes, so the interpreter's overhead of a
+node is paid once per vector instead of once per packet. The dispatcher
+runs the nodes in topological order, each one at most once per dispatch
+with all the buffers passed to it since, and measures the time spent in
+every node.
+
+    graph = Graph([TouchNode('touch', 'tx'), TxNode('tx', device), DropNode()])
+    scheduler.register(device, 0, graph.input('touch'))
+"""
+import time
+from collections import OrderedDict
+
+from ixypy.ixy import IxyException
+from ixypy.mempool import Mempool
+
+
+class GraphException(IxyException):
+    pass
+
+
+class Node(object):
+    """
+    Step of the processing of packet vectors
+
+    Subclasses implement process and set next_nodes to the names of the
+    nodes they pass buffers to.
+    """
+    next_nodes = ()
+
+    def __init__(self, name, next_nodes=None):
+        self.name = name
+        if next_nodes is not None:
+            self.next_nodes = tuple(next_nodes)
+        self.calls = 0
+        self.packets = 0
+        self.time = 0.0
+
+    def process(self, buffers):
+        """
+        Args:
+            buffers: non-empty list of buffers, which the node then owns
+        Returns:
+            iterable of (next node name, list of buffers), the next node
+            then owns the buffers and the list
+        """
+        raise NotImplementedError
+
+    def reset_stats(self):
+        self.calls = 0
+        self.packets = 0
+        self.time = 0.0
+
+    def __str__(self):
+        return '[{0}] {1:d} calls {2:^5.1f} packets/call {3:^6.1f} ns/packet'.format(
+            self.name,
+            self.calls,
+            self.packets / self.calls if self.calls else 0.0,
+            self.time / self.packets * 1e9 if self.packets else 0.0)
+
+
+class TouchNode(Node):
+    """Writes to every packet like a rewrite would, see PacketBuffer.touch"""
+    def __init__(self, name, next_node):
+        super().__init__(name, [next_node])
+        self.next_node = next_node
+
+    def process(self, buffers):
+        for buffer in buffers:
+            buffer.touch()
+        return ((self.next_node, buffers),)
+
+
+class EtherTypeNode(Node):
+    """
+    Classifies the packets by the EtherType of their Ethernet header
+
+    Args:
+        next_by_ether_type: dict of EtherType to the name of the next node
+        default_next: next node of all other packets
+    """
+    def __init__(self, name, next_by_ether_type, default_next='drop'):
+        super().__init__(name, list(next_by_ether_type.values()) + [default_next])
+        self.next_by_ether_type = next_by_ether_type
+        self.default_next = default_next
+
+    def process(self, buffers):
+        next_by_ether_type = self.next_by_ether_type
+        default_next = self.default_next
+        vectors = {}
+        for buffer in buffers:
+            data = buffer.data_buffer
+            next_node = next_by_ether_type.get(data[12] << 8 | data[13], default_next)
+            if next_node in vectors:
+                vectors[next_node].append(buffer)
+            else:
+                vectors[next_node] = [buffer]
+        return vectors.items()
+
+
+class TxNode(Node):
+    """
+    Sends the packets through a TX queue
+
+    The packets that do not fit into the queue are dropped, waiting for
+    room would only accumulate latency.
+    """
+    def __init__(self, name, device, queue=0, drop_node='drop'):
+        super().__init__(name, [drop_node])
+        self.device = device
+        self.queue = queue
+        self.drop_node = drop_node
+
+    def process(self, buffers):
+        sent = self.device.tx_batch(buffers, self.queue)
+        if sent < len(buffers):
+            return ((self.drop_node, buffers[sent:]),)
+        return ()
+
+
+class DropNode(Node):
+    """Returns the buffers to their mempools, one call per mempool"""
+    def __init__(self, name='drop'):
+        super().__init__(name)
+
+    def process(self, buffers):
+        Mempool.free_to_pools(buffers)
+        return ()
+
+
+class Graph(object):
+    """
+    Nodes connected by their next_nodes, which have to form a DAG
+
+    Args:
+        nodes: Nodes to add
+    """
+    def __init__(self, nodes=()):
+        self.nodes = OrderedDict()
+        # Buffers passed to each node since it last ran
+        self.frames = {}
+        self.order = None
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        if node.name in self.nodes:
+            raise GraphException('Node {} already exists'.format(node.name))
+        self.nodes[node.name] = node
+        self.frames[node.name] = []
+        self.order = None
+        return node
+
+    def _sort(self):
+        """Orders the nodes so every node runs after all nodes passing buffers to it"""
+        predecessors = {name: 0 for name in self.nodes}
+        for node in self.nodes.values():
+            for next_node in node.next_nodes:
+                if next_node not in self.nodes:
+                    raise GraphException('Node {} passes buffers to the unknown node {}'.format(node.name, next_node))
+                predecessors[next_node] += 1
+        ready = [node for node in self.nodes.values() if predecessors[node.name] == 0]
+        order = []
+        while ready:
+            node = ready.pop(0)
+            order.append(node)
+            for next_node in node.next_nodes:
+                predecessors[next_node] -= 1
+                if predecessors[next_node] == 0:
+                    ready.append(self.nodes[next_node])
+        if len(order) < len(self.nodes):
+            cycle = sorted(name for name, count in predecessors.items() if count)
+            raise GraphException('The nodes {} form a cycle'.format(', '.join(cycle)))
+        return order
+
+    def enqueue(self, name, buffers):
+        """Passes buffers to a node, it processes them in the next dispatch"""
+        frame = self.frames[name]
+        if frame:
+            frame += buffers
+        else:
+            self.frames[name] = buffers
+
+    def dispatch(self):
+        """Runs every node that has buffers passed to it"""
+        if self.order is None:
+            self.order = self._sort()
+        frames = self.frames
+        clock = time.perf_counter
+        for node in self.order:
+            buffers = frames[node.name]
+            if not buffers:
+                continue
+            frames[node.name] = []
+            start = clock()
+            for next_node, vector in node.process(buffers):
+                if not vector:
+                    continue
+                frame = frames[next_node]
+                if frame:
+                    frame += vector
+                else:
+                    frames[next_node] = vector
+            node.time += clock() - start
+            node.calls += 1
+            node.packets += len(buffers)
+
+    def input(self, name):
+        """
+        Handler for the PollScheduler passing the received buffers to
+        the node and dispatching them through the graph
+        """
+        def handle(buffers):
+            self.enqueue(name, buffers)
+            self.dispatch()
+        return handle
+
+    def print_stats(self):
+        for node in self.nodes.values():
+            if node.calls:
+                print(node)
+
+    def reset_stats(self):
+        for node in self.nodes.values():
+            node.reset_stats()
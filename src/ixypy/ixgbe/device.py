@@ -1,3 +1,4 @@
+import os
 import time
 import logging as log
 from functools import reduce
@@ -7,6 +8,8 @@ from ixypy.mempool import Mempool
 from ixypy.ixgbe.structures import RxQueue, TxQueue
 from ixypy.ixy import IxyDevice
 from ixypy.register import MmapRegister
+from ixypy.trace import traced, RegisterNames
+from ixypy.wait import wait_until, IxyTimeoutException
 from ixypy.ixgbe import types
 from ixypy.utils import dump
 
@@ -31,6 +34,7 @@ class IxgbeDevice(IxyDevice):
     NUM_TX_QUEUE_ENTRIES = 512
     NUM_RX_QUEUE_ENTRIES = 512
     TX_CLEAN_BATCH = 32
+    LINK_TIMEOUT = 10
     RX_DESCRIPTOR_SIZE = 16
     TX_DESCRIPTOR_SIZE = 16
     flags = [
@@ -41,8 +45,10 @@ class IxgbeDevice(IxyDevice):
             types.IXGBE_ADVTXD_DTYP_DATA
         ]
     cmd_type_flags = reduce(lambda x, y: x | y, flags, 0)
+    register_names = RegisterNames(types, 'IXGBE_', MAX_QUEUES)
 
-    def __init__(self, pci_device, num_rx_queues=1, num_tx_queues=1):
+    def __init__(self, pci_device, num_rx_queues=1, num_tx_queues=1, wait_for_link=True):
+        self._wait_for_link_on_init = wait_for_link
         super().__init__(pci_device,
                          'ixy-ixgbe',
                          self.MAX_QUEUES,
@@ -52,7 +58,7 @@ class IxgbeDevice(IxyDevice):
 
     def _initialize_device(self):
         mm = self.pci_device.map_resource()
-        self.reg = MmapRegister(mm)
+        self.reg = traced(MmapRegister(mm), self.register_names)
         self.reset_and_init()
 
     def reset_and_init(self):
@@ -75,7 +81,8 @@ class IxgbeDevice(IxyDevice):
         for queue in self.tx_queues:
             self._start_tx_queue(queue)
         self.set_promisc()
-        self._wait_for_link()
+        if self._wait_for_link_on_init:
+            self.wait_for_link()
 
     def set_promisc(self, enabled=True):
         if enabled:
@@ -85,18 +92,16 @@ class IxgbeDevice(IxyDevice):
             log.info('Disabling promisc mode')
             self.reg.clear_flags(types.IXGBE_FCTRL, types.IXGBE_FCTRL_MPE | types.IXGBE_FCTRL_UPE)
 
-    def _wait_for_link(self):
-        log.info('Waiting for link...')
-        waiting_time = 0
+    def wait_for_link(self, timeout=LINK_TIMEOUT):
+        log.info('Waiting for link on %s...', self.pci_device.address)
+        try:
+            elapsed = wait_until(lambda: self.get_link_speed() != 0, timeout, 'link')
+        except IxyTimeoutException:
+            log.warning('Timed out while waiting for link on %s', self.pci_device.address)
+            return 0
         link_speed = self.get_link_speed()
-        while waiting_time < 10 and link_speed == 0:
-            time.sleep(0.01)
-            waiting_time += 0.01
-            link_speed = self.get_link_speed()
-        if link_speed != 0:
-            log.info('Link established - speed %d Mbit/s', self.get_link_speed())
-        else:
-            log.warning('Timed out while waiting for link')
+        log.info('Link established on %s after %.3fs - speed %d Mbit/s', self.pci_device.address, elapsed, link_speed)
+        return link_speed
 
     def get_link_speed(self):
         links = self.reg.get(types.IXGBE_LINKS)
@@ -166,6 +171,8 @@ class IxgbeDevice(IxyDevice):
         self.rx_queues = [
             self._init_rx_queue(index) for index in range(self.num_rx_queues)
         ]
+        if self.num_rx_queues > 1:
+            self._init_rss()
 
         # Sec 4.6.7 - set magic bits
         self.reg.set_flags(types.IXGBE_CTRL_EXT, types.IXGBE_CTRL_EXT_NS_DIS)
@@ -180,6 +187,31 @@ class IxgbeDevice(IxyDevice):
         # Start RX
         self.reg.set_flags(types.IXGBE_RXCTRL, types.IXGBE_RXCTRL_RXEN)
 
+    def _init_rss(self):
+        """
+        Sec 7.1.2.8
+        Spreads the flows over all rx queues by hashing their addresses and ports,
+        packets of one flow always end up in the same queue
+        """
+        log.info('Enabling RSS over %d queues', self.num_rx_queues)
+        for i in range(types.IXGBE_RSSRK_REGISTERS):
+            self.reg.set(types.IXGBE_RSSRK(i), int.from_bytes(os.urandom(4), 'little'))
+        # Round robin over the queues, one byte per entry
+        for i in range(types.IXGBE_RETA_ENTRIES // 4):
+            reta = 0
+            for j in range(4):
+                reta |= ((4 * i + j) % self.num_rx_queues) << (8 * j)
+            self.reg.set(types.IXGBE_RETA(i), reta)
+        # The RSS hash replaces the fragment checksum in the descriptor
+        self.reg.set_flags(types.IXGBE_RXCSUM, types.IXGBE_RXCSUM_PCSD)
+        self.reg.set(types.IXGBE_MRQC, types.IXGBE_MRQC_RSSEN |
+                     types.IXGBE_MRQC_RSS_FIELD_IPV4 |
+                     types.IXGBE_MRQC_RSS_FIELD_IPV4_TCP |
+                     types.IXGBE_MRQC_RSS_FIELD_IPV4_UDP |
+                     types.IXGBE_MRQC_RSS_FIELD_IPV6 |
+                     types.IXGBE_MRQC_RSS_FIELD_IPV6_TCP |
+                     types.IXGBE_MRQC_RSS_FIELD_IPV6_UDP)
+
     def _init_rx_queue(self, index):
         log.info('Initializing rx queue %d', index)
         # Enable advanced rx descriptors
@@ -213,6 +245,7 @@ class IxgbeDevice(IxyDevice):
         mempool_size = self.NUM_RX_QUEUE_ENTRIES + self.NUM_TX_QUEUE_ENTRIES
         mempool = Mempool.allocate(4096 if mempool_size < 4096 else mempool_size)
         queue = RxQueue(mem, self.NUM_RX_QUEUE_ENTRIES, index, mempool)
+        queue.tail = self.reg.doorbell(types.IXGBE_RDT(index))
         return queue
 
     def _start_tx_queue(self, queue):
@@ -246,6 +279,7 @@ class IxgbeDevice(IxyDevice):
         txdctl = txdctl | (36 | (8 << 8) | (4 << 16))
         self.reg.set(types.IXGBE_TXDCTL(index), txdctl)
         queue = TxQueue(mem, self.NUM_TX_QUEUE_ENTRIES, index)
+        queue.tail = self.reg.doorbell(types.IXGBE_TDT(index))
         return queue
 
     def _init_tx(self):
@@ -316,7 +350,7 @@ class IxgbeDevice(IxyDevice):
             Tell the hardware that we are done. This is intentionally off by one, otherwise
             we'd set RDT=RDH if we are receiving faster than packets are coming in, which would mean queue is full
             """
-            self.reg.set(types.IXGBE_RDT(queue_id), last_rx_index)
+            queue.tail.set(last_rx_index)
             queue.index = rx_index
         return buffers
 
@@ -392,7 +426,6 @@ class IxgbeDevice(IxyDevice):
         return self._send_out_packets(queue, buffers)
 
     def _send_out_packets(self, queue, buffers):
-        queue_id = queue.identifier
         current_index = queue.index
         queue_len = len(queue)
         sent = 0
@@ -424,7 +457,7 @@ class IxgbeDevice(IxyDevice):
             current_index = next_index
             sent += 1
         # Send out by advancing tail, i.e. pass control of the bus to the NIC
-        self.reg.set(types.IXGBE_TDT(queue_id), queue.index)
+        queue.tail.set(queue.index)
         return sent
 
     def _enable_dma(self):
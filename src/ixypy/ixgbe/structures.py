@@ -5,6 +5,8 @@ from ixypy.ixy import IxyQueue
 class IxgbeQueue(IxyQueue):
     def __init__(self, memory, size, identifier, mempool=None):
         super().__init__(memory, size, identifier, mempool)
+        # Tail register (RDT/TDT), bound by the device once the queue is set up
+        self.tail = None
 
     def _get_descriptors(self, descriptor_class):
         desc_size = descriptor_class.byte_size()
@@ -387,6 +387,33 @@ IXGBE_RFCTL = 0x05008
 IXGBE_DRECCCTL = 0x02F08
 IXGBE_DRECCCTL_DISABLE = 0
 IXGBE_DRECCCTL2 = 0x02F8C
+# Packet checksum disable, required for RSS
+IXGBE_RXCSUM_PCSD = 0x00002000
+
+# Receive side scaling
+IXGBE_MRQC = 0x05818
+IXGBE_MRQC_RSSEN = 0x00000001
+IXGBE_MRQC_RSS_FIELD_IPV4_TCP = 0x00010000
+IXGBE_MRQC_RSS_FIELD_IPV4 = 0x00020000
+IXGBE_MRQC_RSS_FIELD_IPV6 = 0x00100000
+IXGBE_MRQC_RSS_FIELD_IPV6_TCP = 0x00200000
+IXGBE_MRQC_RSS_FIELD_IPV4_UDP = 0x00400000
+IXGBE_MRQC_RSS_FIELD_IPV6_UDP = 0x00800000
+# 128 redirection table entries, 4 per register
+IXGBE_RETA_ENTRIES = 128
+# 40 byte hash key
+IXGBE_RSSRK_REGISTERS = 10
+
+
+def IXGBE_RETA(i):
+    # 32 of these (0-31)
+    return 0x05C00 + i * 4
+
+
+def IXGBE_RSSRK(i):
+    # 10 of these (0-9)
+    return 0x05C80 + i * 4
+
 
 # Packet Buffer Initialization
 IXGBE_MAX_PACKET_BUFFERS = 8
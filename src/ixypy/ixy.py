@@ -3,6 +3,8 @@ import logging as log
 from abc import ABC, abstractmethod
 from struct import Struct, calcsize, pack_into
 
+from ixypy.mempool import Mempool
+
 
 def is_running_as_root():
     return getuid() == 0
@@ -97,6 +99,15 @@ class IxyDevice(ABC):
     def get_link_speed(self):
         pass
 
+    def wait_for_link(self, timeout=10):
+        """
+        Blocks until the link is up or the timeout expires
+
+        Returns:
+            the link speed in Mbit/s, 0 if the link is still down
+        """
+        return self.get_link_speed()
+
     @abstractmethod
     def set_promisc(self):
         pass
@@ -105,6 +116,14 @@ class IxyDevice(ABC):
     def read_stats(self, stats):
         pass
 
+    def allocate_mempool(self, num_entries, entry_size=2048):
+        """Mempool in memory the device can send from"""
+        return Mempool.allocate(num_entries, entry_size)
+
+    def prepare_tx_mempool(self, mempool):
+        """Called with the mempools whose buffers are going to be sent through this device"""
+        pass
+
     @abstractmethod
     def tx_batch(self, buffers, queue_id=0):
         pass
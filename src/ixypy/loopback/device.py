@@ -0,0 +1,357 @@
+"""
+Software loopback ports
+
+The ports 0 and 1 of a loopback pair are connected like two NICs by a
+cable, what one port sends the other one receives. Every port owns a
+link carrying the packets to it: a SharedMempool for the received
+packets and a PacketRing of their indices, both in a shared memory file.
+Sending copies the packets into buffers of the peer's mempool (like the
+receiving NIC's DMA would) and enqueues them on the peer's ring, the
+sent buffers are free right away. The ports may be opened by different
+processes, e.g. ixy-pktgen on one and ixy-fwd on the other, no hugepages
+or NICs are needed.
+
+The ports send at most at their line rate. Packets that do not fit into
+the peer's ring are dropped, or with lossless links not accepted for
+sending, as if the link had flow control.
+
+Addresses look like loop:<name>:<port>[,speed=<Mbit/s>][,lossless],
+speed=0 sends as fast as possible.
+"""
+import os
+import mmap
+import atexit
+import time
+import logging as log
+
+from ixypy.ixy import IxyDevice
+from ixypy.mempool import Mempool, SharedMempool
+from ixypy.ring import PacketRing
+from ixypy.wait import wait_until, IxyTimeoutException
+
+LOOPBACK_PREFIX = 'loop:'
+# tmpfs, there is no DMA so the memory needs neither hugepages nor physical addresses
+SHM_DIR = '/dev/shm'
+RING_SIZE = 1024
+NUM_BUFFERS = 4096
+BUFFER_SIZE = 2048
+DEFAULT_SPEED = 10000
+# Preamble, start of frame delimiter and inter frame gap (20 bytes) and the CRC (4 bytes)
+WIRE_OVERHEAD = 24
+# Minimum sized frames the TX queue holds, it takes as long to send them as packets may wait to be sent
+TX_QUEUE_FRAMES = 512
+MIN_FRAME_SIZE = 60
+
+
+class SharedMemory(mmap.mmap):
+    """Shared file mapping, the size of an existing file if size is 0"""
+    physical_address = 0
+
+    def __new__(cls, path, size=0):
+        fd = os.open(path, os.O_RDWR | (os.O_CREAT | os.O_EXCL if size else 0), 0o600)
+        try:
+            if size:
+                os.ftruncate(fd, size)
+            memory = super().__new__(cls, fd, size)
+        finally:
+            os.close(fd)
+        memory.path = path
+        return memory
+
+    def unlink(self):
+        os.unlink(self.path)
+
+
+class AnonymousMemory(mmap.mmap):
+    """Memory of private mempools, the ports copy the packets they send"""
+    physical_address = 0
+
+    def __new__(cls, size):
+        return super().__new__(cls, -1, size)
+
+
+class Link(object):
+    """
+    Mempool and ring carrying packets to a port
+
+    Memory layout: SharedMempool | PacketRing
+
+    Links are shared by all ports of a process, the mempool is registered
+    only once.
+    """
+    links = {}
+
+    def __init__(self, memory, mempool, ring):
+        self.memory = memory
+        self.mempool = mempool
+        self.ring = ring
+        self.inode = os.stat(memory.path).st_ino
+        self.users = 0
+
+    @staticmethod
+    def path_for(name, port):
+        return '{}/ixypy-loop-{}-{:d}'.format(SHM_DIR, name, port)
+
+    @classmethod
+    def create(cls, path, ring_size=RING_SIZE, num_buffers=NUM_BUFFERS):
+        """
+        Lays out a new link, replacing the one of a previous run
+
+        The link is laid out in a temporary file renamed into place, so no
+        sender attaches to a partially formatted one.
+        """
+        # Ports of this process may still be attached to the link being replaced
+        cls.links.pop(path, None)
+        mempool_size = SharedMempool.byte_size(num_buffers, BUFFER_SIZE)
+        temporary_path = '{}.{:d}'.format(path, os.getpid())
+        if os.path.exists(temporary_path):
+            os.unlink(temporary_path)
+        memory = SharedMemory(temporary_path, mempool_size + PacketRing.byte_size(ring_size))
+        # Attaching processes read the identifier from the memory, it only has to differ from the replaced link's
+        identifier = SharedMempool.identifier_for('{}-{!r}'.format(temporary_path, time.time()))
+        mempool = SharedMempool.format(memory, num_buffers, BUFFER_SIZE, identifier)
+        ring = PacketRing(memoryview(memory)[mempool_size:], ring_size)
+        os.rename(temporary_path, path)
+        memory.path = path
+        return cls._open(cls(memory, mempool, ring))
+
+    @classmethod
+    def attach(cls, path):
+        """
+        Raises:
+            FileNotFoundError if the link does not exist (yet)
+        """
+        if path in cls.links:
+            return cls._open(cls.links[path])
+        memory = SharedMemory(path)
+        mempool = SharedMempool.from_memory(memory)
+        ring = PacketRing(memoryview(memory)[SharedMempool.byte_size(mempool.num_entries, mempool.buffer_size):])
+        return cls._open(cls(memory, mempool, ring))
+
+    @classmethod
+    def _open(cls, link):
+        cls.links[link.memory.path] = link
+        link.users += 1
+        return link
+
+    def is_current(self):
+        """False if the receiving port was reopened with a new link since"""
+        try:
+            return os.stat(self.memory.path).st_ino == self.inode
+        except FileNotFoundError:
+            return False
+
+    def release(self):
+        """Detaches this process from the link once no port uses it"""
+        self.users -= 1
+        if self.users == 0:
+            if Link.links.get(self.memory.path) is self:
+                del Link.links[self.memory.path]
+            self.mempool.free()
+
+
+class LoopbackPort(object):
+    """Stands in for the PCIDevice of the port"""
+    def __init__(self, name, port):
+        if port not in (0, 1):
+            raise ValueError('Loopback port must be 0 or 1, got {}'.format(port))
+        self.name = name
+        self.port = port
+        self.address = '{}{}:{:d}'.format(LOOPBACK_PREFIX, name, port)
+
+    def local_cpus(self):
+        """Any CPU is as close to the memory as any other"""
+        return None
+
+    def __str__(self):
+        return self.address
+
+
+def parse_address(address):
+    """
+    Returns:
+        (name, port, options) with the speed and lossless options as keyword arguments
+    """
+    if not address.startswith(LOOPBACK_PREFIX):
+        raise ValueError('Not a loopback address: {}'.format(address))
+    parts = address[len(LOOPBACK_PREFIX):].split(',')
+    name, _, port = parts[0].rpartition(':')
+    if not name or not port.isdigit():
+        raise ValueError('Loopback address {} does not match {}<name>:<port>'.format(address, LOOPBACK_PREFIX))
+    options = {}
+    for option in parts[1:]:
+        if option == 'lossless':
+            options['lossless'] = True
+        elif option.startswith('speed='):
+            options['speed'] = int(option[len('speed='):])
+        else:
+            raise ValueError('Unknown loopback option {} in {}'.format(option, address))
+    return name, int(port), options
+
+
+class LoopbackDevice(IxyDevice):
+    """
+    Port of a loopback pair
+
+    Args:
+        speed: line rate in Mbit/s, 0 for no limit
+        lossless: refuse to send the packets the peer has no room for
+                  instead of dropping them
+    """
+    LINK_TIMEOUT = 10
+
+    def __init__(self, name, port, num_rx_queues=1, num_tx_queues=1, speed=DEFAULT_SPEED, lossless=False,
+                 ring_size=RING_SIZE, num_buffers=NUM_BUFFERS, wait_for_link=True):
+        self.speed = speed
+        self.lossless = lossless
+        self.ring_size = ring_size
+        self.num_buffers = num_buffers
+        super().__init__(LoopbackPort(name, port), 'ixy-loopback', 1, 1, num_rx_queues, num_tx_queues)
+        if wait_for_link:
+            self.wait_for_link()
+
+    @classmethod
+    def from_address(cls, address, num_queues=1, wait_for_link=True):
+        name, port, options = parse_address(address)
+        return cls(name, port, num_queues, num_queues, wait_for_link=wait_for_link, **options)
+
+    def _common_init(self):
+        """There is no PCI device to take over"""
+        pass
+
+    def _initialize_device(self):
+        port = self.pci_device
+        self.rx_link = Link.create(Link.path_for(port.name, port.port), self.ring_size, self.num_buffers)
+        self.peer_path = Link.path_for(port.name, 1 - port.port)
+        self.tx_link = None
+        # Time the last accepted packet has left the port
+        self.wire_free = 0.0
+        # TX queue of TX_QUEUE_FRAMES minimum sized frames
+        self.max_backlog = TX_QUEUE_FRAMES * (MIN_FRAME_SIZE + WIRE_OVERHEAD) * 8 / (self.speed * 1e6) \
+            if self.speed else 0
+        self.rx_packets = 0
+        self.tx_packets = 0
+        self.rx_bytes = 0
+        self.tx_bytes = 0
+        # Packets sent that the peer had no room for
+        self.dropped = 0
+        # The links would stay in the tmpfs otherwise
+        atexit.register(self.close)
+        log.info('Opened loopback port %s', port)
+
+    def _attach_peer(self):
+        """The link to the peer, None as long as the peer is not open"""
+        if self.tx_link is not None and not self.tx_link.is_current():
+            log.info('Peer of %s was reopened', self.pci_device)
+            self.tx_link.release()
+            self.tx_link = None
+        if self.tx_link is None:
+            try:
+                self.tx_link = Link.attach(self.peer_path)
+            except FileNotFoundError:
+                pass
+        return self.tx_link
+
+    def get_link_speed(self):
+        """The link is up once the peer is open"""
+        if self._attach_peer() is None:
+            return 0
+        return self.speed if self.speed else DEFAULT_SPEED
+
+    def wait_for_link(self, timeout=LINK_TIMEOUT):
+        log.info('Waiting for the peer of %s...', self.pci_device)
+        try:
+            wait_until(lambda: self.get_link_speed() != 0, timeout, 'loopback peer')
+        except IxyTimeoutException:
+            log.warning('Timed out while waiting for the peer of %s', self.pci_device)
+            return 0
+        return self.get_link_speed()
+
+    def allocate_mempool(self, num_entries, entry_size=2048):
+        mempool = Mempool(AnonymousMemory(num_entries * entry_size), entry_size, num_entries)
+        mempool.preallocate_buffers()
+        return mempool
+
+    def set_promisc(self, enabled=True):
+        """Loopback ports receive every packet"""
+        pass
+
+    def read_stats(self, stats):
+        """Adds the counters since the last call, like the clear on read registers of the NICs"""
+        stats.rx_packets += self.rx_packets
+        stats.tx_packets += self.tx_packets
+        stats.rx_bytes += self.rx_bytes
+        stats.tx_bytes += self.tx_bytes
+        self.rx_packets = 0
+        self.tx_packets = 0
+        self.rx_bytes = 0
+        self.tx_bytes = 0
+
+    def rx_batch(self, queue_id, batch_size):
+        link = self.rx_link
+        buffers = link.ring.dequeue_buffers(link.mempool, batch_size)
+        if buffers:
+            self.rx_packets += len(buffers)
+            self.rx_bytes += sum(buffer.size for buffer in buffers)
+        return buffers
+
+    def _accepted_by_wire(self, sizes, now):
+        """Number of packets that fit into the TX queue draining at line rate"""
+        if not self.speed:
+            return len(sizes)
+        bit_time = 8 / (self.speed * 1e6)
+        wire_free = max(self.wire_free, now)
+        deadline = now + self.max_backlog
+        count = 0
+        for size in sizes:
+            if wire_free > deadline:
+                break
+            wire_free += (size + WIRE_OVERHEAD) * bit_time
+            count += 1
+        return count
+
+    def tx_batch(self, buffers, queue_id=0):
+        """
+        Sends single segment packets, returns the number of packets sent,
+        which are free again
+        """
+        sizes = [buffer.size for buffer in buffers]
+        now = time.perf_counter()
+        count = self._accepted_by_wire(sizes, now)
+        delivered = 0
+        link = self.tx_link or self._attach_peer()
+        if count and link is not None:
+            peer_buffers = link.mempool.get_buffers(count)
+            for buffer, peer_buffer, size in zip(buffers, peer_buffers, sizes):
+                peer_buffer.data_buffer[:size] = buffer.data_buffer[:size]
+                peer_buffer.size = size
+            delivered = link.ring.enqueue_buffers(peer_buffers)
+            if delivered < len(peer_buffers):
+                link.mempool.free_buffers(peer_buffers[delivered:])
+            if delivered == 0:
+                # Nobody drains the link of a peer that was reopened, so it fills up
+                self._attach_peer()
+        sent = delivered if self.lossless else count
+        self.dropped += sent - delivered
+        if sent:
+            sent_bytes = sum(sizes[:sent])
+            if self.speed:
+                bit_time = 8 / (self.speed * 1e6)
+                self.wire_free = max(self.wire_free, now) + (sent_bytes + WIRE_OVERHEAD * sent) * bit_time
+            self.tx_packets += sent
+            self.tx_bytes += sent_bytes
+            Mempool.free_to_pools(buffers[:sent])
+        return sent
+
+    def close(self):
+        """Closes the port, the peer's link goes down"""
+        if self.rx_link is None:
+            return
+        atexit.unregister(self.close)
+        if self.tx_link is not None:
+            self.tx_link.release()
+            self.tx_link = None
+        if self.rx_link.is_current():
+            self.rx_link.memory.unlink()
+        self.rx_link.release()
+        self.rx_link = None
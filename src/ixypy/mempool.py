@@ -1,8 +1,13 @@
+import os
+import fcntl
+import zlib
 import logging as log
 
 from struct import Struct, calcsize, unpack_from, pack_into
+from contextlib import contextmanager
 
 from itertools import count
+import numpy as np
 from memory import DmaMemory
 
 HUGE_PAGE_BITS = 21
@@ -21,6 +26,8 @@ class Stack(object):
         self.top += 1
 
     def pop(self):
+        if self.top == 0:
+            raise IndexError('pop from empty stack')
         self.top -= 1
         return self.items[self.top]
 
@@ -61,6 +68,7 @@ class Mempool(object):
             offset = i*self.buffer_size
             buff = PacketBuffer(self.mem[offset:offset + self.buffer_size])
             buff.mempool_id = self.identifier
+            buff.index = i
             buff.physical_address = base_phy_address + offset
             buff.size = 0
             yield buff
@@ -69,6 +77,19 @@ class Mempool(object):
         for buff in self._gen_buffers():
             self._buffers.push(buff)
 
+    def stamp_header(self, header):
+        """
+        Writes the header in front of the data of every buffer
+
+        Used by devices that send a per packet header along with the data
+        (e.g. virtio), they only rewrite it if PacketBuffer.header changed
+        """
+        length = len(header)
+        for buff in self._buffers.items:
+            if buff is not None:
+                header.to_buffer(buff.head_room_buffer[-length:])
+                buff.header = header
+
     def get_buffer(self):
         try:
             return self._buffers.pop()
@@ -80,7 +101,30 @@ class Mempool(object):
         return [self._buffers.pop() for _ in range(num)]
 
     def free_buffer(self, buff):
+        buff.offload = None
         self._buffers.push(buff)
+        # Chained segments (e.g. virtio mergeable rx buffers) go back to their pool as well
+        segment = buff.next_buffer
+        if segment is not None:
+            buff.next_buffer = None
+            Mempool.pools[segment.mempool_id].free_buffer(segment)
+
+    def free_buffers(self, buffs):
+        for buff in buffs:
+            self.free_buffer(buff)
+
+    @staticmethod
+    def free_to_pools(buffs):
+        """Frees buffers of any mempools, with one free_buffers call per mempool"""
+        by_mempool = {}
+        for buff in buffs:
+            mempool_id = buff.mempool_id
+            if mempool_id in by_mempool:
+                by_mempool[mempool_id].append(buff)
+            else:
+                by_mempool[mempool_id] = [buff]
+        for mempool_id, mempool_buffs in by_mempool.items():
+            Mempool.pools[mempool_id].free_buffers(mempool_buffs)
     
     @staticmethod
     def add_pool(mempool):
@@ -103,6 +147,201 @@ class Mempool(object):
         return mempool
 
 
+class SharedMempool(Mempool):
+    """
+    Mempool in named hugepage memory that other processes can attach to
+
+    Buffers have the same index and physical address in every process, so
+    they can be handed between processes by index (see ixypy.ring). The free
+    stack of buffer indices lives in the shared memory too; allocations and
+    frees take a record lock on the hugepage file, which is per process, so
+    forked children can use the inherited descriptor. Use the bulk
+    get_buffers/free_buffers to pay for the lock once per batch.
+
+    Memory layout: control block | free stack | buffers
+    """
+    magic = 0x50595849
+    # magic, number of buffers, buffer size, pool id, top of the free stack
+    control_words = 5
+    control_size = 64
+    TOP = 4
+
+    def __init__(self, dma, buffer_size, num_entries):
+        # The memory may be in use by other processes, it is neither cleared nor pooled here
+        self.dma = dma
+        self.mem = memoryview(dma)
+        self.buffer_size = buffer_size
+        self.num_entries = num_entries
+        self.identifier = None
+        self.buffers_offset = self.buffers_offset_for(num_entries, buffer_size)
+        self._control = np.frombuffer(self.mem, dtype=np.uint32, count=self.control_words)
+        self._free_stack = np.frombuffer(self.mem, dtype=np.uint32, count=num_entries, offset=self.control_size)
+        self._lock_fd = os.open(dma.path, os.O_RDWR)
+        self.buffers = [PacketBuffer(self.mem[offset:offset + buffer_size])
+                        for offset in range(self.buffers_offset,
+                                            self.buffers_offset + num_entries * buffer_size,
+                                            buffer_size)]
+
+    @staticmethod
+    def buffers_offset_for(num_entries, buffer_size):
+        # Buffers must not cross huge page boundaries
+        stack_end = SharedMempool.control_size + 4 * num_entries
+        return (stack_end + buffer_size - 1) // buffer_size * buffer_size
+
+    @staticmethod
+    def byte_size(num_entries, buffer_size):
+        return SharedMempool.buffers_offset_for(num_entries, buffer_size) + num_entries * buffer_size
+
+    @staticmethod
+    def identifier_for(name):
+        """The same in every process, clear of the ids of private pools"""
+        return 0x80000000 | (zlib.crc32(name.encode()) & 0x7FFFFFFF)
+
+    @classmethod
+    def create(cls, name, num_entries, entry_size=2048):
+        if HUGE_PAGE_SIZE % entry_size != 0:
+            raise ValueError('entry size[{}] must be a divisor of the huge page size[{}]'.format(entry_size, HUGE_PAGE_SIZE))
+        dma = DmaMemory(cls.byte_size(num_entries, entry_size), False, name=name)
+        return cls.format(dma, num_entries, entry_size, cls.identifier_for(name))
+
+    @classmethod
+    def attach(cls, name):
+        return cls.from_memory(DmaMemory(0, False, name=name, create=False))
+
+    @classmethod
+    def format(cls, dma, num_entries, entry_size, identifier):
+        """Lays out a new pool in the memory, all buffers are free"""
+        mempool = cls(dma, entry_size, num_entries)
+        mempool.id = identifier
+        base_phy_address = dma.physical_address + mempool.buffers_offset
+        for i, buff in enumerate(mempool.buffers):
+            buff.buffer[:] = bytes(entry_size)
+            buff.physical_address = base_phy_address + i * entry_size
+            buff.mempool_id = identifier
+            buff.index = i
+        mempool._free_stack[:] = np.arange(num_entries - 1, -1, -1, dtype=np.uint32)
+        mempool._control[1:] = (num_entries, entry_size, identifier, num_entries)
+        # Attaching processes check the magic, it goes last
+        mempool._control[0] = cls.magic
+        Mempool.pools[identifier] = mempool
+        return mempool
+
+    @classmethod
+    def from_memory(cls, dma):
+        """Attaches to the pool another process laid out in the memory"""
+        magic, num_entries, entry_size, identifier, _ = unpack_from('5I', dma, 0)
+        if magic != cls.magic:
+            raise ValueError('No mempool found in {}'.format(dma))
+        mempool = cls(dma, entry_size, num_entries)
+        mempool.id = identifier
+        Mempool.pools[identifier] = mempool
+        return mempool
+
+    @contextmanager
+    def _locked(self):
+        fcntl.lockf(self._lock_fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.lockf(self._lock_fd, fcntl.LOCK_UN)
+
+    @property
+    def num_free(self):
+        return int(self._control[self.TOP])
+
+    def buffer(self, index):
+        return self.buffers[index]
+
+    def stamp_header(self, header):
+        """
+        Headers are not pre-stamped, PacketBuffer.header is process local and
+        could not tell that another process overwrote the head room
+        """
+        pass
+
+    def get_buffer(self):
+        buffs = self.get_buffers(1)
+        if not buffs:
+            log.error('No memory buffers left in pool %d', self.identifier)
+            return None
+        return buffs[0]
+
+    def get_buffers(self, num_buffers):
+        with self._locked():
+            top = int(self._control[self.TOP])
+            num = min(num_buffers, top)
+            indices = self._free_stack[top - num:top].tolist()
+            self._control[self.TOP] = top - num
+        buffers = self.buffers
+        buffs = [buffers[index] for index in reversed(indices)]
+        for buff in buffs:
+            buff.header = None
+        return buffs
+
+    def free_buffer(self, buff):
+        self.free_buffers([buff])
+
+    def free_buffers(self, buffs):
+        indices = []
+        for buff in buffs:
+            buff.offload = None
+            indices.append(buff.index)
+            segment = buff.next_buffer
+            if segment is not None:
+                buff.next_buffer = None
+                Mempool.pools[segment.mempool_id].free_buffer(segment)
+        with self._locked():
+            top = int(self._control[self.TOP])
+            if top + len(indices) > self.num_entries:
+                raise ValueError('More buffers freed than allocated in pool {:d}'.format(self.identifier))
+            self._free_stack[top:top + len(indices)] = indices
+            self._control[self.TOP] = top + len(indices)
+
+    def free(self):
+        """Detaches this process from the pool"""
+        super().free()
+        os.close(self._lock_fd)
+
+    def unlink(self):
+        """Removes the name, processes that attached keep using the pool"""
+        self.dma.unlink()
+
+
+class Offload(object):
+    """
+    Checksum and segmentation requests of a packet to be sent
+
+    csum_start is where checksumming starts, the checksum is stored at
+    csum_start + csum_offset (e.g. 16 for TCP, 6 for UDP). For segmentation,
+    gso_type takes the VIRTIO_NET_HDR_GSO_* values, gso_size is the payload
+    size of every segment and header_len the length of the headers
+    prepended to each of them.
+    """
+    __slots__ = ('csum_start', 'csum_offset', 'gso_type', 'gso_size', 'header_len')
+
+    def __init__(self, csum_start=None, csum_offset=0, gso_type=0, gso_size=0, header_len=0):
+        self.csum_start = csum_start
+        self.csum_offset = csum_offset
+        self.gso_type = gso_type
+        self.gso_size = gso_size
+        self.header_len = header_len
+
+    def values(self):
+        """Immutable snapshot of the requests, to tell later whether they changed"""
+        return self.csum_start, self.csum_offset, self.gso_type, self.gso_size, self.header_len
+
+    def __eq__(self, other):
+        if isinstance(other, Offload):
+            return self.values() == other.values()
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.values())
+
+    def __repr__(self):
+        return 'Offload({})'.format(', '.join('{}={}'.format(name, getattr(self, name)) for name in self.__slots__))
+
+
 class PacketBuffer(object):
     data_format = 'Q 8x I I 40x'
     data_offset = calcsize(data_format)
@@ -114,6 +353,14 @@ class PacketBuffer(object):
         self.data_buffer = buffer[self.struct.size:]
         # data: Q 8x I I ==> 24
         self.head_room_buffer = buffer[self.head_room_offset:self.struct.size]
+        # Next segment of a packet spanning several buffers
+        self.next_buffer = None
+        # Offload requests for the device, None if there are none
+        self.offload = None
+        # Set on reception if the device has validated the checksum
+        self.checksum_valid = False
+        # Header (or Offload.values()) currently written at the end of the head room, None if unknown
+        self.header = None
 
     @property
     def physical_address(self):
@@ -123,6 +370,16 @@ class PacketBuffer(object):
     def physical_address(self, phyaddr):
         pack_into('Q', self.buffer, 0, phyaddr)
 
+    @property
+    def index(self):
+        """Index of the buffer in its mempool"""
+        # offset: Q => 8
+        return unpack_from('I', self.buffer, 8)[0]
+
+    @index.setter
+    def index(self, index):
+        pack_into('I', self.buffer, 8, index)
+
     @property
     def mempool_id(self):
         # offset: Q 8x => 16
@@ -154,6 +411,12 @@ class PacketBuffer(object):
         unpacked = self.struct.unpack_from(self.buffer)
         return unpacked[0], unpacked[0] + self.data_offset, unpacked[1], unpacked[2]
 
+    def segments(self):
+        segment = self
+        while segment is not None:
+            yield segment
+            segment = segment.next_buffer
+
     @property
     def data_addr(self):
         return self.physical_address + self.data_offset
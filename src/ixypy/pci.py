@@ -28,6 +28,22 @@ class UnknownVendorException(PCIException):
     pass
 
 
+def parse_cpulist(cpulist):
+    """
+    Parses the sysfs cpulist format, e.g. '0-3,8,10-11'
+
+    Returns:
+        set of the CPU numbers
+    """
+    cpus = set()
+    for item in cpulist.strip().split(','):
+        if not item:
+            continue
+        first, _, last = item.partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+
 class PCIConfig(object):
     def __init__(self, **kwargs):
         for key, value in kwargs.items():
@@ -183,15 +199,28 @@ class PCIDeviceController(object):
         else:
             raise RuntimeError('No bound driver')
 
-    def map_resource(self):
-        resource_fd, size = self.resource()
+    def read_config(self, offset, length):
+        with open(self.config_path(), 'rb') as config:
+            config.seek(offset)
+            return config.read(length)
+
+    def local_cpus(self):
+        """CPUs of the device's NUMA node, None if unknown"""
+        cpulist_path = '{}/local_cpulist'.format(self.device_path)
+        if not os.path.exists(cpulist_path):
+            return None
+        with open(cpulist_path, 'r') as cpulist:
+            return parse_cpulist(cpulist.read())
+
+    def map_resource(self, bar=0):
+        resource_fd, size = self.resource(bar)
         try:
             return mmap(resource_fd.fileno(), size, flags=MAP_SHARED, prot=PROT_READ | PROT_WRITE)
         except OSError:
             raise MmapNotSupportedException('Failed mapping device<{}>'.format(self.device_path))
 
-    def resource(self):
-        resource_path = '{}/resource0'.format(self.device_path)
+    def resource(self, bar=0):
+        resource_path = '{}/resource{:d}'.format(self.device_path, bar)
         if os.path.exists(resource_path):
             size = os.stat(resource_path).st_size
             return open(resource_path, 'r+b'), size
@@ -199,7 +228,21 @@ class PCIDeviceController(object):
             raise PCIException('No resource found at<{}>'.format(resource_path))
 
 
+class PCICapability(object):
+    vendor_specific = 0x09
+
+    def __init__(self, cap_id, offset):
+        self.id = cap_id
+        self.offset = offset
+
+    def __repr__(self):
+        return '<PCICapability(id=0x{:02X}, offset=0x{:02X})>'.format(self.id, self.offset)
+
+
 class PCIDevice(object):
+    # Status register bit 4
+    capability_list_flag = 1 << 4
+
     def __init__(self, address, pci_controller=None):
         self.address = address
         if pci_controller is None:
@@ -213,8 +256,8 @@ class PCIDevice(object):
     def enable_dma(self):
         self.pci_controller.enable_dma()
 
-    def resource(self):
-        return self.pci_controller.resource()
+    def resource(self, bar=0):
+        return self.pci_controller.resource(bar)
 
     def has_driver(self):
         return self.pci_controller.has_driver()
@@ -222,12 +265,37 @@ class PCIDevice(object):
     def unbind_driver(self):
         self.pci_controller.unbind_driver(self.address)
 
-    def map_resource(self):
-        return self.pci_controller.map_resource()
+    def map_resource(self, bar=0):
+        return self.pci_controller.map_resource(bar)
 
     def config(self):
         return PCIConfigurationReader(self.pci_controller.config_path()).read()
 
+    def local_cpus(self):
+        return self.pci_controller.local_cpus()
+
+    def read_config(self, offset, length):
+        return self.pci_controller.read_config(offset, length)
+
+    def capabilities(self):
+        """
+        Walks the capability list in the configuration space
+
+        Returns:
+            list of PCICapability
+        """
+        config = self.config()
+        if not config.status_register & self.capability_list_flag:
+            return []
+        capabilities = []
+        offset = config.cap_pointer & ~0x3
+        # At most 48 capabilities fit in the 256 bytes of the configuration space
+        while offset and len(capabilities) < 48:
+            cap_id, next_offset = unpack('BB', self.read_config(offset, 2))
+            capabilities.append(PCICapability(cap_id, offset))
+            offset = next_offset & ~0x3
+        return capabilities
+
     def vendor(self):
         vendor_id = self.config().vendor_id
         try:
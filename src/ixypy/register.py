@@ -1,8 +1,8 @@
 import re
-import time
 from os import pwrite, pread
 from struct import pack_into, unpack_from
-import numpy as np
+
+from ixypy.wait import wait_until, DEFAULT_TIMEOUT
 
 
 class Register(object):
@@ -23,17 +23,19 @@ class Register(object):
         """
         pass
 
-    def wait_set(self, reg, mask, length=1):
+    def wait_set(self, reg, mask, length=1, timeout=DEFAULT_TIMEOUT):
         """
         Args:
             reg: register offset
             mask: bitmask to be set
             length: length in bytes of the mask
+            timeout: seconds until an IxyTimeoutException is raised
+        Returns:
+            the time waited in seconds
         """
-        current = self.get(reg, length)
-        while (current & mask) != mask:
-            time.sleep(0.01)
-            current = self.get(reg, length)
+        return wait_until(lambda: (self.get(reg, length) & mask) == mask,
+                          timeout,
+                          'mask 0x{:X} set in register 0x{:X}'.format(mask, reg))
 
     def __getattr__(self, name):
         op = re.match(r"(?P<operation>(get|set|wait_set))(?P<length>\d+)", name)
@@ -62,17 +64,22 @@ class FileRegister(object):
     def get(self, offset, length=1):
         return int.from_bytes(pread(self.fd.fileno(), length, offset), 'little')
 
-    def wait_set(self, reg, mask, length=1):
+    def wait_set(self, reg, mask, length=1, timeout=DEFAULT_TIMEOUT):
         """
         Args:
             reg: register offset
             mask: bitmask to be set
             length: length in bytes of the mask
+            timeout: seconds until an IxyTimeoutException is raised
+        Returns:
+            the time waited in seconds
         """
-        current = self.get(reg, length)
-        while (current & mask) != mask:
-            time.sleep(0.01)
-            current = self.get(reg, length)
+        return wait_until(lambda: (self.get(reg, length) & mask) == mask,
+                          timeout,
+                          'mask 0x{:X} set in register 0x{:X}'.format(mask, reg))
+
+    def doorbell(self, offset, length=1):
+        return RegisterDoorbell(self, offset, length)
 
     def get8(self, offset):
         return self.get(offset)
@@ -92,24 +99,64 @@ class FileRegister(object):
     def set32(self, offset, value):
         self.set(offset, value, 4)
 
-    def wait_set8(self, reg, mask):
-        self.wait_set(reg, mask)
+    def wait_set8(self, reg, mask, timeout=DEFAULT_TIMEOUT):
+        return self.wait_set(reg, mask, timeout=timeout)
+
+    def wait_set16(self, reg, mask, timeout=DEFAULT_TIMEOUT):
+        return self.wait_set(reg, mask, 2, timeout)
+
+    def wait_set32(self, reg, mask, timeout=DEFAULT_TIMEOUT):
+        return self.wait_set(reg, mask, 4, timeout)
+
+
+class Doorbell(object):
+    """
+    A single register bound to its offset
+
+    Used for the registers written on every batch (e.g. RDT/TDT),
+    it skips the offset computation and returns plain ints
+    """
+    __slots__ = ('reg_vals', 'index')
+
+    def __init__(self, reg_vals, index):
+        self.reg_vals = reg_vals
+        self.index = index
 
-    def wait_set16(self, reg, mask):
-        self.wait_set(reg, mask, 2)
+    def set(self, value):
+        self.reg_vals[self.index] = value
 
-    def wait_set32(self, reg, mask):
-        self.wait_set(reg, mask, 4)
+    def get(self):
+        return self.reg_vals[self.index]
+
+
+class RegisterDoorbell(object):
+    """A register bound to its offset, for registers without a memory view (e.g. port I/O)"""
+    def __init__(self, register, offset, *args):
+        self.register = register
+        self.offset = offset
+        self.args = args
+
+    def set(self, value):
+        self.register.set(self.offset, value, *self.args)
+
+    def get(self):
+        return self.register.get(self.offset, *self.args)
 
 
 class MmapRegister(object):
     def __init__(self, mm):
         self.mm = mm
         self.mem_buffer = memoryview(mm)
-        self.reg_vals = np.frombuffer(self.mem_buffer, dtype=np.uint32)
-
-    def set(self, offset, value):
-        self.reg_vals[offset//4] = value
+        # Indexing a 32 bit memoryview yields native ints, no numpy scalar conversion
+        self.reg_vals = self.mem_buffer.cast('I')
+        # Views for 8 and 16 bit wide registers (e.g. virtio common configuration)
+        self.views = {1: self.mem_buffer.cast('B'), 2: self.mem_buffer.cast('H'), 4: self.reg_vals}
+
+    def set(self, offset, value, length=4):
+        if length == 4:
+            self.reg_vals[offset//4] = value & 0xFFFFFFFF
+        else:
+            self.views[length][offset//length] = value & ((1 << 8*length) - 1)
 
     def set_flags(self, offset, flags):
         new_value = self.get(offset) | flags
@@ -118,18 +165,38 @@ class MmapRegister(object):
     def clear_flags(self, offset, flags):
         self.set(offset, self.get(offset) & ~flags)
 
-    def get(self, offset):
-        return self.reg_vals[offset//4]
+    def get(self, offset, length=4):
+        if length == 4:
+            return self.reg_vals[offset//4]
+        return self.views[length][offset//length]
+
+    def get8(self, offset):
+        return self.get(offset, 1)
+
+    def get16(self, offset):
+        return self.get(offset, 2)
+
+    def get32(self, offset):
+        return self.get(offset)
+
+    def set8(self, offset, value):
+        self.set(offset, value, 1)
+
+    def set16(self, offset, value):
+        self.set(offset, value, 2)
+
+    def set32(self, offset, value):
+        self.set(offset, value)
 
-    def wait_clear(self, offset, mask):
-        current = self.get(offset)
-        while (current & mask) != 0:
-            time.sleep(0.01)
-            current = self.get(offset)
+    def doorbell(self, offset, length=4):
+        return Doorbell(self.views[length], offset//length)
 
-    def wait_set(self, offset, mask):
-        current = self.get(offset)
-        while (current & mask) != mask:
-            time.sleep(0.01)
-            current = self.get(offset)
+    def wait_clear(self, offset, mask, timeout=DEFAULT_TIMEOUT):
+        return wait_until(lambda: (self.get(offset) & mask) == 0,
+                          timeout,
+                          'mask 0x{:X} cleared in register 0x{:X}'.format(mask, offset))
 
+    def wait_set(self, offset, mask, length=4, timeout=DEFAULT_TIMEOUT):
+        return wait_until(lambda: (self.get(offset, length) & mask) == mask,
+                          timeout,
+                          'mask 0x{:X} set in register 0x{:X}'.format(mask, offset))
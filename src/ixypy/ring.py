@@ -0,0 +1,143 @@
+"""
+Single producer, single consumer ring of packet buffer indices
+
+Connects the stages of a multi-process pipeline (e.g. RX -> classify -> TX),
+each stage passes the indices of buffers from a SharedMempool, the packets
+themselves stay where they are. The producer only writes the head and the
+consumer only writes the tail, both on cache lines of their own, so no lock
+is needed. Indices are free running 64 bit counters, the ring size must be
+a power of two.
+"""
+from array import array
+
+import numpy as np
+
+from memory import DmaMemory, memory_barrier
+from ixypy.ixy import IxyException
+
+CACHE_LINE_SIZE = 64
+
+
+class RingException(IxyException):
+    pass
+
+
+class PacketRing(object):
+    """
+    Memory layout:
+        cache line 0: head (u8), size (u4), magic (u4)
+        cache line 1: tail (u8)
+        slots (u4 each)
+    """
+    magic = 0x474E4952
+    slots_offset = 2 * CACHE_LINE_SIZE
+
+    def __init__(self, memory, size=None):
+        """
+        Args:
+            memory: buffer shared with the other side, e.g. an anonymous mmap
+                    created before forking or named DmaMemory
+            size: number of slots to lay out a new ring, None to use the ring
+                  already in the memory
+        """
+        self.memory = memory
+        header = np.frombuffer(memory, dtype=np.uint32, count=4)
+        if size is not None:
+            if size & (size - 1) != 0:
+                raise RingException('Ring size must be a power of 2, got {:d}'.format(size))
+            if len(memory) < self.byte_size(size):
+                raise RingException('Ring of {:d} slots needs {:d} bytes'.format(size, self.byte_size(size)))
+            header[2] = size
+            header[3] = self.magic
+        elif header[3] != self.magic:
+            raise RingException('No ring found in the memory')
+        self.size = int(header[2])
+        self.mask = self.size - 1
+        # Single elements are read and written through memoryviews, which is
+        # several times cheaper than indexing numpy arrays
+        mem = memoryview(memory)
+        self.head = mem[:8].cast('Q')
+        self.tail = mem[CACHE_LINE_SIZE:CACHE_LINE_SIZE + 8].cast('Q')
+        self.slots = np.frombuffer(memory, dtype=np.uint32, count=self.size, offset=self.slots_offset)
+        if size is not None:
+            self.head[0] = 0
+            self.tail[0] = 0
+
+    @staticmethod
+    def byte_size(size):
+        return PacketRing.slots_offset + 4 * size
+
+    @classmethod
+    def create(cls, name, size):
+        return cls(DmaMemory(cls.byte_size(size), False, name=name), size)
+
+    @classmethod
+    def attach(cls, name):
+        return cls(DmaMemory(0, False, name=name, create=False))
+
+    def __len__(self):
+        """Number of indices in the ring"""
+        return self.head[0] - self.tail[0]
+
+    def enqueue(self, indices):
+        """
+        Producer side, appends as many of the indices as there is room for
+
+        Returns:
+            the number of indices enqueued
+        """
+        head = self.head[0]
+        count = min(len(indices), self.size - (head - self.tail[0]))
+        if count == 0:
+            return 0
+        # Converting the list through an array is faster than letting numpy do it
+        indices = array('I', indices[:count])
+        start = head & self.mask
+        first = min(count, self.size - start)
+        slots = self.slots
+        slots[start:start + first] = indices[:first]
+        if first < count:
+            slots[:count - first] = indices[first:]
+        # The slots have to be visible before the head is
+        memory_barrier()
+        self.head[0] = head + count
+        return count
+
+    def dequeue(self, max_count):
+        """
+        Consumer side, takes up to max_count indices
+
+        Returns:
+            list of the indices
+        """
+        tail = self.tail[0]
+        count = min(max_count, self.head[0] - tail)
+        if count == 0:
+            return []
+        # The head has to be read before the slots
+        memory_barrier()
+        start = tail & self.mask
+        first = min(count, self.size - start)
+        slots = self.slots
+        indices = slots[start:start + first].tolist()
+        if first < count:
+            indices += slots[:count - first].tolist()
+        # The slots have to be read before the producer may reuse them
+        memory_barrier()
+        self.tail[0] = tail + count
+        return indices
+
+    def enqueue_buffers(self, buffers):
+        """
+        Enqueues buffers of a SharedMempool, the caller still owns those
+        that did not fit
+
+        Returns:
+            the number of buffers enqueued
+        """
+        return self.enqueue([buffer.index for buffer in buffers])
+
+    def dequeue_buffers(self, mempool, max_count):
+        """Takes up to max_count buffers of the mempool the producer enqueued"""
+        buffer = mempool.buffer
+        return [buffer(index) for index in self.dequeue(max_count)]
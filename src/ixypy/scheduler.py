@@ -0,0 +1,254 @@
+"""
+Run to completion polling of several RX queues
+
+Every round polls each registered queue once and hands the received
+batches to their handlers. Rounds without any packets count as idle;
+after a while the scheduler backs off, first by yielding the CPU, then
+by sleeping for growing intervals bounded by the latency the ports may
+tolerate. The first round with packets switches back to busy polling.
+Packets arriving while the scheduler sleeps wait in the RX rings, so
+the longest sleep should stay below the time it takes to fill one.
+"""
+import os
+import time
+import logging as log
+
+# Empty rounds that are busy polled before backing off
+SPIN_ROUNDS = 10000
+# Empty rounds afterwards that yield the CPU before sleeping
+YIELD_ROUNDS = 100
+MIN_SLEEP = 1e-5
+MAX_SLEEP = 1e-3
+
+
+class IdleBackoff(object):
+    """
+    Decides how long to wait after a round without packets
+
+    Python has no pause instruction, yielding the CPU is the cheapest
+    way to let other processes on the core run before sleeping.
+
+    Args:
+        max_sleep: longest sleep in seconds, i.e. the latency added to
+                   the first packet after an idle period, 0 busy polls
+    """
+    def __init__(self, spin_rounds=SPIN_ROUNDS, yield_rounds=YIELD_ROUNDS, min_sleep=MIN_SLEEP, max_sleep=MAX_SLEEP):
+        self.spin_rounds = spin_rounds
+        self.yield_rounds = yield_rounds
+        self.min_sleep = min(min_sleep, max_sleep)
+        self.max_sleep = max_sleep
+        self.empty_rounds = 0
+        self.sleep = self.min_sleep
+
+    def reset(self):
+        self.empty_rounds = 0
+        self.sleep = self.min_sleep
+
+    def delay(self):
+        """
+        Called after every round without packets
+
+        Returns:
+            None to poll again right away, 0 to yield the CPU first,
+            otherwise the seconds to sleep
+        """
+        self.empty_rounds += 1
+        if self.max_sleep <= 0 or self.empty_rounds <= self.spin_rounds:
+            return None
+        if self.empty_rounds <= self.spin_rounds + self.yield_rounds:
+            return 0
+        sleep = self.sleep
+        self.sleep = min(sleep * 2, self.max_sleep)
+        return sleep
+
+    def idle(self):
+        """
+        Waits as long as delay says
+
+        Returns:
+            True if the call slept
+        """
+        delay = self.delay()
+        if delay is None:
+            return False
+        if delay == 0:
+            os.sched_yield()
+            return False
+        time.sleep(delay)
+        return True
+
+
+class PollTask(object):
+    """An RX queue and the handler of the batches received on it"""
+    def __init__(self, device, queue, handler, batch_size):
+        self.device = device
+        self.queue = queue
+        self.handler = handler
+        self.batch_size = batch_size
+        self.packets = 0
+        self.empty_polls = 0
+
+    def __repr__(self):
+        return '<PollTask(device={}, queue={:d}, packets={:d}, empty_polls={:d})>'.format(
+            self.device.pci_device.address, self.queue, self.packets, self.empty_polls)
+
+
+class PollStats(object):
+    """
+    Time a scheduler spent in rounds with packets and without them
+
+    The idle time includes the time spent sleeping.
+    """
+    fields = ('rounds', 'empty_rounds', 'busy_time', 'idle_time', 'sleep_time')
+
+    def __init__(self, name='scheduler'):
+        self.name = name
+        self.rounds = 0
+        self.empty_rounds = 0
+        self.busy_time = 0.0
+        self.idle_time = 0.0
+        self.sleep_time = 0.0
+
+    def reset(self):
+        self.rounds = 0
+        self.empty_rounds = 0
+        self.busy_time = 0.0
+        self.idle_time = 0.0
+        self.sleep_time = 0.0
+
+    @staticmethod
+    def _percentage(part, total):
+        return 100.0 * part / total if total else 0.0
+
+    def __str__(self):
+        total = self.busy_time + self.idle_time
+        return 'name={} rounds={:d} empty_rounds={:d} busy={:.1f}% idle={:.1f}% sleeping={:.1f}%'.format(
+            self.name,
+            int(self.rounds),
+            int(self.empty_rounds),
+            self._percentage(self.busy_time, total),
+            self._percentage(self.idle_time, total),
+            self._percentage(self.sleep_time, total))
+
+    def print_diff(self, other, interval):
+        busy = self.busy_time - other.busy_time
+        idle = self.idle_time - other.idle_time
+        total = busy + idle
+        print('[{0}] busy {1:^5.1f}% idle {2:^5.1f}% sleeping {3:^5.1f}% empty rounds {4:d}/{5:d}'.format(
+            self.name,
+            self._percentage(busy, total),
+            self._percentage(idle, total),
+            self._percentage(self.sleep_time - other.sleep_time, total),
+            int(self.empty_rounds - other.empty_rounds),
+            int(self.rounds - other.rounds)))
+
+
+class PollScheduler(object):
+    """
+    Round robin poller of RX queues with adaptive idle backoff
+
+    Args:
+        backoff: IdleBackoff, the default one if None
+    """
+    def __init__(self, backoff=None, name='scheduler'):
+        self.backoff = IdleBackoff() if backoff is None else backoff
+        self.stats = PollStats(name)
+        self.tasks = []
+        self.timers = []
+        self.running = False
+
+    def register(self, device, queue, handler, batch_size=32):
+        """
+        Polls the queue of the device in every round
+
+        Args:
+            handler: called with every non-empty list of received buffers,
+                     which it then owns
+        Returns:
+            the PollTask, to unregister it
+        """
+        task = PollTask(device, queue, handler, batch_size)
+        self.tasks.append(task)
+        return task
+
+    def unregister(self, task):
+        self.tasks.remove(task)
+
+    def every(self, interval, callback):
+        """Calls callback(elapsed seconds) about every interval seconds while running"""
+        self.timers.append([interval, callback, time.perf_counter()])
+
+    def poll_once(self):
+        """
+        Polls every queue once
+
+        Returns:
+            the number of packets received
+        """
+        packets = 0
+        for task in self.tasks:
+            buffers = task.device.rx_batch(task.queue, task.batch_size)
+            if buffers:
+                task.packets += len(buffers)
+                packets += len(buffers)
+                task.handler(buffers)
+            else:
+                task.empty_polls += 1
+        return packets
+
+    def _run_timers(self, now):
+        next_timer = float('inf')
+        for timer in self.timers:
+            interval, callback, last = timer
+            if now - last >= interval:
+                callback(now - last)
+                timer[2] = last = now
+            next_timer = min(next_timer, last + interval)
+        return next_timer
+
+    def run(self):
+        """Polls until stop is called, e.g. by a handler or a timer"""
+        stats = self.stats
+        backoff = self.backoff
+        poll_once = self.poll_once
+        clock = time.perf_counter
+        log.info('Polling %d queues', len(self.tasks))
+        self.running = True
+        start = clock()
+        next_timer = self._run_timers(start)
+        # Busy rounds are only counted in the stats when the timers run
+        busy_rounds = 0
+        busy_since = start
+        while self.running:
+            if poll_once():
+                busy_rounds += 1
+                if backoff.empty_rounds:
+                    backoff.reset()
+                now = clock()
+            else:
+                if busy_rounds:
+                    stats.rounds += busy_rounds
+                    stats.busy_time += start - busy_since
+                    busy_rounds = 0
+                stats.rounds += 1
+                stats.empty_rounds += 1
+                if backoff.idle():
+                    now = clock()
+                    # Sleeps overshoot, so the whole round is measured instead of adding up the requested times
+                    stats.sleep_time += now - start
+                else:
+                    now = clock()
+                stats.idle_time += now - start
+                busy_since = now
+            start = now
+            if now >= next_timer:
+                stats.rounds += busy_rounds
+                stats.busy_time += now - busy_since
+                busy_rounds = 0
+                next_timer = self._run_timers(now)
+                start = busy_since = clock()
+        stats.rounds += busy_rounds
+        stats.busy_time += start - busy_since
+
+    def stop(self):
+        self.running = False
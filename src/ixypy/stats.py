@@ -1,3 +1,6 @@
+from multiprocessing import RawArray
+
+
 class Stats(object):
     def __init__(self, device, rxp=0, txp=0, rxb=0, txb=0):
         self.device = device
@@ -5,24 +8,38 @@ class Stats(object):
         self.tx_packets = txp
         self.rx_bytes = rxb
         self.tx_bytes = txb
+        # Queue notifications issued/suppressed (virtio only)
+        self.kicks = 0
+        self.suppressed_kicks = 0
+        # Where the polling workers ran, see ixypy.affinity
+        self.placement = None
 
     def reset(self):
         self.rx_packets = 0
         self.tx_packets = 0
         self.rx_bytes = 0
         self.tx_bytes = 0
+        self.kicks = 0
+        self.suppressed_kicks = 0
 
     def print_stats(self):
         print('{0} RX: {1} bytes {2} packets'.format(self.device.address, self.rx_bytes, self.rx_packets))
         print('{0} TX: {1} bytes {2} packets'.format(self.device.address, self.tx_bytes, self.tx_packets))
+        if self.kicks or self.suppressed_kicks:
+            print('{0} kicks: {1} issued {2} suppressed'.format(self.device.address, self.kicks, self.suppressed_kicks))
+        if self.placement:
+            print('{0} placement: {1}'.format(self.device.address, self.placement))
 
     def __str__(self):
-        return 'address={} packets(rx={}, tx={}) bytes(rx={}, tx={})'.format(
+        return 'address={} packets(rx={}, tx={}) bytes(rx={}, tx={}) kicks(issued={}, suppressed={}) placement={}'.format(
             self.device.address,
             self.rx_packets,
             self.tx_packets,
             self.rx_bytes,
-            self.tx_bytes)
+            self.tx_bytes,
+            self.kicks,
+            self.suppressed_kicks,
+            self.placement)
 
     @staticmethod
     def _diff_mpps(pkt_new, pkt_old, interval):
@@ -41,3 +58,45 @@ class Stats(object):
         tx_diff_mpps = self._diff_mpps(self.tx_packets, other.tx_packets, interval)
         print('[{0}] RX: {1:^5.2f} Mbit/s {2:^5.2f} Mpps'.format(self.device.address, rx_diff_mbit, rx_diff_mpps))
         print('[{0}] TX: {1:^5.2f} Mbit/s {2:^5.2f} Mpps'.format(self.device.address, tx_diff_mbit, tx_diff_mpps))
+        if self.kicks or self.suppressed_kicks:
+            print('[{0}] kicks: {1:d} issued {2:d} suppressed'.format(self.device.address,
+                                                                     self.kicks - other.kicks,
+                                                                     self.suppressed_kicks - other.suppressed_kicks))
+        if self.placement:
+            print('[{0}] placement: {1}'.format(self.device.address, self.placement))
+
+
+class SharedStats(object):
+    """
+    Counters of several worker processes in shared memory
+
+    Every worker publishes the stats it read for a device into its own slot,
+    so there is no locking, and the parent process sums the slots up
+
+    Args:
+        fields: attributes to share, those of Stats by default
+        typecode: array typecode of the attributes, 'd' for float ones
+    """
+    stats_fields = ('rx_packets', 'tx_packets', 'rx_bytes', 'tx_bytes', 'kicks', 'suppressed_kicks')
+
+    def __init__(self, num_workers, num_devices, fields=stats_fields, typecode='Q'):
+        self.num_workers = num_workers
+        self.num_devices = num_devices
+        self.fields = fields
+        # Must be created before the workers are forked
+        self.counters = RawArray(typecode, num_workers * num_devices * len(self.fields))
+
+    def _slot(self, worker, device_index):
+        return (worker * self.num_devices + device_index) * len(self.fields)
+
+    def publish(self, worker, device_index, stats):
+        """Stores the worker's cumulative stats of the device"""
+        offset = self._slot(worker, device_index)
+        for i, field in enumerate(self.fields):
+            self.counters[offset + i] = getattr(stats, field)
+
+    def read(self, device_index, stats):
+        """Sets stats to the sum over all workers"""
+        for i, field in enumerate(self.fields):
+            setattr(stats, field, sum(self.counters[self._slot(worker, device_index) + i]
+                                      for worker in range(self.num_workers)))
@@ -0,0 +1,186 @@
+"""
+Register access tracing
+
+Tracing is enabled globally with `enable_tracing` and only affects
+registers created afterwards: `traced` returns the register untouched
+when tracing is off, so the hot path runs without any indirection.
+"""
+import sys
+import time
+from collections import Counter
+from types import MethodType
+
+from ixypy.register import RegisterDoorbell
+
+READ = 'R'
+WRITE = 'W'
+
+_trace = None
+
+
+def enable_tracing(capacity=65536):
+    global _trace
+    _trace = RegisterTrace(capacity)
+    return _trace
+
+
+def disable_tracing():
+    global _trace
+    _trace = None
+
+
+def get_trace():
+    return _trace
+
+
+def traced(register, names=None):
+    """
+    Wraps the register in a TracedRegister if tracing is enabled
+
+    Args:
+        register: MmapRegister or FileRegister
+        names: RegisterNames used to resolve the offsets
+    """
+    if _trace is None:
+        return register
+    return TracedRegister(register, _trace, names)
+
+
+class RegisterNames(object):
+    """
+    Reverse mapping of register offsets to their symbolic names
+
+    Names are taken from the constants and the per queue register
+    functions (e.g. IXGBE_RDT(i)) of a types module. Offsets shared
+    by several constants resolve to the shortest register-like name.
+    Constants starting with one of the excluded prefixes are skipped.
+    """
+    excluded_suffixes = ('_SHIFT', '_MASK')
+
+    def __init__(self, module, prefix, num_queues=64, excluded_prefixes=()):
+        self.module = module
+        self.prefix = prefix
+        self.num_queues = num_queues
+        self.excluded_prefixes = tuple(excluded_prefixes)
+        self._names = None
+
+    def _build(self):
+        names = {}
+        candidates = [(name, value) for name, value in vars(self.module).items()
+                      if name.startswith(self.prefix) and not name.endswith(self.excluded_suffixes)
+                      and not name.startswith(self.excluded_prefixes)]
+        for name, value in candidates:
+            if callable(value):
+                for i in range(self.num_queues):
+                    names.setdefault(value(i), '{}({:d})'.format(name, i))
+        constants = sorted((name.count('_'), name, value) for name, value in candidates if isinstance(value, int))
+        for _, name, value in constants:
+            names.setdefault(value, name)
+        return names
+
+    def __getitem__(self, offset):
+        if self._names is None:
+            self._names = self._build()
+        return self._names.get(offset, '0x{:05X}'.format(offset))
+
+
+class RegisterTrace(object):
+    """
+    Preallocated ring of register accesses
+
+    Once full, the oldest records are overwritten
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.offsets = [0]*capacity
+        self.names = [None]*capacity
+        self.operations = [None]*capacity
+        self.values = [0]*capacity
+        self.timestamps = [0]*capacity
+        self.sites = [None]*capacity
+        self.count = 0
+
+    def record(self, operation, offset, name, value, site):
+        i = self.count % self.capacity
+        self.offsets[i] = offset
+        self.names[i] = name
+        self.operations[i] = operation
+        self.values[i] = value
+        self.timestamps[i] = time.perf_counter()
+        self.sites[i] = site
+        self.count += 1
+
+    def reset(self):
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def records(self):
+        """Yields (timestamp, operation, offset, name, value, site) from the oldest to the newest"""
+        start = self.count - len(self)
+        for n in range(start, self.count):
+            i = n % self.capacity
+            yield (self.timestamps[i], self.operations[i], self.offsets[i],
+                   self.names[i], self.values[i], self.sites[i])
+
+    def per_register(self):
+        return Counter((name, operation) for _, operation, _, name, _, _ in self.records())
+
+    def per_site(self):
+        return Counter((site, operation) for _, operation, _, _, _, site in self.records())
+
+    def print_summary(self):
+        print('{:d} register accesses ({:d} recorded)'.format(self.count, len(self)))
+        print('{:<32} {:^2} {:>10}'.format('register', 'op', 'count'))
+        for (name, operation), count in self.per_register().most_common():
+            print('{:<32} {:^2} {:>10d}'.format(name, operation, count))
+        print('{:<48} {:^2} {:>10}'.format('call site', 'op', 'count'))
+        for (site, operation), count in self.per_site().most_common():
+            print('{:<48} {:^2} {:>10d}'.format(site, operation, count))
+
+
+class TracedRegister(object):
+    """
+    Records every get/set of the wrapped register
+
+    The remaining register methods (set_flags, wait_set, get32, ...) are
+    run against the wrapper, so the accesses they perform are recorded too
+    """
+    def __init__(self, register, trace, names=None):
+        self.register = register
+        self.trace = trace
+        self.register_names = names
+
+    def _name(self, offset):
+        if self.register_names is None:
+            return '0x{:05X}'.format(offset)
+        return self.register_names[offset]
+
+    def _call_site(self):
+        frame = sys._getframe(2)
+        register_file = sys.modules[type(self.register).__module__].__file__
+        while frame is not None and frame.f_code.co_filename in (__file__, register_file):
+            frame = frame.f_back
+        if frame is None:
+            return '<unknown>'
+        return '{}:{:d}'.format(frame.f_code.co_name, frame.f_lineno)
+
+    def get(self, offset, *args):
+        value = self.register.get(offset, *args)
+        self.trace.record(READ, offset, self._name(offset), value, self._call_site())
+        return value
+
+    def set(self, offset, value, *args):
+        self.trace.record(WRITE, offset, self._name(offset), value, self._call_site())
+        self.register.set(offset, value, *args)
+
+    def doorbell(self, offset, *args):
+        return RegisterDoorbell(self, offset, *args)
+
+    def __getattr__(self, name):
+        attr = getattr(type(self.register), name, None)
+        if callable(attr):
+            return MethodType(attr, self)
+        return getattr(self.register, name)
+
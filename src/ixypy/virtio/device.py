@@ -2,312 +2,565 @@ import time
 import logging as log
 
 from functools import reduce
+from collections import OrderedDict
 
 from memory import DmaMemory
-from ixypy.mempool import Mempool
-from ixypy.virtio.structures import VRing, VQueue, VirtioNetworkControl, PromiscuousModeCommand, VirtioNetworkHeader
+from ixypy.mempool import Mempool, PacketBuffer
+from ixypy.virtio.structures import VRing, VQueue, VirtioNetworkControl, PromiscuousModeCommand, VirtioNetworkHeader,\
+                                    MultiQueueCommand, VirtioNetworkMergeableHeader, IndirectTables,\
+                                    AllMulticastCommand, MacTableCommand, VlanFilterCommand
 from ixypy.ixy import IxyDevice
 from ixypy.virtio import types
-from ixypy.register import FileRegister
+from ixypy.wait import wait_until, IxyTimeoutException
+from ixypy.virtio.transport import transport_for
+from ixypy.virtio.packed import PackedRing, PackedVQueue
 from ixypy.virtio.exception import VirtioException
 
 
-class VirtioLegacyDevice(IxyDevice):
+class VirtioDevice(IxyDevice):
     net_hdr = VirtioNetworkHeader(flags=0, gso_type=types.VIRTIO_NET_HDR_GSO_NONE, header_len=14 + 20 + 8)
-
-    def __init__(self, pci_device):
+    CTRL_TIMEOUT = 1
+    MAX_QUEUE_PAIRS = types.VIRTIO_NET_CTRL_MQ_VQ_PAIRS_MAX
+    # Packet buffers per indirect descriptor table
+    MAX_TX_SEGMENTS = 16
+    # Feature the device needs to accept commands of a class
+    command_features = {
+        types.VIRTIO_NET_CTRL_RX: types.VIRTIO_NET_F_CTRL_RX,
+        types.VIRTIO_NET_CTRL_MAC: types.VIRTIO_NET_F_CTRL_RX,
+        types.VIRTIO_NET_CTRL_VLAN: types.VIRTIO_NET_F_CTRL_VLAN,
+        types.VIRTIO_NET_CTRL_MQ: types.VIRTIO_NET_F_MQ,
+    }
+    # Feature the device needs to accept packets of a GSO type
+    gso_features = {
+        types.VIRTIO_NET_HDR_GSO_TCPV4: types.VIRTIO_NET_F_HOST_TSO4,
+        types.VIRTIO_NET_HDR_GSO_TCPV6: types.VIRTIO_NET_F_HOST_TSO6,
+        types.VIRTIO_NET_HDR_GSO_UDP: types.VIRTIO_NET_F_HOST_UFO,
+    }
+
+    def __init__(self, pci_device, num_rx_queues=1, num_tx_queues=1, transport=None):
+        """
+        Args:
+            transport: VirtioTransport to drive the device through, by default the
+                       one the PCI device exposes (see transport_for)
+        """
+        self.transport = transport
         self.rx_pkt_count = 0
         self.tx_pkt_count  = 0
-        # Supporting at most 1 tx/rx queue
-        super().__init__(pci_device, 'ixypy-virtio')
-        self._verify_is_legacy()
+        if num_rx_queues != num_tx_queues:
+            raise VirtioException('RX and TX queues come in pairs, got {:d} RX and {:d} TX queues'
+                                  .format(num_rx_queues, num_tx_queues))
+        super().__init__(pci_device,
+                         'ixypy-virtio',
+                         self.MAX_QUEUE_PAIRS,
+                         self.MAX_QUEUE_PAIRS,
+                         num_rx_queues,
+                         num_tx_queues)
         self.tx_pkts = 0
         self.tx_bytes = 0
         self.rx_pkts = 0
         self.rx_bytes = 0
+        self.kicks = 0
+        self.suppressed_kicks = 0
 
     def _initialize_device(self):
         """Section 3.1"""
-        log.debug('Configuring bar0')
         self.ctrl_queues = []
-        self.resource, self.resource_size = self.pci_device.resource()
-        self.reg = FileRegister(self.resource)
+        # Buffer id to (command, deadline, timeout) of the commands posted but not completed yet
+        self.pending_commands = OrderedDict()
+        # Buffer ids of the commands that timed out, the device may still return them
+        self.expired_commands = set()
+        if self.transport is None:
+            self.transport = transport_for(self.pci_device)
         self._reset_devices()
         self._ack_device()
         self._drive_device()
         self._setup_features()
-        self._setup_rx_queue()
-        self._setup_tx_queue()
+        self.mergeable_rx_buffers = self._has_feature(types.VIRTIO_NET_F_MRG_RXBUF)
+        self.packed_rings = self._has_feature(types.VIRTIO_F_RING_PACKED)
+        # Section 5.1.6, virtio 1.0 devices always use the header with num_buffers
+        if self.mergeable_rx_buffers or self._has_feature(types.VIRTIO_F_VERSION_1):
+            self.net_hdr = VirtioNetworkMergeableHeader(flags=0,
+                                                        gso_type=types.VIRTIO_NET_HDR_GSO_NONE,
+                                                        header_len=14 + 20 + 8)
+        self._setup_queue_pairs()
         self._setup_ctrl_queue()
         self.signal_ok()
         self.verify_device()
+        if self.num_rx_queues > 1:
+            log.debug('Enabling %d queue pairs', self.num_rx_queues)
+            self.send_cmd(VirtioNetworkControl(MultiQueueCommand(self.num_rx_queues)))
         log.debug('Setting promisc mode')
         self.set_promisc()
 
-    def _verify_is_legacy(self):
-        legacy_device_id = 0x1000
-        if self.pci_device.config().device_id != legacy_device_id:
-            raise VirtioException('Device with id 0x{:02X} not supported'.format(self.pci_device.config().device_id))
-
     def set_promisc(self, on=True):
-        command = VirtioNetworkControl(PromiscuousModeCommand(on=True))
-        self.send_cmd(command)
+        self.send_cmd(VirtioNetworkControl(PromiscuousModeCommand(on)))
+
+    def set_allmulti(self, on=True):
+        """Receive all multicast packets, independent of the MAC table"""
+        self.send_cmd(VirtioNetworkControl(AllMulticastCommand(on)))
+
+    def set_mac_table(self, unicast=(), multicast=()):
+        """
+        Section 5.1.6.5.2
+        Outside of promiscuous mode the device only passes packets to these
+        addresses (and broadcasts), the rest is filtered on the host
+        """
+        self.send_cmd(VirtioNetworkControl(MacTableCommand(unicast, multicast)))
+
+    def add_vlan(self, vlan_id):
+        """Section 5.1.6.5.3, requires VIRTIO_NET_F_CTRL_VLAN"""
+        self.send_cmd(VirtioNetworkControl(VlanFilterCommand(vlan_id, add=True)))
+
+    def remove_vlan(self, vlan_id):
+        self.send_cmd(VirtioNetworkControl(VlanFilterCommand(vlan_id, add=False)))
 
     def read_stats(self, stats):
         stats.rx_packets += self.rx_pkts
         stats.tx_packets += self.tx_pkts
         stats.rx_bytes += self.rx_bytes
         stats.tx_bytes += self.tx_bytes
+        stats.kicks += self.kicks
+        stats.suppressed_kicks += self.suppressed_kicks
         self.rx_pkts, self.tx_pkts, self.rx_bytes, self.tx_bytes = 0, 0, 0, 0
+        self.kicks, self.suppressed_kicks = 0, 0
 
     def get_link_speed(self):
         return 1000
 
     def rx_batch(self, queue_id, batch_size):
-        vq = self.rx_queues[0]
+        vq = self.rx_queues[queue_id]
         buffs = []
-        vring_last_used_index = vq.vring.used.index
-        # Read buffers from rx queue
-        for _ in range(batch_size):
-            if vq.used_last_index == vring_last_used_index:
-                break
-            used_element = vq.vring.used.rings[vq.used_last_index % vq.vring.size]
-            used_element_id = used_element.id
-            desc = vq.vring.descriptors[used_element_id]
-            vq.used_last_index += 1
-            self.rx_pkt_count += 1
-            if desc.flags != types.VRING_DESC_F_WRITE:
-                log.error("Unsupported rx flags on descriptor: %x", desc.flags)
-            desc.reset()
-            buf = vq.buffers[used_element_id]
+        hdr_len = len(self.net_hdr)
+        mergeable = self.mergeable_rx_buffers
+        # Every packet takes at least one used element, more are read for mergeable packets that need them
+        count = vq.num_used(batch_size)
+        ids, lengths = vq.used_entries(count)
+        queue_buffers = vq.buffers
+        received = 0
+        while received < count and len(buffs) < batch_size:
+            buf = queue_buffers[ids[received]]
+            num_buffers = VirtioNetworkMergeableHeader.num_buffers_in(buf) if mergeable else 1
+            if received + num_buffers > count:
+                count = vq.num_used(received + num_buffers + batch_size - len(buffs) - 1)
+                ids, lengths = vq.used_entries(count)
+            if num_buffers == 0 or received + num_buffers > count:
+                # The device publishes all buffers of a packet at once, the header is broken
+                log.warning('Dropping packet of %d buffers, %d buffers are used', num_buffers, count - received)
+                dropped = 1 if num_buffers == 0 else count - received
+                for index in ids[received:received + dropped]:
+                    vq.mempool.free_buffer(queue_buffers[index])
+                received += dropped
+                continue
+            # The device wrote its own header (or data) into the head room
+            buf.header = None
+            buf.size = lengths[received] - hdr_len
+            buf.checksum_valid = bool(buf.head_room_buffer[-hdr_len] & types.VIRTIO_NET_HDR_F_DATA_VALID)
+            buff_size = buf.size
+            if num_buffers > 1:
+                segments = slice(received + 1, received + num_buffers)
+                buff_size += self._receive_segments(buf,
+                                                    [queue_buffers[index] for index in ids[segments]],
+                                                    lengths[segments])
+            received += num_buffers
             buffs.append(buf)
-            buff_size = used_element.length
-            buf.size = buff_size
             self.rx_bytes += buff_size
-            self.rx_pkts += 1
+        if received:
+            vq.release_used(ids[:received])
+            vq.hold_off_interrupts()
+            self.rx_pkt_count += received
+            self.rx_pkts += len(buffs)
 
-        for index, desc in vq.free_descriptors():
-            pkt_buf = vq.mempool.get_buffer()
-            pkt_buf.size = vq.mempool.buffer_size
-            self.net_hdr.to_buffer(pkt_buf.head_room_buffer[-len(self.net_hdr):])
-            desc.length = pkt_buf.size + len(self.net_hdr)
-            desc.address = pkt_buf.data_addr - len(self.net_hdr)
-            desc.flags = types.VRING_DESC_F_WRITE
-            desc.next = 0
-            vq.buffers[index] = pkt_buf
-            vq.vring.available.rings[vq.vring.available.index % vq.vring.size] = index
-            vq.vring.available.index += 1
-            self._notify_queue(0)
+        self._refill_rx_queue(vq)
         return buffs
 
-    def _free_sent_buffers(self, vq):
-        mempool = None
-        while vq.used_last_index != vq.vring.used.index:
-            used_element = vq.vring.used.rings[vq.used_last_index % vq.vring.size]
-            idx = used_element.id
-            buff = vq.buffers[idx]
-            if buff:
-                vq.buffers[idx] = None
-            else:
-                break
-            desc = vq.vring.descriptors[idx]
-            desc.address = 0
-            desc.length = 0
-            if not mempool:
-                mempool = Mempool.pools[buff.mempool_id]
-            mempool.free_buffer(buff)
-            vq.used_last_index += 1
+    def _receive_segments(self, head, segments, lengths):
+        """
+        Chains the remaining buffers of a mergeable packet to its head buffer
+
+        Only the first buffer carries the header, the following ones are filled from
+        where the header would be, so their data is moved in place to the data offset
+
+        Returns:
+            the size of the chained segments
+        """
+        hdr_len = len(self.net_hdr)
+        last = head
+        size = 0
+        for segment, length in zip(segments, lengths):
+            segment.header = None
+            data_offset = segment.data_offset
+            segment.buffer[data_offset:data_offset + length] = segment.buffer[data_offset - hdr_len:data_offset - hdr_len + length]
+            segment.size = length
+            last.next_buffer = segment
+            last = segment
+            size += length
+        return size
+
+    def _refill_rx_queue(self, vq):
+        """
+        Publishes all free descriptors with fresh buffers, the device
+        is notified once for the whole batch
+        """
+        hdr_len = len(self.net_hdr)
+        buffers = vq.mempool.get_buffers(vq.num_free)
+        if not buffers:
+            return
+        for pkt_buf in buffers:
+            pkt_buf.size = vq.mempool.buffer_size
+        # The device writes from the header on, the data of mergeable continuation buffers
+        # is moved by the header length afterwards and still has to fit into the buffer
+        buffer_length = vq.mempool.buffer_size - PacketBuffer.data_offset
+        old_index, new_index = vq.add_buffers(buffers,
+                                              [pkt_buf.data_addr - hdr_len for pkt_buf in buffers],
+                                              buffer_length,
+                                              types.VRING_DESC_F_WRITE)
+        self._kick(vq, old_index, new_index)
+
+    @staticmethod
+    def _free_sent_buffers(vq):
+        count = vq.num_used(vq.size)
+        if count == 0:
+            return
+        ids, _ = vq.used_entries(count)
+        queue_buffers = vq.buffers
+        mempool = Mempool.pools[queue_buffers[ids[0]].mempool_id]
+        for index in ids:
+            mempool.free_buffer(queue_buffers[index])
+        vq.release_used(ids)
+        vq.hold_off_interrupts()
 
     def tx_batch(self, buffers, queue_id=0):
-        vq = self.tx_queues[0]
+        vq = self.tx_queues[queue_id]
         self._free_sent_buffers(vq)
-        buffer_index = 0
-        free_descriptors = vq.free_descriptors()
-        for buffer in buffers:
+        batch = buffers[:vq.num_free]
+        if not batch:
+            return 0
+        hdr_len = len(self.net_hdr)
+        if vq.indirect is not None:
+            indices = vq.take_free(len(batch))
+            addresses = []
+            lengths = []
+            tx_bytes = 0
             try:
-                index, desc = next(free_descriptors)
-            except StopIteration:
-                break
-            else:
-                vq.buffers[index] = buffer
-                buffer_size = buffer.size
+                for index, buffer in zip(indices, batch):
+                    header_address = None
+                    if buffer.offload is not None:
+                        # The shared header requests no offloads
+                        self._write_tx_header(buffer)
+                        header_address = buffer.data_addr - hdr_len
+                    table_address, table_length = vq.indirect.write(index, buffer, header_address)
+                    addresses.append(table_address)
+                    lengths.append(table_length)
+                    tx_bytes += sum(segment.size for segment in buffer.segments())
+            except VirtioException:
+                # Nothing of the batch is sent if a packet is rejected
+                vq.return_free(indices)
+                raise
+            old_index, new_index = vq.publish(indices, batch, addresses, lengths, types.VRING_DESC_F_INDIRECT)
+        else:
+            for buffer in batch:
+                if buffer.next_buffer is not None:
+                    raise VirtioException('Multi-segment packets require VIRTIO_RING_F_INDIRECT_DESC')
+                self._write_tx_header(buffer)
+            old_index, new_index = vq.add_buffers(batch,
+                                                  [buffer.physical_address + buffer.data_offset - hdr_len for buffer in batch],
+                                                  [buffer.size + hdr_len for buffer in batch])
+            tx_bytes = sum(buffer.size for buffer in batch)
+        self.tx_bytes += tx_bytes
+        self.tx_pkts += len(batch)
+        self._kick(vq, old_index, new_index)
+        return len(batch)
+
+    def _write_tx_header(self, buffer):
+        """
+        Writes the static header, or one with the offloads the packet requests,
+        unless the buffer already holds it (see prepare_tx_mempool)
+        """
+        offload = buffer.offload
+        if offload is None:
+            if buffer.header is not self.net_hdr:
                 self.net_hdr.to_buffer(buffer.head_room_buffer[-len(self.net_hdr):])
-                desc.length = buffer_size + len(self.net_hdr)
-                offset = buffer.data_offset - len(self.net_hdr)
-                desc.address = buffer.physical_address + offset
-                desc.flags = 0
-                desc.next_descriptor = 0
-                vq.vring.available.rings[index] = index
-                buffer_index += 1
-                self.tx_bytes += buffer_size
-                self.tx_pkts += 1
-        vq.vring.available.index += buffer_index
-        self._notify_queue(vq.identifier)
-        return buffer_index
+                buffer.header = self.net_hdr
+        else:
+            # A snapshot, the caller may change the Offload in place for the next packet
+            values = offload.values()
+            if buffer.header != values:
+                self._verify_offload(offload)
+                self.net_hdr.offload_to_buffer(offload, buffer.head_room_buffer[-len(self.net_hdr):])
+                buffer.header = values
+
+    def prepare_tx_mempool(self, mempool):
+        """Stamps the static header into all buffers, so sending them writes no header"""
+        mempool.stamp_header(self.net_hdr)
+
+    def _verify_offload(self, offload):
+        gso_type = offload.gso_type & ~types.VIRTIO_NET_HDR_GSO_ECN
+        if gso_type == types.VIRTIO_NET_HDR_GSO_NONE:
+            return
+        if offload.csum_start is None:
+            raise VirtioException('Segmentation offload requires checksum offload')
+        feature = self.gso_features.get(gso_type)
+        if feature is None or not self._has_feature(feature):
+            raise VirtioException('GSO type {:d} not supported by the device'.format(offload.gso_type))
 
     def verify_device(self):
         if self.get_pci_status() == types.VIRTIO_CONFIG_STATUS_FAILED:
             raise VirtioException('Failed to initialize device')
 
     def signal_ok(self):
-        self.reg.set(types.VIRTIO_PCI_STATUS, types.VIRTIO_CONFIG_STATUS_DRIVER_OK)
+        self.transport.add_status(types.VIRTIO_CONFIG_STATUS_DRIVER_OK)
 
     def get_pci_status(self):
-        return self.reg.get16(types.VIRTIO_PCI_STATUS)
+        return self.transport.get_status()
 
     def send_cmd(self, net_ctrl):
-        if net_ctrl.command_class != types.VIRTIO_NET_CTRL_RX:
+        """
+        Posts the command and polls the control queue until it completed
+
+        Raises:
+            VirtioException if the device rejected the command
+            IxyTimeoutException if it did not complete within CTRL_TIMEOUT
+        """
+        self.post_cmd(net_ctrl)
+
+        def completed():
+            self.poll_ctrl_queue()
+            return net_ctrl.completed
+        try:
+            wait_until(completed, self.CTRL_TIMEOUT, 'control command')
+        except IxyTimeoutException:
+            # Unless poll_ctrl_queue expired it already, it must not raise for it later
+            for buffer_id, pending in list(self.pending_commands.items()):
+                if pending[0] is net_ctrl:
+                    self._expire_command(buffer_id)
+            raise
+        if not net_ctrl.ok:
+            raise VirtioException('Device rejected {}'.format(net_ctrl))
+
+    def post_cmd(self, net_ctrl, timeout=None):
+        """
+        Makes the command available to the device without waiting for it,
+        it completes in a later poll_ctrl_queue
+
+        Returns:
+            the command, check its completed and ok attributes
+        """
+        feature = self.command_features.get(net_ctrl.command_class)
+        if feature is None or not self._has_feature(feature):
             raise VirtioException('Command class[{}] is not supported'.format(net_ctrl.command_class))
         vq = self.ctrl_queues[0]
-        vring = vq.vring
-        index, header_descriptor = vq.get_free_descriptor()
-        log.debug('Found descriptor slot at {:d} ({:d})'.format(index, vring.size))
-        log.debug('Packet buffer allocation')
         pkt_buf = vq.mempool.get_buffer()
+        if pkt_buf is None:
+            raise VirtioException('No buffer left for {}'.format(net_ctrl))
+        if len(net_ctrl) > len(pkt_buf.data_buffer):
+            vq.mempool.free_buffer(pkt_buf)
+            raise VirtioException('{} does not fit into a packet buffer'.format(net_ctrl))
         net_ctrl.to_buffer(pkt_buf.data_buffer)
-        vq.buffers[index] = pkt_buf
-
-        log.debug('Writing to descriptor {:d}'.format(index))
-        # Device-readable head: cmd header
-        header_descriptor.length = 2
-        header_descriptor.address = pkt_buf.data_addr
-        header_descriptor.flags = types.VRING_DESC_F_NEXT
-        header_descriptor.next_descriptor, payload_dscr = vq.get_free_descriptor()
-
-        log.debug('Writing to descriptor {:d}'.format(header_descriptor.next_descriptor))
-        # Device-readable payload: data
-        payload_dscr.length = len(net_ctrl) - 2 - 1
-        payload_dscr.address = pkt_buf.data_addr + 2
-        payload_dscr.flags = types.VRING_DESC_F_NEXT
-        payload_dscr.next_descriptor, ack_flag = vq.get_free_descriptor()
-
-        log.debug('Writing to descriptor {:d}'.format(payload_dscr.next_descriptor))
-        # Device-writable tail: ack flag
-        ack_flag.length = 1
-        ack_flag.address = pkt_buf.data_addr + len(net_ctrl) - 1
-        ack_flag.flags = types.VRING_DESC_F_WRITE
-        ack_flag.next_descriptor = 0
-
-        log.debug('Avail index %d', vring.available.index)
-        log.debug('Ring index = %d', vring.available.index % vring.size)
-        vring.available.rings[vring.available.index % vring.size] = index
-        vring.available.index += 1
-
-        log.debug('Notifying queue')
-        self._notify_queue(vq.identifier)
-        # wait until buffer processed
-        while vq.used_last_index == vring.used.index:
-            time.sleep(1)
-        vq.used_last_index += 1
-        log.debug('Retrieved used element')
-        log.debug('Used buff index => %d', vring.used.index)
-        used_element = vring.used.rings[vring.used.index]
-        log.debug('UE: %s', used_element)
-        if used_element.id != index:
-            log.error('Used buffer has different index as sent one')
-        log.debug('Freeing buffer')
-
-        vq.mempool.free_buffer(pkt_buf)
-        for descriptor in [header_descriptor, payload_dscr, ack_flag]:
-            descriptor.reset()
-
-    def _notify_queue(self, index):
-        self.reg.set16(types.VIRTIO_PCI_QUEUE_NOTIFY, index)
-
-    def _notify_offset(self):
-        return self.reg.get16(types.VIRTIO_PCI_QUEUE_NOTIFY)
-
-    def _setup_rx_queue(self):
-        self.rx_queues.append(self._setup_queue(index=0))
-
-    def _setup_tx_queue(self):
-        self.tx_queues.append(self._setup_queue(index=1, is_mempool_required=False))
+        address = pkt_buf.data_addr
+        try:
+            # Device-readable header and payload, device-writable ack flag
+            vq.add_chain(pkt_buf, [(address, 2, 0),
+                                   (address + 2, len(net_ctrl) - 2 - 1, 0),
+                                   (address + len(net_ctrl) - 1, 1, types.VRING_DESC_F_WRITE)])
+        except VirtioException:
+            # Too many commands in flight
+            vq.mempool.free_buffer(pkt_buf)
+            raise
+        self._notify_queue(vq)
+        if timeout is None:
+            timeout = self.CTRL_TIMEOUT
+        self.pending_commands[id(pkt_buf)] = (net_ctrl, time.perf_counter() + timeout, timeout)
+        return net_ctrl
+
+    def poll_ctrl_queue(self):
+        """
+        Completes the commands the device has processed
+
+        Returns:
+            list of the completed commands
+        Raises:
+            IxyTimeoutException if a pending command is past its deadline, it is
+            no longer pending and its buffer is freed once the device returns it
+        """
+        vq = self.ctrl_queues[0]
+        completed = []
+        used = vq.get_used()
+        while used is not None:
+            pkt_buf = used[0]
+            pending = self.pending_commands.pop(id(pkt_buf), None)
+            if pending is None:
+                if id(pkt_buf) in self.expired_commands:
+                    self.expired_commands.remove(id(pkt_buf))
+                else:
+                    log.error('Used buffer does not belong to a pending command')
+            else:
+                net_ctrl = pending[0]
+                net_ctrl.read_ack(pkt_buf.data_buffer)
+                completed.append(net_ctrl)
+            vq.mempool.free_buffer(pkt_buf)
+            used = vq.get_used()
+        now = time.perf_counter()
+        # Commands may have different timeouts, so a later one can expire first
+        for buffer_id, (net_ctrl, deadline, timeout) in self.pending_commands.items():
+            if now > deadline:
+                self._expire_command(buffer_id)
+                raise IxyTimeoutException('{}'.format(net_ctrl), timeout)
+        return completed
+
+    def _expire_command(self, buffer_id):
+        """
+        Gives up on a pending command, the device may still write the ack, so the
+        buffer and its descriptors are only reclaimed once it returns them
+        """
+        del self.pending_commands[buffer_id]
+        self.expired_commands.add(buffer_id)
+
+    def _kick(self, vq, old_index, new_index):
+        """
+        Notifies the device about the available entries in [old_index, new_index)
+        unless it asked not to be notified (it is polling the ring)
+        """
+        if vq.needs_notification(old_index, new_index):
+            self._notify_queue(vq)
+            self.kicks += 1
+        else:
+            self.suppressed_kicks += 1
+
+    @staticmethod
+    def _notify_queue(vq):
+        vq.doorbell.set(vq.identifier)
+
+    def _max_queue_pairs(self):
+        if not self._has_feature(types.VIRTIO_NET_F_MQ):
+            return 1
+        return self.transport.read_device_config(types.VIRTIO_NET_CONFIG_MAX_VIRTQUEUE_PAIRS, 2)
+
+    def _setup_queue_pairs(self):
+        """
+        Section 5.1.2
+        Queue pair i uses the virtqueues 2i (RX) and 2i+1 (TX)
+        """
+        max_queue_pairs = self._max_queue_pairs()
+        log.debug('Max queue pairs: %d', max_queue_pairs)
+        self._validate_queue_size(self.num_rx_queues, max_queue_pairs)
+        for pair in range(self.num_rx_queues):
+            self.rx_queues.append(self._setup_queue(index=2*pair))
+            self.tx_queues.append(self._setup_queue(index=2*pair + 1, is_mempool_required=False, is_tx_queue=True))
 
     def _setup_ctrl_queue(self):
-        self.ctrl_queues.append(self._setup_queue(index=2))
+        """The control queue follows the last possible queue pair"""
+        self.ctrl_queues.append(self._setup_queue(index=2*self._max_queue_pairs(), is_ctrl_queue=True))
 
-    def _setup_queue(self, index, is_mempool_required=True):
+    def _setup_queue(self, index, is_mempool_required=True, is_ctrl_queue=False, is_tx_queue=False):
         """Section 5.1.2"""
         log.debug('Setting up queue %d', index)
-        self._create_virt_queue(index)
-        max_queue_size = self._max_queue_size()
-        virt_queue_mem_size = VRing.byte_size(max_queue_size, 4096)
+        self.transport.select_queue(index)
+        max_queue_size = self.transport.max_queue_size()
+        ring_class = PackedRing if self.packed_rings else VRing
+        virt_queue_mem_size = ring_class.byte_size(max_queue_size)
         log.debug('max queue size: %d', max_queue_size)
         log.debug('queue size in bytes: %d', virt_queue_mem_size)
-        dma = DmaMemory(virt_queue_mem_size)
+        dma = self._allocate_dma(virt_queue_mem_size)
         log.debug('Allocated %s', dma)
-        self._set_physical_address(dma.physical_address)
+        self.transport.enable_queue(max_queue_size,
+                                    *[dma.physical_address + offset for offset in ring_class.area_offsets(max_queue_size)])
         # virtual queue initialization
-        mempool_size = self._mempool_size(index, max_queue_size) if is_mempool_required else 0
-        notify_offset = self._notify_offset()
-        vqueue = self._build_queue(dma, max_queue_size, index, notify_offset, mempool_size) 
+        mempool_size = self._mempool_size(is_ctrl_queue, max_queue_size) if is_mempool_required else 0
+        notify_offset = self.transport.notify_offset()
+        event_idx = self._has_feature(types.VIRTIO_RING_F_EVENT_IDX)
+        queue_class = PackedVQueue if self.packed_rings else VQueue
+        vqueue = self._build_queue(queue_class, dma, max_queue_size, index, notify_offset, mempool_size, event_idx)
+        # Indirect tables are only built in the split ring layout
+        if is_tx_queue and not self.packed_rings and self._has_feature(types.VIRTIO_RING_F_INDIRECT_DESC):
+            vqueue.indirect = self._build_indirect_tables(max_queue_size)
+        vqueue.doorbell = self.transport.doorbell(index)
         log.debug('notify offset: %d', notify_offset)
         vqueue.disable_interrupts()
         return vqueue
 
     @staticmethod
-    def _build_queue(dma, size, index, notify_offset, mempool_size):
+    def _allocate_dma(size):
+        """Memory for the rings and tables the device accesses"""
+        return DmaMemory(size)
+
+    def _build_queue(self, queue_class, dma, size, index, notify_offset, mempool_size, event_idx=False):
         mem = memoryview(dma)
         if mempool_size > 0:
-            mempool = Mempool.allocate(mempool_size)
-            return VQueue(mem, size, index, notify_offset, mempool)
+            mempool = self.allocate_mempool(mempool_size)
+            return queue_class(mem, size, index, notify_offset, mempool, event_idx)
         else:
-            return VQueue(mem, size, index, notify_offset)
-
-    @staticmethod
-    def _mempool_size(index, max_queue_size):
-        return max_queue_size if index == 2 else max_queue_size * 4
+            return queue_class(mem, size, index, notify_offset, event_idx=event_idx)
 
-    def _create_virt_queue(self, idx):
-        self.reg.set16(types.VIRTIO_PCI_QUEUE_SEL, idx)
+    def _build_indirect_tables(self, queue_size):
+        size = IndirectTables.byte_size(queue_size, self.MAX_TX_SEGMENTS, len(self.net_hdr))
+        dma = self._allocate_dma(size)
+        log.debug('Allocated indirect tables %s', dma)
+        return IndirectTables(dma, queue_size, self.MAX_TX_SEGMENTS, self.net_hdr)
 
-    def _set_physical_address(self, phy_address):
-        address = phy_address >> types.VIRTIO_PCI_QUEUE_ADDR_SHIFT
-        log.debug('Setting VQueue address to: 0x%02X', address)
-        self.reg.set32(types.VIRTIO_PCI_QUEUE_PFN, address)
+    @staticmethod
+    def _mempool_size(is_ctrl_queue, max_queue_size):
+        return max_queue_size if is_ctrl_queue else max_queue_size * 4
 
-    def _max_queue_size(self):
-        return self.reg.get32(types.VIRTIO_PCI_QUEUE_NUM)
+    def _set_features(self, features):
+        self.features = features
+        self.transport.set_features(features)
 
-    def _set_features(self):
-        self.reg.set32(types.VIRTIO_PCI_GUEST_FEATURES, self._required_features())
+    def _has_feature(self, feature):
+        return bool(self.features & (1 << feature))
 
     def _drive_device(self):
         log.debug('Setting the driver status')
-        self.reg.set(types.VIRTIO_PCI_STATUS,
-                     types.VIRTIO_CONFIG_STATUS_DRIVER)
+        self.transport.add_status(types.VIRTIO_CONFIG_STATUS_DRIVER)
 
     def _ack_device(self):
         log.debug('Acknowledge device')
-        self.reg.set(types.VIRTIO_PCI_STATUS, types.VIRTIO_CONFIG_STATUS_ACK)
+        self.transport.add_status(types.VIRTIO_CONFIG_STATUS_ACK)
 
     def _reset_devices(self):
         log.debug('Resetting device')
-        self.reg.set(types.VIRTIO_PCI_STATUS, types.VIRTIO_CONFIG_STATUS_RESET)
-        self.reg.wait_set(types.VIRTIO_PCI_STATUS,
-                          types.VIRTIO_CONFIG_STATUS_RESET)
+        self.transport.reset()
 
     def _setup_features(self):
         host_features = self._host_features()
-        required_features = self._required_features()
+        required_features = self._required_features() | self.transport.required_features
         log.debug('Host features: 0x%02X', host_features)
         log.debug('Required features: 0x%02X', required_features)
-        if not host_features & types.VIRTIO_F_VERSION_1:
-            raise VirtioException('In legacy mode but, not a legacy device')
         if (host_features & required_features) != required_features:
             raise VirtioException("Device doesn't support required features")
-        log.debug('Guest features before negotiation: 0x%02X', self.reg.get32(types.VIRTIO_PCI_GUEST_FEATURES))
-        self._set_features()
-        log.debug('Guest features after negotiation: 0x%02X', self.reg.get32(types.VIRTIO_PCI_GUEST_FEATURES))
+        log.debug('Guest features before negotiation: 0x%02X', self.transport.guest_features())
+        optional_features = self._optional_features()
+        if self.num_rx_queues > 1:
+            multi_queue = 1 << types.VIRTIO_NET_F_MQ
+            if not host_features & multi_queue:
+                raise VirtioException("Device doesn't support multiple queues")
+            optional_features |= multi_queue
+        self._set_features(required_features | (host_features & optional_features))
+        log.debug('Guest features after negotiation: 0x%02X', self.transport.guest_features())
 
     def _host_features(self):
-        return self.reg.get32(types.VIRTIO_PCI_HOST_FEATURES)
+        return self.transport.host_features()
 
     @staticmethod
     def _required_features():
         features = [types.VIRTIO_NET_F_CSUM,
                     types.VIRTIO_NET_F_GUEST_CSUM,
                     types.VIRTIO_NET_F_CTRL_VQ,
-                    types.VIRTIO_F_ANY_LAYOUT,
                     types.VIRTIO_NET_F_CTRL_RX]
         return reduce(lambda x, y: x | y, map(lambda x: 1 << x, features), 0)
+
+    @staticmethod
+    def _optional_features():
+        """Negotiated only if offered by the host"""
+        features = [types.VIRTIO_RING_F_EVENT_IDX,
+                    types.VIRTIO_RING_F_INDIRECT_DESC,
+                    types.VIRTIO_NET_F_MRG_RXBUF,
+                    types.VIRTIO_F_RING_PACKED,
+                    types.VIRTIO_NET_F_CTRL_VLAN,
+                    types.VIRTIO_NET_F_HOST_TSO4,
+                    types.VIRTIO_NET_F_HOST_TSO6,
+                    types.VIRTIO_NET_F_HOST_UFO]
+        return reduce(lambda x, y: x | y, map(lambda x: 1 << x, features), 0)
+
+
+# The device predates the modern transport
+VirtioLegacyDevice = VirtioDevice
@@ -0,0 +1,269 @@
+"""
+Packed virtqueues (Section 2.8)
+
+Descriptors are made available and marked as used in place, in a single
+ring, instead of going through separate available and used rings. The
+ownership of a descriptor is encoded in its AVAIL/USED flag bits relative
+to a wrap counter that flips every time the ring index wraps around.
+"""
+import numpy as np
+
+from memory import memory_barrier
+from ixypy.ixy import IxyQueue
+from ixypy.virtio import types
+from ixypy.virtio.structures import need_event, MAX_QUEUE_SIZE
+from ixypy.virtio.exception import VirtioException, BufferSizeException
+
+AVAIL = 1 << types.VRING_PACKED_DESC_F_AVAIL
+USED = 1 << types.VRING_PACKED_DESC_F_USED
+
+# struct pvirtq_desc
+descriptor_dtype = np.dtype([('address', '<u8'), ('length', '<u4'), ('id', '<u2'), ('flags', '<u2')])
+# struct pvirtq_event_suppress
+event_dtype = np.dtype([('off_wrap', '<u2'), ('flags', '<u2')])
+
+
+class PackedRing(object):
+    """Descriptor ring followed by the driver and the device event suppression structures"""
+    def __init__(self, buffer, size):
+        if size > MAX_QUEUE_SIZE:
+            raise VirtioException("Size[{}] exceeded maximum size[{}]".format(size, MAX_QUEUE_SIZE))
+        if len(buffer) < self.byte_size(size):
+            raise BufferSizeException("Required: {}, Received: {}".format(self.byte_size(size), len(buffer)))
+        self.size = size
+        self.buffer = buffer
+        self.descriptors = np.frombuffer(buffer, dtype=descriptor_dtype, count=size)
+        self.descriptors.fill(0)
+        # Field views, indexing them is much cheaper than indexing the records
+        self.addresses = self.descriptors['address']
+        self.lengths = self.descriptors['length']
+        self.ids = self.descriptors['id']
+        self.flags = self.descriptors['flags']
+        events = np.frombuffer(buffer, dtype=event_dtype, count=2, offset=self.descriptor_table_size(size))
+        events.fill(0)
+        self.driver_event = events[0:1]
+        self.device_event = events[1:2]
+
+    @staticmethod
+    def descriptor_table_size(queue_size):
+        return descriptor_dtype.itemsize * queue_size
+
+    @staticmethod
+    def area_offsets(queue_size):
+        """Offsets of the descriptor ring, the driver and the device area"""
+        driver_area = PackedRing.descriptor_table_size(queue_size)
+        return 0, driver_area, driver_area + event_dtype.itemsize
+
+    @staticmethod
+    def byte_size(queue_size):
+        return PackedRing.descriptor_table_size(queue_size) + 2 * event_dtype.itemsize
+
+
+class PackedVQueue(IxyQueue):
+    """
+    Driver side of a packed virtqueue
+
+    Buffers are identified by their buffer id, which the device returns in the
+    used descriptor. Every buffer occupies as many ring slots as it has segments.
+    """
+    packed = True
+
+    def __init__(self, memory, size, identifier, notification_offset, mempool=None, event_idx=False):
+        super().__init__(memory, size, identifier, mempool)
+        self.ring = PackedRing(memory, size)
+        self.notification_offset = notification_offset
+        self.event_idx = event_idx
+        # Indirect tables use the split descriptor layout, they are not supported here
+        self.indirect = None
+        self.doorbell = None
+        self.next_avail = 0
+        self.avail_wrap = 1
+        self.next_used = 0
+        self.used_wrap = 1
+        # Free ring slots
+        self.num_free = size
+        self.free_ids = list(range(size - 1, -1, -1))
+        self.chain_lengths = [0]*size
+
+    def disable_interrupts(self):
+        self.ring.driver_event['flags'] = types.VRING_PACKED_EVENT_FLAG_DISABLE
+
+    def hold_off_interrupts(self):
+        """Interrupts stay disabled through the driver event flags"""
+        pass
+
+    def needs_notification(self, old_index, new_index):
+        """
+        Section 2.8.10
+        Args:
+            old_index: ring position of the first added descriptor, negative if the ring wrapped since
+            new_index: ring position after the last added descriptor
+        """
+        flags = int(self.ring.device_event['flags'][0])
+        if flags != types.VRING_PACKED_EVENT_FLAG_DESC:
+            return flags != types.VRING_PACKED_EVENT_FLAG_DISABLE
+        off_wrap = int(self.ring.device_event['off_wrap'][0])
+        event_index = off_wrap & ~(1 << types.VRING_PACKED_EVENT_F_WRAP_CTR)
+        if off_wrap >> types.VRING_PACKED_EVENT_F_WRAP_CTR != self.avail_wrap:
+            event_index -= self.size
+        return need_event(event_index, new_index, old_index)
+
+    def _positions(self, start, count):
+        """Ring positions from start on and whether they wrapped around the end of the ring"""
+        positions = np.arange(start, start + count)
+        wrapped = positions >= self.size
+        positions[wrapped] -= self.size
+        return positions, wrapped
+
+    def add_buffers(self, buffers, addresses, lengths, flags=0):
+        """
+        Makes single segment buffers available
+
+        The descriptors are written first, then the flags of all but the head,
+        the head's flags go last so the device sees the whole batch at once
+
+        Returns:
+            (old_index, new_index) for needs_notification
+        """
+        count = len(buffers)
+        if count > self.num_free:
+            raise VirtioException('Queue overflow')
+        if count == 0:
+            return self.next_avail, self.next_avail
+        free_ids = self.free_ids
+        ids = [free_ids.pop() for _ in range(count)]
+        for buffer_id, buffer in zip(ids, buffers):
+            self.buffers[buffer_id] = buffer
+            self.chain_lengths[buffer_id] = 1
+        ring = self.ring
+        positions, wrapped = self._positions(self.next_avail, count)
+        ring.addresses[positions] = addresses
+        ring.lengths[positions] = lengths
+        ring.ids[positions] = ids
+        current = (AVAIL if self.avail_wrap else USED) | flags
+        descriptor_flags = np.where(wrapped, current ^ (AVAIL | USED), current)
+        memory_barrier()
+        ring.flags[positions[1:]] = descriptor_flags[1:]
+        memory_barrier()
+        ring.flags[positions[0]] = descriptor_flags[0]
+        # The head has to be visible before needs_notification reads the device event
+        memory_barrier()
+        return self._advance_avail(count)
+
+    def add_chain(self, buffer, segments):
+        """
+        Makes a buffer of several (address, length, flags) segments available
+
+        Returns:
+            (old_index, new_index) for needs_notification
+        """
+        count = len(segments)
+        if count > self.num_free:
+            raise VirtioException('Queue overflow')
+        buffer_id = self.free_ids.pop()
+        self.buffers[buffer_id] = buffer
+        self.chain_lengths[buffer_id] = count
+        ring = self.ring
+        positions, wrapped = self._positions(self.next_avail, count)
+        current = AVAIL if self.avail_wrap else USED
+        head_flags = 0
+        for i, (address, length, flags) in enumerate(segments):
+            position = positions[i]
+            ring.addresses[position] = address
+            ring.lengths[position] = length
+            ring.ids[position] = buffer_id
+            if i < count - 1:
+                flags |= types.VRING_DESC_F_NEXT
+            flags |= current ^ (AVAIL | USED) if wrapped[i] else current
+            if i == 0:
+                head_flags = flags
+            else:
+                ring.flags[position] = flags
+        memory_barrier()
+        ring.flags[positions[0]] = head_flags
+        # The head has to be visible before needs_notification reads the device event
+        memory_barrier()
+        return self._advance_avail(count)
+
+    def _advance_avail(self, count):
+        old_index = self.next_avail
+        self.next_avail += count
+        self.num_free -= count
+        if self.next_avail >= self.size:
+            self.next_avail -= self.size
+            self.avail_wrap ^= 1
+            old_index -= self.size
+        return old_index, self.next_avail
+
+    def num_used(self, limit):
+        """
+        Number of used buffers ready to be taken, at most limit
+
+        Only valid for queues of single segment buffers (i.e. RX queues)
+        """
+        count = min(limit, self.size - self.num_free)
+        if count == 0:
+            return 0
+        positions, wrapped = self._positions(self.next_used, count)
+        flags = self.ring.flags[positions]
+        wrap = np.where(wrapped, self.used_wrap ^ 1, self.used_wrap)
+        used = (((flags >> types.VRING_PACKED_DESC_F_AVAIL) & 1) == wrap) &\
+               (((flags >> types.VRING_PACKED_DESC_F_USED) & 1) == wrap)
+        if used.all():
+            return count
+        return int(used.argmin())
+
+    def has_used(self):
+        if self.num_free == self.size:
+            return False
+        flags = int(self.ring.flags[self.next_used])
+        return bool(flags & AVAIL) == bool(flags & USED) == bool(self.used_wrap)
+
+    def used_entries(self, count):
+        """
+        Reads the next count used descriptors without taking them,
+        count has to come from num_used
+
+        Returns:
+            (ids, lengths) lists
+        """
+        # The used flags have to be read before the descriptors
+        memory_barrier()
+        positions, _ = self._positions(self.next_used, count)
+        return self.ring.ids[positions].tolist(), self.ring.lengths[positions].tolist()
+
+    def release_used(self, ids):
+        """Takes the single segment buffers read with used_entries, their slots become free"""
+        count = len(ids)
+        self.next_used += count
+        if self.next_used >= self.size:
+            self.next_used -= self.size
+            self.used_wrap ^= 1
+        self.num_free += count
+        self.free_ids.extend(ids)
+
+    def get_used(self):
+        """
+        Takes the next used buffer off the ring
+
+        Returns:
+            (buffer, written length) or None if the device has not used any
+        """
+        if not self.has_used():
+            return None
+        # The used flags have to be read before the descriptor
+        memory_barrier()
+        position = self.next_used
+        ring = self.ring
+        buffer_id = int(ring.ids[position])
+        length = int(ring.lengths[position])
+        chain_length = self.chain_lengths[buffer_id]
+        self.next_used += chain_length
+        if self.next_used >= self.size:
+            self.next_used -= self.size
+            self.used_wrap ^= 1
+        self.num_free += chain_length
+        buffer = self.buffers[buffer_id]
+        self.buffers[buffer_id] = None
+        self.free_ids.append(buffer_id)
+        return buffer, length
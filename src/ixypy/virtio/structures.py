@@ -1,40 +1,268 @@
 from struct import Struct, calcsize, pack, pack_into, unpack_from
 from collections import OrderedDict
-from ixypy.virtio.types import VRING_AVAIL_F_NO_INTERRUPT, VIRTIO_NET_CTRL_RX, VIRTIO_NET_CTRL_RX_PROMISC
+
+import numpy as np
+
+from memory import memory_barrier
+from ixypy.virtio.types import VRING_AVAIL_F_NO_INTERRUPT, VRING_USED_F_NO_NOTIFY, VRING_DESC_F_NEXT, VIRTIO_NET_CTRL_RX,\
+                               VIRTIO_NET_CTRL_RX_PROMISC, VIRTIO_NET_CTRL_MQ, VIRTIO_NET_CTRL_MQ_VQ_PAIRS_SET,\
+                               VIRTIO_NET_HDR_F_NEEDS_CSUM, VIRTIO_NET_CTRL_RX_ALLMULTI, VIRTIO_NET_CTRL_MAC,\
+                               VIRTIO_NET_CTRL_MAC_TABLE_SET, VIRTIO_NET_CTRL_VLAN, VIRTIO_NET_CTRL_VLAN_ADD,\
+                               VIRTIO_NET_CTRL_VLAN_DEL, VIRTIO_NET_OK
 from ixypy.virtio.exception import VirtioException, BufferSizeException
 
-from ixypy.ixy import IxyStruct, IxyQueue
+from ixypy.ixy import IxyQueue
 
 
 MAX_QUEUE_SIZE = 32768
 
+# struct virtq_desc
+descriptor_dtype = np.dtype([('address', '<u8'), ('length', '<u4'), ('flags', '<u2'), ('next_descriptor', '<u2')])
+# struct virtq_used_elem
+used_element_dtype = np.dtype([('id', '<u4'), ('length', '<u4')])
+
 
 def align(offset, alignment=4096):
     return (offset + (alignment-1)) & -alignment
 
 
+def need_event(event_index, new_index, old_index):
+    """
+    Section 2.4.7.2
+    True if event_index lies in [old_index, new_index), all 16 bit indices
+    """
+    return ((new_index - event_index - 1) & 0xFFFF) < ((new_index - old_index) & 0xFFFF)
+
+
 class VQueue(IxyQueue):
-    def __init__(self, memory, size, identifier, notification_offset, mempool=None):
+    packed = False
+
+    def __init__(self, memory, size, identifier, notification_offset, mempool=None, event_idx=False):
         super().__init__(memory, size, identifier, mempool)
         self.vring = VRing(memory, size) 
         self.notification_offset = notification_offset
         self.used_last_index = 0
+        # VIRTIO_RING_F_EVENT_IDX negotiated
+        self.event_idx = event_idx
+        # IndirectTables, if VIRTIO_RING_F_INDIRECT_DESC is used
+        self.indirect = None
+        # Register the queue index is written to on notifications
+        self.doorbell = None
+        # Stack of free descriptor indices, popped in ascending order at first
+        self.free_indices = list(range(size - 1, -1, -1))
 
     def disable_interrupts(self):
         self.vring.available.flags = VRING_AVAIL_F_NO_INTERRUPT
         self.vring.used.flags = 0
+        self.hold_off_interrupts()
 
-    def get_free_descriptor(self, index=0):
-        for i in range(index, len(self.vring.descriptors)):
-            desc = self.vring.descriptors[i]
-            if desc.address == 0:
-                return i, desc
-        raise VirtioException('Queue overflow')
+    def hold_off_interrupts(self):
+        """
+        With event indices the available flags are ignored by the device, instead
+        the used event is kept half the index space ahead of what we have consumed
+        """
+        if self.event_idx:
+            self.vring.available.used_event = self.used_last_index + 0x7FFF
 
-    def free_descriptors(self):
-        for index, desc in enumerate(self.vring.descriptors):
-            if desc.address == 0:
-                yield index, desc
+    def needs_notification(self, old_index, new_index):
+        """
+        Args:
+            old_index: available index at the last notification
+            new_index: available index just published
+        """
+        if self.event_idx:
+            return need_event(self.vring.used.avail_event, new_index, old_index)
+        return not self.vring.used.flags & VRING_USED_F_NO_NOTIFY
+
+    @property
+    def num_free(self):
+        return len(self.free_indices)
+
+    def free_descriptor(self, index):
+        self.vring.descriptors[index] = (0, 0, 0, 0)
+        self.free_indices.append(index)
+
+    def add_buffers(self, buffers, addresses, lengths, flags=0):
+        """
+        Makes single descriptor buffers available
+
+        Returns:
+            (old_index, new_index) of the available ring for needs_notification
+        """
+        return self.publish(self.take_free(len(buffers)), buffers, addresses, lengths, flags)
+
+    def take_free(self, count):
+        """Takes count descriptor indices off the free list"""
+        free_indices = self.free_indices
+        if count > len(free_indices):
+            raise VirtioException('Queue overflow')
+        if count == 0:
+            return []
+        # Same order as popping them one by one
+        indices = free_indices[:-count - 1:-1]
+        del free_indices[-count:]
+        return indices
+
+    def return_free(self, indices):
+        """Puts indices taken by take_free but never published back onto the free list"""
+        self.free_indices += reversed(indices)
+
+    def publish(self, indices, buffers, addresses, lengths, flags=0):
+        """
+        Fills the descriptors at indices and appends them to the available ring,
+        the entries are visible to the device before the index is
+        """
+        vring = self.vring
+        available = vring.available
+        old_index = available.index
+        count = len(indices)
+        if count == 0:
+            return old_index, old_index
+        vring.addresses[indices] = addresses
+        vring.lengths[indices] = lengths
+        vring.flags[indices] = flags
+        vring.next_descriptors[indices] = 0
+        queue_buffers = self.buffers
+        for index, buffer in zip(indices, buffers):
+            queue_buffers[index] = buffer
+        available.rings.put(np.arange(old_index, old_index + count), indices, mode='wrap')
+        memory_barrier()
+        available.index = old_index + count
+        memory_barrier()
+        return old_index, old_index + count
+
+    def num_used(self, limit):
+        """Number of used elements ready to be taken, at most limit"""
+        return min(limit, (self.vring.used.index - self.used_last_index) & 0xFFFF)
+
+    def used_entries(self, count):
+        """
+        Reads the next count used elements without taking them
+
+        Returns:
+            (ids, lengths) lists
+        """
+        # The used index has to be read before the elements
+        memory_barrier()
+        positions = np.arange(self.used_last_index, self.used_last_index + count)
+        used = self.vring
+        return (used.used_ids.take(positions, mode='wrap').tolist(),
+                used.used_lengths.take(positions, mode='wrap').tolist())
+
+    def release_used(self, ids):
+        """Takes the used elements read with used_entries, their descriptors become free"""
+        self.used_last_index = (self.used_last_index + len(ids)) & 0xFFFF
+        self.free_indices.extend(ids)
+
+    def add_chain(self, buffer, segments):
+        """
+        Makes a buffer of several (address, length, flags) segments available
+        as one descriptor chain
+
+        Returns:
+            (old_index, new_index) of the available ring for needs_notification
+        """
+        indices = self.take_free(len(segments))
+        descriptors = self.vring.descriptors
+        last = len(indices) - 1
+        for i, (address, length, flags) in enumerate(segments):
+            next_descriptor = 0
+            if i < last:
+                flags |= VRING_DESC_F_NEXT
+                next_descriptor = indices[i + 1]
+            descriptors[indices[i]] = (address, length, flags, next_descriptor)
+        self.buffers[indices[0]] = buffer
+        available = self.vring.available
+        old_index = available.index
+        available.rings[old_index % self.size] = indices[0]
+        memory_barrier()
+        available.index = old_index + 1
+        memory_barrier()
+        return old_index, old_index + 1
+
+    def has_used(self):
+        return self.used_last_index != self.vring.used.index
+
+    def get_used(self):
+        """
+        Takes the next used chain off the queue, its descriptors become free
+
+        Returns:
+            (buffer, written length) or None if the device has not used any
+        """
+        if not self.has_used():
+            return None
+        # The used index has to be read before the element
+        memory_barrier()
+        element = self.vring.used.rings[self.used_last_index % self.size]
+        head, length = int(element.id), int(element.length)
+        self.used_last_index = (self.used_last_index + 1) & 0xFFFF
+        vring = self.vring
+        index = head
+        while vring.flags[index] & VRING_DESC_F_NEXT:
+            next_descriptor = int(vring.next_descriptors[index])
+            self.free_descriptor(index)
+            index = next_descriptor
+        self.free_descriptor(index)
+        buffer = self.buffers[head]
+        self.buffers[head] = None
+        return buffer, length
+
+
+class IndirectTables(object):
+    """
+    Section 2.4.5.3
+    One indirect descriptor table per ring descriptor, all in a single DMA area
+    followed by the net header shared by all the packets sent through them
+
+    A table holds the header followed by up to max_segments packet buffers
+    """
+    descriptor_struct = Struct('Q I H H')
+
+    def __init__(self, dma, queue_size, max_segments, net_hdr):
+        self.mem = memoryview(dma)
+        self.physical_address = dma.physical_address
+        self.max_segments = max_segments
+        self.table_size = self.table_byte_size(max_segments)
+        header_offset = queue_size * self.table_size
+        net_hdr.to_buffer(self.mem, header_offset)
+        self.header_address = self.physical_address + header_offset
+        self.header_length = len(net_hdr)
+
+    def write(self, index, pkt_buf, header_address=None):
+        """
+        Fills the table of the ring descriptor at index with the segments of the packet
+
+        Args:
+            header_address: physical address of a header for this packet only,
+                            the shared header is used if omitted
+        Returns:
+            physical address and length of the table
+        """
+        pack_into = self.descriptor_struct.pack_into
+        mem = self.mem
+        table_offset = index * self.table_size
+        if header_address is None:
+            header_address = self.header_address
+        pack_into(mem, table_offset, header_address, self.header_length, VRING_DESC_F_NEXT, 1)
+        entries = 1
+        for segment in pkt_buf.segments():
+            if entries > self.max_segments:
+                raise VirtioException('Packet exceeds {:d} segments'.format(self.max_segments))
+            pack_into(mem, table_offset + entries * 16, segment.data_addr, segment.size, VRING_DESC_F_NEXT, entries + 1)
+            entries += 1
+        # The last segment ends the chain
+        pack_into(mem, table_offset + (entries - 1) * 16, segment.data_addr, segment.size, 0, 0)
+        return self.physical_address + table_offset, entries * 16
+
+    @staticmethod
+    def table_byte_size(max_segments):
+        # header + segments, Q I H H ==> 16
+        return (max_segments + 1) * 16
+
+    @staticmethod
+    def byte_size(queue_size, max_segments, net_hdr_length):
+        return queue_size * IndirectTables.table_byte_size(max_segments) + net_hdr_length
 
 
 class VirtioNetworkHeader(object):
@@ -59,6 +287,26 @@ class VirtioNetworkHeader(object):
                               self.csum_start,
                               self.csum_offset)
 
+    def offload_to_buffer(self, offload, buffer, offset=0):
+        """Writes a header requesting the offloads of a packet (see mempool.Offload)"""
+        if offload.csum_start is None:
+            flags, csum_start = 0, 0
+        else:
+            flags, csum_start = VIRTIO_NET_HDR_F_NEEDS_CSUM, offload.csum_start
+        self.struct.pack_into(buffer,
+                              offset,
+                              flags,
+                              offload.gso_type,
+                              offload.header_len,
+                              offload.gso_size,
+                              csum_start,
+                              offload.csum_offset,
+                              *self.extra_fields)
+
+    @property
+    def extra_fields(self):
+        return ()
+
     def __len__(self):
         return self.byte_size()
 
@@ -69,6 +317,42 @@ class VirtioNetworkHeader(object):
         # return calcsize(VirtioNetworkHeader.data_format)
 
 
+class VirtioNetworkMergeableHeader(VirtioNetworkHeader):
+    """Header used with VIRTIO_NET_F_MRG_RXBUF"""
+    data_format = 'B B H H H H H'
+
+    def __init__(self, flags=0, gso_type=0, header_len=0, gso_size=0, csum_start=0, csum_offset=0, num_buffers=0):
+        super().__init__(flags, gso_type, header_len, gso_size, csum_start, csum_offset)
+        self.num_buffers = num_buffers
+
+    def to_buffer(self, buffer, offset=0):
+        self.struct.pack_into(buffer,
+                              offset,
+                              self.flags,
+                              self.gso_type,
+                              self.header_len,
+                              self.gso_size,
+                              self.csum_start,
+                              self.csum_offset,
+                              self.num_buffers)
+
+    @property
+    def extra_fields(self):
+        # num_buffers is only set by the device
+        return (0,)
+
+    @staticmethod
+    def num_buffers_in(pkt_buf):
+        """Reads num_buffers from the header in front of the packet data"""
+        # num_buffers are the last 2 bytes of the header, right in front of the data
+        return unpack_from('H', pkt_buf.head_room_buffer, len(pkt_buf.head_room_buffer) - 2)[0]
+
+    @staticmethod
+    def byte_size():
+        # B B H H H H H ==> 12
+        return 12
+
+
 class VCommand(object):
     def __init__(self, class_, id_):
         self.class_ = class_
@@ -78,10 +362,10 @@ class VCommand(object):
         pass
 
 
-class PromiscuousModeCommand(VCommand):
-    def __init__(self, on=True):
+class RxModeCommand(VCommand):
+    def __init__(self, id_, on=True):
         self.on = on
-        super().__init__(VIRTIO_NET_CTRL_RX, VIRTIO_NET_CTRL_RX_PROMISC)
+        super().__init__(VIRTIO_NET_CTRL_RX, id_)
 
     def bytes(self):
         return pack('B', self.on)
@@ -90,6 +374,65 @@ class PromiscuousModeCommand(VCommand):
         return 1
 
 
+class PromiscuousModeCommand(RxModeCommand):
+    def __init__(self, on=True):
+        super().__init__(VIRTIO_NET_CTRL_RX_PROMISC, on)
+
+
+class AllMulticastCommand(RxModeCommand):
+    def __init__(self, on=True):
+        super().__init__(VIRTIO_NET_CTRL_RX_ALLMULTI, on)
+
+
+def mac_bytes(mac):
+    """6 byte address from bytes or a colon separated string"""
+    if isinstance(mac, str):
+        mac = bytes.fromhex(mac.replace(':', ''))
+    if len(mac) != 6:
+        raise VirtioException('Invalid MAC address {!r}'.format(mac))
+    return bytes(mac)
+
+
+class MacTableCommand(VCommand):
+    def __init__(self, unicast=(), multicast=()):
+        self.unicast = [mac_bytes(mac) for mac in unicast]
+        self.multicast = [mac_bytes(mac) for mac in multicast]
+        super().__init__(VIRTIO_NET_CTRL_MAC, VIRTIO_NET_CTRL_MAC_TABLE_SET)
+
+    def bytes(self):
+        return pack('<I', len(self.unicast)) + b''.join(self.unicast) +\
+               pack('<I', len(self.multicast)) + b''.join(self.multicast)
+
+    def __len__(self):
+        return 8 + 6 * (len(self.unicast) + len(self.multicast))
+
+
+class VlanFilterCommand(VCommand):
+    def __init__(self, vlan_id, add=True):
+        if not 0 <= vlan_id < 4096:
+            raise VirtioException('Invalid VLAN id {:d}'.format(vlan_id))
+        self.vlan_id = vlan_id
+        super().__init__(VIRTIO_NET_CTRL_VLAN, VIRTIO_NET_CTRL_VLAN_ADD if add else VIRTIO_NET_CTRL_VLAN_DEL)
+
+    def bytes(self):
+        return pack('<H', self.vlan_id)
+
+    def __len__(self):
+        return 2
+
+
+class MultiQueueCommand(VCommand):
+    def __init__(self, queue_pairs):
+        self.queue_pairs = queue_pairs
+        super().__init__(VIRTIO_NET_CTRL_MQ, VIRTIO_NET_CTRL_MQ_VQ_PAIRS_SET)
+
+    def bytes(self):
+        return pack('H', self.queue_pairs)
+
+    def __len__(self):
+        return 2
+
+
 class VirtioNetworkControl(object):
     """
     u8 class
@@ -102,11 +445,22 @@ class VirtioNetworkControl(object):
     def __init__(self, command, ack=0):
         self.command = command
         self.ack = ack
+        self.completed = False
 
     def to_buffer(self, buffer, offset=0):
         fmt = self.data_format.format(len(self.command))
         pack_into(fmt, buffer, offset, self.command.class_, self.command.id, *self.command.bytes(), self.ack)
 
+    def read_ack(self, buffer, offset=0):
+        """Reads back the ack the device wrote, the command is completed afterwards"""
+        self.ack = buffer[offset + len(self) - 1]
+        self.completed = True
+        return self.ack
+
+    @property
+    def ok(self):
+        return self.completed and self.ack == VIRTIO_NET_OK
+
     @staticmethod
     def from_bytes(byte_sequence):
         pass
@@ -122,6 +476,10 @@ class VirtioNetworkControl(object):
     def __len__(self):
         return calcsize(self.data_format.format(len(self.command)))
 
+    def __repr__(self):
+        return '<VirtioNetworkControl(class={:d}, command={:d}, ack={:d})>'.format(
+            self.command_class, self.command_id, self.ack)
+
 
 class VRing(object):
     dump_count = 0
@@ -136,13 +494,19 @@ class VRing(object):
         self.descriptors = self._descriptors()
         self.available = self._available()
         self.used = self._used()
+        # Field views of the descriptor table and the used ring for bulk access
+        self.addresses = self.descriptors['address']
+        self.lengths = self.descriptors['length']
+        self.flags = self.descriptors['flags']
+        self.next_descriptors = self.descriptors['next_descriptor']
+        self.used_ids = self.used.rings['id']
+        self.used_lengths = self.used.rings['length']
 
     def _descriptors(self):
-        item_size = VRingDescriptor.byte_size()
         descriptor_tbl_size = VRing.descriptor_table_size(self.size)
-        sub_buff = self.buffer[:descriptor_tbl_size]
-        descriptor_buffers = [sub_buff[i*item_size:item_size*(i+1)] for i in range(self.size)]
-        return [VRingDescriptor.create_descriptor(dsc_buff) for dsc_buff in descriptor_buffers]
+        descriptors = np.frombuffer(self.buffer[:descriptor_tbl_size], dtype=descriptor_dtype).view(np.recarray)
+        descriptors.fill(0)
+        return descriptors
 
     def _available(self):
         descriptor_tbl_size = VRing.descriptor_table_size(self.size)
@@ -150,18 +514,15 @@ class VRing(object):
         sub_buff = self.buffer[descriptor_tbl_size:(descriptor_tbl_size + available_queue_size)]
         avail = Available(sub_buff, self.size)
         avail.index = 0
-        for i in range(len(avail.rings)):
-            avail.rings[i] = 0
-        return Available(sub_buff, self.size)
+        avail.rings.fill(0)
+        return avail
 
     def _used(self):
         buffer_start = len(self) - VRing.used_queue_size(self.size)
         sub_buff = self.buffer[buffer_start:len(self)]
         used = VRingUsed(sub_buff, self.size)
         used.index = 0
-        for ring in used.rings:
-            ring.id = 0
-            ring.len = 0
+        used.rings.fill(0)
         return used
 
     def __len__(self):
@@ -178,7 +539,7 @@ class VRing(object):
 
     @staticmethod
     def descriptor_table_size(queue_size):
-        return VRingDescriptor.byte_size() * queue_size
+        return descriptor_dtype.itemsize * queue_size
 
     @staticmethod
     def available_queue_size(queue_size):
@@ -191,6 +552,17 @@ class VRing(object):
         offset = dsc_tbl_sz + avail_sz
         return -offset & (alignment - 1)
 
+    @staticmethod
+    def used_offset(queue_size, alignment=4096):
+        dsc_tbl_sz = VRing.descriptor_table_size(queue_size)
+        avail_qsz = VRing.available_queue_size(queue_size)
+        return align(dsc_tbl_sz + avail_qsz, alignment)
+
+    @staticmethod
+    def area_offsets(queue_size, alignment=4096):
+        """Offsets of the descriptor table, the available (driver area) and the used ring (device area)"""
+        return 0, VRing.descriptor_table_size(queue_size), VRing.used_offset(queue_size, alignment)
+
     @staticmethod
     def byte_size(queue_size, alignment=4096):
         # see 2.4.2
@@ -200,67 +572,6 @@ class VRing(object):
         return align(dsc_tbl_sz + avail_qsz, alignment) + used_qsz
 
 
-class VRingDescriptor(IxyStruct):
-    data_format = 'Q I H H'
-
-    def __init__(self, mem):
-        super().__init__(mem)
-
-    @staticmethod
-    def create_descriptor(mem):
-        """
-        Creates a new descriptor around a buffer
-        and sets all the fields to zero
-        """
-        descriptor = VRingDescriptor(mem)
-        descriptor.length = 0
-        descriptor.address = 0
-        descriptor.flags = 0
-        descriptor.next_descriptor = 0
-        return descriptor
-
-    @property
-    def address(self):
-        return unpack_from('Q', self.mem, 0)[0]
-
-    @address.setter
-    def address(self, address):
-        pack_into('Q', self.mem, 0, address)
-
-    @property
-    def length(self):
-        return unpack_from('I', self.mem, 8)[0]
-
-    @length.setter
-    def length(self, length):
-        # Q ==> 8
-        pack_into('I', self.mem, 8, length)
-
-    @property
-    def flags(self):
-        return unpack_from('H', self.mem, 12)[0]
-
-    @flags.setter
-    def flags(self, flags):
-        # Q I ==> 12
-        pack_into('H', self.mem, 12, flags)
-
-    @property
-    def next_descriptor(self):
-        return unpack_from('H', self.mem, 14)[0]
-
-    @next_descriptor.setter
-    def next_descriptor(self, next_descriptor):
-        # Q I H ==> 14
-        pack_into('H', self.mem, 14, next_descriptor)
-
-    def reset(self):
-        self.write(0, 0, 0, 0)
-
-    def write(self, length, addr, flags, next_descriptor):
-        self.data_struct.pack_into(self.mem, 0, length, addr, flags, next_descriptor)
-
-
 class Available(object):
     data_format = 'H H'
 
@@ -268,7 +579,9 @@ class Available(object):
         self.size = size
         self.struct = Struct(Available.data_format.format(size))
         self.buffer = buffer[:self.struct.size]
-        self.rings = RingList(buffer[self.struct.size:], size)
+        self.rings = np.frombuffer(buffer[self.struct.size:self.struct.size + 2 * size], dtype='<u2')
+        # H H + queue_sizeH
+        self.event_buffer = buffer[self.struct.size + 2 * size:]
 
     @property
     def flags(self):
@@ -284,19 +597,26 @@ class Available(object):
 
     @index.setter
     def index(self, index):
-        index = index % 0xFFFF
-        pack_into('H', self.buffer, 2, index)
+        pack_into('H', self.buffer, 2, index & 0xFFFF)
+
+    @property
+    def used_event(self):
+        return unpack_from('H', self.event_buffer, 0)[0]
+
+    @used_event.setter
+    def used_event(self, index):
+        pack_into('H', self.event_buffer, 0, index & 0xFFFF)
 
     @staticmethod
     def byte_size(queue_size):
         """
-         H H + queue_sizeH(RingList) + xx
+         H H + queue_sizeH + H
          uint16_t avail_flags;
          uint16_t avail_idx;
          uint16_t available[num];
          uint16_t used_event_idx;
         """
-        return 4 + 2 * queue_size
+        return 4 + 2 * queue_size + 2
 
     def __str__(self):
         return 'size={} buffer_size={}'.format(self.size, len(self.buffer))
@@ -309,95 +629,6 @@ class Available(object):
         pack_into(field_format, self.buffer, offset, value)
 
 
-class RingList(object):
-    def __init__(self, buffer, size):
-        self.struct = Struct('{:d}H'.format(size))
-        self.buffer = buffer
-        self.size = size
-
-    def __getitem__(self, index):
-        return unpack_from('H', self.buffer, self._get_offset(index))[0]
-
-    def __setitem__(self, index, value):
-        pack_into('H', self.buffer, self._get_offset(index), value)
-
-    def __len__(self):
-        return self.size
-
-    def __iter__(self):
-        return RingListIterator(self)
-
-    @staticmethod
-    def _get_offset(index):
-        # H ==> 2
-        return 2 * index
-
-
-class RingListIterator(object):
-    def __init__(self, ring_list):
-        self.i = 0
-        self.ring_list = ring_list
-
-    def __iter__(self):
-        return self
-
-    def __next__(self):
-        if self.i < len(self.ring_list):
-            ring = self.ring_list[self.i]
-            self.i += 1
-            return ring
-        else:
-            raise StopIteration()
-
-
-class VRingUsedElement(object):
-    data_format = 'I I'
-
-    def __init__(self, buffer):
-        self.buffer = buffer
-        self.struct = Struct(self.data_format)
-
-    @staticmethod
-    def create_used_element(buff):
-        used_element = VRingUsedElement(buff)
-        used_element.id = 0
-        used_element.length = 0
-        return used_element
-
-    @property
-    def id(self):
-        # return self._unpack()[0]
-        return unpack_from('I', self.buffer, 0)[0]
-
-    @id.setter
-    def id(self, _id):
-        pack_into('I', self.buffer, 0, _id)
-
-    @property
-    def length(self):
-        return self._unpack()[1]
-
-    @length.setter
-    def length(self, length):
-        # I ==> 4
-        pack_into('I', self.buffer, 4, length)
-
-    @staticmethod
-    def byte_size():
-        # I I ==> 8
-        return 8
-
-    def _unpack(self):
-        return self.struct.unpack(self.buffer)
-
-    def _pack_into_buffer(self, value, field_format, prefix=''):
-        offset = calcsize(prefix)
-        pack_into(field_format, self.buffer, offset, value)
-
-    def __str__(self):
-        return 'id={}, length={}'.format(self.id, self.length)
-
-
 class VRingUsed(object):
     data_format = 'H H'
 
@@ -405,10 +636,11 @@ class VRingUsed(object):
         self.buffer = buffer
         self.self_buffer = buffer[:4]
         self.size = size
-        used_elem_size = VRingUsedElement.byte_size()
+        used_elem_size = used_element_dtype.itemsize
         self.struct = Struct(VRingUsed.data_format.format(used_elem_size*size))
         elem_buff = buffer[4:]
-        self.rings = [VRingUsedElement.create_used_element(elem_buff[i*used_elem_size:used_elem_size*(i + 1)]) for i in range(size)]
+        self.rings = np.frombuffer(elem_buff[:used_elem_size*size], dtype=used_element_dtype).view(np.recarray)
+        self.event_buffer = elem_buff[used_elem_size*size:]
 
     @property
     def flags(self):
@@ -427,6 +659,14 @@ class VRingUsed(object):
         # H ==> 2
         pack_into('H', self.buffer, 2, index)
 
+    @property
+    def avail_event(self):
+        return unpack_from('H', self.event_buffer, 0)[0]
+
+    @avail_event.setter
+    def avail_event(self, index):
+        pack_into('H', self.event_buffer, 0, index & 0xFFFF)
+
     def _pack_into_buffer(self, value, field_format, prefix=''):
         offset = calcsize(prefix)
         pack_into(field_format, self.buffer, offset, value)
@@ -439,5 +679,5 @@ class VRingUsed(object):
 
     @staticmethod
     def byte_size(queue_size):
-        # H H (used elements interpreted as padding bytes)
-        return 4 + VRingUsedElement.byte_size() * queue_size
+        # H H (used elements interpreted as padding bytes) H
+        return 4 + used_element_dtype.itemsize * queue_size + 2
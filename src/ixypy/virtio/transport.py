@@ -0,0 +1,247 @@
+"""
+Virtio over PCI transports (Section 4.1)
+
+The legacy transport accesses the registers in BAR0 through port I/O,
+the modern one finds its configuration structures through vendor
+specific PCI capabilities and accesses them through memory mapped BARs,
+so queue notifications are single stores.
+"""
+import logging as log
+from struct import Struct
+
+from ixypy.pci import PCICapability
+from ixypy.register import FileRegister, MmapRegister
+from ixypy.trace import traced, RegisterNames
+from ixypy.wait import wait_until
+from ixypy.virtio import types
+from ixypy.virtio.structures import align
+from ixypy.virtio.exception import VirtioException
+
+
+def transport_for(pci_device):
+    """
+    Modern transport if the device exposes the virtio capabilities,
+    legacy transport otherwise (transitional devices support both)
+    """
+    capabilities = VirtioCapability.read_all(pci_device)
+    if types.VIRTIO_PCI_CAP_COMMON_CFG in capabilities:
+        log.debug('Using the modern virtio transport')
+        return ModernTransport(pci_device, capabilities)
+    device_id = pci_device.config().device_id
+    if device_id != types.VIRTIO_PCI_LEGACY_DEVICE_ID:
+        raise VirtioException('Device with id 0x{:02X} not supported'.format(device_id))
+    log.debug('Using the legacy virtio transport')
+    return LegacyTransport(pci_device)
+
+
+class VirtioCapability(object):
+    """Section 4.1.4, struct virtio_pci_cap"""
+    data_format = Struct('< B B B B B B 2x I I')
+    notify_multiplier_format = Struct('< I')
+
+    def __init__(self, cfg_type, bar, offset, length, notify_off_multiplier=0):
+        self.cfg_type = cfg_type
+        self.bar = bar
+        self.offset = offset
+        self.length = length
+        self.notify_off_multiplier = notify_off_multiplier
+
+    @classmethod
+    def read(cls, pci_device, cap_offset):
+        _, _, _, cfg_type, bar, _, offset, length = cls.data_format.unpack(
+            pci_device.read_config(cap_offset, cls.data_format.size))
+        notify_off_multiplier = 0
+        if cfg_type == types.VIRTIO_PCI_CAP_NOTIFY_CFG:
+            notify_off_multiplier = cls.notify_multiplier_format.unpack(
+                pci_device.read_config(cap_offset + cls.data_format.size, cls.notify_multiplier_format.size))[0]
+        return cls(cfg_type, bar, offset, length, notify_off_multiplier)
+
+    @classmethod
+    def read_all(cls, pci_device):
+        """
+        Returns:
+            dict of cfg_type to the first VirtioCapability of that type
+        """
+        capabilities = {}
+        for capability in pci_device.capabilities():
+            if capability.id != PCICapability.vendor_specific:
+                continue
+            virtio_capability = cls.read(pci_device, capability.offset)
+            # The driver should use the first capability of each type it can use
+            capabilities.setdefault(virtio_capability.cfg_type, virtio_capability)
+        return capabilities
+
+    def __repr__(self):
+        return '<VirtioCapability(cfg_type={:d}, bar={:d}, offset=0x{:X}, length=0x{:X})>'.format(
+            self.cfg_type, self.bar, self.offset, self.length)
+
+
+class VirtioTransport(object):
+    """Access to the device status, features, virtqueue configuration and notifications"""
+    RESET_TIMEOUT = 1
+    # Feature bits the transport itself depends on
+    required_features = 0
+
+    def reset(self):
+        """Writing 0 resets the device, the reset is complete once 0 is read back"""
+        self.set_status(types.VIRTIO_CONFIG_STATUS_RESET)
+        wait_until(lambda: self.get_status() == types.VIRTIO_CONFIG_STATUS_RESET, self.RESET_TIMEOUT, 'device reset')
+
+    def add_status(self, status):
+        self.set_status(self.get_status() | status)
+
+    def get_status(self):
+        raise NotImplementedError
+
+    def set_status(self, status):
+        raise NotImplementedError
+
+
+class LegacyTransport(VirtioTransport):
+    """Section 4.1.4.8, all registers in the I/O BAR0"""
+    # Legacy devices may expect the header in a descriptor of its own otherwise,
+    # the bit does not exist for modern devices (Legacy Interface: Message Framing)
+    required_features = 1 << types.VIRTIO_F_ANY_LAYOUT
+    register_names = RegisterNames(types, 'VIRTIO_PCI_',
+                                   excluded_prefixes=['VIRTIO_PCI_COMMON_', 'VIRTIO_PCI_CAP_', 'VIRTIO_PCI_MODERN_'])
+
+    def __init__(self, pci_device):
+        self.resource, self.resource_size = pci_device.resource()
+        self.reg = traced(FileRegister(self.resource), self.register_names)
+
+    def get_status(self):
+        return self.reg.get8(types.VIRTIO_PCI_STATUS)
+
+    def set_status(self, status):
+        self.reg.set8(types.VIRTIO_PCI_STATUS, status)
+
+    def host_features(self):
+        return self.reg.get32(types.VIRTIO_PCI_HOST_FEATURES)
+
+    def guest_features(self):
+        return self.reg.get32(types.VIRTIO_PCI_GUEST_FEATURES)
+
+    def set_features(self, features):
+        self.reg.set32(types.VIRTIO_PCI_GUEST_FEATURES, features)
+
+    def select_queue(self, index):
+        self.reg.set16(types.VIRTIO_PCI_QUEUE_SEL, index)
+
+    def max_queue_size(self):
+        return self.reg.get32(types.VIRTIO_PCI_QUEUE_NUM)
+
+    def notify_offset(self):
+        return self.reg.get16(types.VIRTIO_PCI_QUEUE_NOTIFY)
+
+    def enable_queue(self, size, desc_address, driver_address, device_address):
+        """
+        The ring has to be page aligned and the device assumes the maximum size,
+        it derives the location of the available and used rings from it
+        """
+        address = desc_address >> types.VIRTIO_PCI_QUEUE_ADDR_SHIFT
+        log.debug('Setting VQueue address to: 0x%02X', address)
+        self.reg.set32(types.VIRTIO_PCI_QUEUE_PFN, address)
+
+    def doorbell(self, index):
+        """The queue to notify is written to the shared notify register"""
+        return self.reg.doorbell(types.VIRTIO_PCI_QUEUE_NOTIFY, 2)
+
+    def read_device_config(self, offset, length):
+        return self.reg.get(types.VIRTIO_PCI_CONFIG_OFFSET + offset, length)
+
+
+class ModernTransport(VirtioTransport):
+    """Section 4.1.4, configuration structures in memory mapped BARs"""
+    register_names = RegisterNames(types, 'VIRTIO_PCI_COMMON_')
+    required_features = 1 << types.VIRTIO_F_VERSION_1
+
+    def __init__(self, pci_device, capabilities):
+        self.pci_device = pci_device
+        self.bars = {}
+        for cfg_type in [types.VIRTIO_PCI_CAP_COMMON_CFG, types.VIRTIO_PCI_CAP_NOTIFY_CFG]:
+            if cfg_type not in capabilities:
+                raise VirtioException('Missing virtio capability with cfg_type {:d}'.format(cfg_type))
+        common = capabilities[types.VIRTIO_PCI_CAP_COMMON_CFG]
+        notify = capabilities[types.VIRTIO_PCI_CAP_NOTIFY_CFG]
+        self.common_cfg = traced(self._map(common), self.register_names)
+        self.notify_cfg = traced(self._map(notify))
+        self.notify_off_multiplier = notify.notify_off_multiplier
+        self.isr_cfg = self._map(capabilities[types.VIRTIO_PCI_CAP_ISR_CFG]) \
+            if types.VIRTIO_PCI_CAP_ISR_CFG in capabilities else None
+        self.device_cfg = self._map(capabilities[types.VIRTIO_PCI_CAP_DEVICE_CFG]) \
+            if types.VIRTIO_PCI_CAP_DEVICE_CFG in capabilities else None
+
+    def _map(self, capability):
+        """Register over the capability's region, the BARs are mapped only once"""
+        if capability.bar not in self.bars:
+            self.bars[capability.bar] = self.pci_device.map_resource(capability.bar)
+        mm = self.bars[capability.bar]
+        end = capability.offset + align(capability.length, 4)
+        if end > len(mm):
+            raise VirtioException('{} exceeds BAR{:d} of size 0x{:X}'.format(capability, capability.bar, len(mm)))
+        return MmapRegister(memoryview(mm)[capability.offset:end])
+
+    def get_status(self):
+        return self.common_cfg.get8(types.VIRTIO_PCI_COMMON_STATUS)
+
+    def set_status(self, status):
+        self.common_cfg.set8(types.VIRTIO_PCI_COMMON_STATUS, status)
+
+    def _read_features(self, select_offset, features_offset):
+        features = 0
+        for word in range(2):
+            self.common_cfg.set32(select_offset, word)
+            features |= self.common_cfg.get32(features_offset) << (32 * word)
+        return features
+
+    def host_features(self):
+        return self._read_features(types.VIRTIO_PCI_COMMON_DFSELECT, types.VIRTIO_PCI_COMMON_DF)
+
+    def guest_features(self):
+        return self._read_features(types.VIRTIO_PCI_COMMON_GFSELECT, types.VIRTIO_PCI_COMMON_GF)
+
+    def set_features(self, features):
+        """Section 3.1.1, the device has to accept the features before the queues are set up"""
+        for word in range(2):
+            self.common_cfg.set32(types.VIRTIO_PCI_COMMON_GFSELECT, word)
+            self.common_cfg.set32(types.VIRTIO_PCI_COMMON_GF, (features >> (32 * word)) & 0xFFFFFFFF)
+        self.add_status(types.VIRTIO_CONFIG_STATUS_FEATURES_OK)
+        if not self.get_status() & types.VIRTIO_CONFIG_STATUS_FEATURES_OK:
+            raise VirtioException('Device did not accept the features 0x{:X}'.format(features))
+
+    def select_queue(self, index):
+        self.common_cfg.set16(types.VIRTIO_PCI_COMMON_Q_SELECT, index)
+
+    def max_queue_size(self):
+        return self.common_cfg.get16(types.VIRTIO_PCI_COMMON_Q_SIZE)
+
+    def notify_offset(self):
+        return self.common_cfg.get16(types.VIRTIO_PCI_COMMON_Q_NOFF)
+
+    def _set64(self, offset, value):
+        self.common_cfg.set32(offset, value & 0xFFFFFFFF)
+        self.common_cfg.set32(offset + 4, value >> 32)
+
+    def enable_queue(self, size, desc_address, driver_address, device_address):
+        """The driver and device areas are the available and used rings of split queues"""
+        self.common_cfg.set16(types.VIRTIO_PCI_COMMON_Q_SIZE, size)
+        self._set64(types.VIRTIO_PCI_COMMON_Q_DESCLO, desc_address)
+        self._set64(types.VIRTIO_PCI_COMMON_Q_AVAILLO, driver_address)
+        self._set64(types.VIRTIO_PCI_COMMON_Q_USEDLO, device_address)
+        self.common_cfg.set16(types.VIRTIO_PCI_COMMON_Q_ENABLE, 1)
+
+    def doorbell(self, index):
+        """Section 4.1.4.4, every queue has its own notification address"""
+        self.select_queue(index)
+        offset = self.notify_offset() * self.notify_off_multiplier
+        return self.notify_cfg.doorbell(offset, 2)
+
+    def read_device_config(self, offset, length):
+        if self.device_cfg is None:
+            raise VirtioException('Device has no device specific configuration')
+        # Section 4.1.4.3.1, retry until the configuration did not change while being read
+        while True:
+            generation = self.common_cfg.get8(types.VIRTIO_PCI_COMMON_CFGGENERATION)
+            value = self.device_cfg.get(offset, length)
+            if generation == self.common_cfg.get8(types.VIRTIO_PCI_COMMON_CFGGENERATION):
+                return value
@@ -12,6 +12,46 @@ VIRTIO_PCI_QUEUE_NUM = 12
 VIRTIO_PCI_QUEUE_SEL = 14
 VIRTIO_PCI_QUEUE_NOTIFY = 16
 VIRTIO_PCI_STATUS = 18
+VIRTIO_PCI_ISR = 19
+# Device specific configuration, legacy layout without MSI-X
+VIRTIO_PCI_CONFIG_OFFSET = 20
+
+# Modern (virtio 1.0) device id, legacy devices use 0x1000
+VIRTIO_PCI_MODERN_DEVICE_ID = 0x1041
+VIRTIO_PCI_LEGACY_DEVICE_ID = 0x1000
+
+# Section 4.1.4, cfg_type of the vendor specific capabilities
+VIRTIO_PCI_CAP_COMMON_CFG = 1
+VIRTIO_PCI_CAP_NOTIFY_CFG = 2
+VIRTIO_PCI_CAP_ISR_CFG = 3
+VIRTIO_PCI_CAP_DEVICE_CFG = 4
+VIRTIO_PCI_CAP_PCI_CFG = 5
+
+# Section 4.1.4.3, virtio_pci_common_cfg fields
+VIRTIO_PCI_COMMON_DFSELECT = 0
+VIRTIO_PCI_COMMON_DF = 4
+VIRTIO_PCI_COMMON_GFSELECT = 8
+VIRTIO_PCI_COMMON_GF = 12
+VIRTIO_PCI_COMMON_MSIX = 16
+VIRTIO_PCI_COMMON_NUMQ = 18
+VIRTIO_PCI_COMMON_STATUS = 20
+VIRTIO_PCI_COMMON_CFGGENERATION = 21
+VIRTIO_PCI_COMMON_Q_SELECT = 22
+VIRTIO_PCI_COMMON_Q_SIZE = 24
+VIRTIO_PCI_COMMON_Q_MSIX = 26
+VIRTIO_PCI_COMMON_Q_ENABLE = 28
+VIRTIO_PCI_COMMON_Q_NOFF = 30
+VIRTIO_PCI_COMMON_Q_DESCLO = 32
+VIRTIO_PCI_COMMON_Q_DESCHI = 36
+VIRTIO_PCI_COMMON_Q_AVAILLO = 40
+VIRTIO_PCI_COMMON_Q_AVAILHI = 44
+VIRTIO_PCI_COMMON_Q_USEDLO = 48
+VIRTIO_PCI_COMMON_Q_USEDHI = 52
+
+# virtio_net_config fields, relative to the device specific configuration
+VIRTIO_NET_CONFIG_MAC = 0
+VIRTIO_NET_CONFIG_STATUS = 6
+VIRTIO_NET_CONFIG_MAX_VIRTQUEUE_PAIRS = 8
 
 VIRTIO_NET_F_CSUM = 0
 VIRTIO_NET_F_GUEST_CSUM = 1
@@ -37,12 +77,16 @@ VIRTIO_NET_F_CTRL_MAC_ADDR = 23
 VIRTIO_F_NOTIFY_ON_EMPTY = 24
 VIRTIO_F_ANY_LAYOUT = 27
 VIRTIO_RING_F_INDIRECT_DESC = 28
+VIRTIO_RING_F_EVENT_IDX = 29
 VIRTIO_F_VERSION_1 = 32
 VIRTIO_F_IOMMU_PLATFORM = 33
+VIRTIO_F_RING_PACKED = 34
 
 VIRTIO_PCI_QUEUE_ADDR_SHIFT = 12
 
 VRING_AVAIL_F_NO_INTERRUPT = 1
+# The device is polling the available ring, no need to notify it
+VRING_USED_F_NO_NOTIFY = 1
 
 # This marks a buffer as continuing via the next field. */
 VRING_DESC_F_NEXT = 1
@@ -51,6 +95,16 @@ VRING_DESC_F_WRITE = 2
 # This means the buffer contains a list of buffer descriptors. */
 VRING_DESC_F_INDIRECT = 4
 
+# Section 2.8.1, packed descriptor flag bits, both track the ring wrap counter
+VRING_PACKED_DESC_F_AVAIL = 7
+VRING_PACKED_DESC_F_USED = 15
+
+# Section 2.8.10, packed ring event suppression
+VRING_PACKED_EVENT_FLAG_ENABLE = 0
+VRING_PACKED_EVENT_FLAG_DISABLE = 1
+VRING_PACKED_EVENT_FLAG_DESC = 2
+VRING_PACKED_EVENT_F_WRAP_CTR = 15
+
 """
  Control the RX mode, ie. promiscuous, allmulti, etc...
  All commands require an "out" sg entry containing a 1 byte
@@ -66,6 +120,37 @@ VIRTIO_NET_CTRL_RX_NOMULTI = 3
 VIRTIO_NET_CTRL_RX_NOUNI = 4
 VIRTIO_NET_CTRL_RX_NOBCAST = 5
 
+"""
+ Control the MAC filter table, the device passes packets to these
+ addresses even when not in promiscuous (or allmulti) mode.
+ The command data holds the unicast and then the multicast table,
+ each being a le32 entry count followed by the 6 byte addresses.
+ """
+VIRTIO_NET_CTRL_MAC = 1
+VIRTIO_NET_CTRL_MAC_TABLE_SET = 0
+VIRTIO_NET_CTRL_MAC_ADDR_SET = 1
+
+"""
+ Control the VLAN filter table, the command data is the le16 VLAN id.
+ Requires VIRTIO_NET_F_CTRL_VLAN
+ """
+VIRTIO_NET_CTRL_VLAN = 2
+VIRTIO_NET_CTRL_VLAN_ADD = 0
+VIRTIO_NET_CTRL_VLAN_DEL = 1
+
+"""
+ Control the number of virtqueue pairs used for multiqueue receive,
+ requires VIRTIO_NET_F_MQ
+ """
+VIRTIO_NET_CTRL_MQ = 4
+VIRTIO_NET_CTRL_MQ_VQ_PAIRS_SET = 0
+VIRTIO_NET_CTRL_MQ_VQ_PAIRS_MIN = 1
+VIRTIO_NET_CTRL_MQ_VQ_PAIRS_MAX = 0x8000
+
+# Ack written by the device into the last byte of a control command
+VIRTIO_NET_OK = 0
+VIRTIO_NET_ERR = 1
+
 
 # Use csum_start,csum_offset
 VIRTIO_NET_HDR_F_NEEDS_CSUM = 1
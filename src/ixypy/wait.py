@@ -0,0 +1,55 @@
+import time
+import logging as log
+
+from ixypy.ixy import IxyException
+
+DEFAULT_TIMEOUT = 2.0
+SPIN_COUNT = 100
+MIN_SLEEP = 1e-5
+MAX_SLEEP = 0.01
+
+
+class IxyTimeoutException(IxyException):
+    def __init__(self, description, timeout):
+        super().__init__('Timed out after {:.3f}s waiting for {}'.format(timeout, description))
+        self.description = description
+        self.timeout = timeout
+
+
+def wait_until(condition,
+               timeout=DEFAULT_TIMEOUT,
+               description='condition',
+               spin_count=SPIN_COUNT,
+               min_sleep=MIN_SLEEP,
+               max_sleep=MAX_SLEEP):
+    """
+    Polls until the condition holds
+
+    The condition is first polled in a tight loop, afterwards the
+    sleep between polls doubles from min_sleep up to max_sleep
+
+    Args:
+        condition: callable returning a truthy value once done
+        timeout: seconds until giving up
+        description: what is being waited for, used for logging and errors
+        spin_count: number of polls before starting to sleep
+    Returns:
+        the time waited in seconds
+    Raises:
+        IxyTimeoutException
+    """
+    start = time.perf_counter()
+    deadline = start + timeout
+    sleep = min_sleep
+    polls = 0
+    while not condition():
+        now = time.perf_counter()
+        if now >= deadline:
+            raise IxyTimeoutException(description, timeout)
+        polls += 1
+        if polls > spin_count:
+            time.sleep(min(sleep, deadline - now))
+            sleep = min(sleep * 2, max_sleep)
+    elapsed = time.perf_counter() - start
+    log.debug('Waited %.3f ms for %s (%d polls)', elapsed * 1000, description, polls + 1)
+    return elapsed
@@ -0,0 +1,75 @@
+import os
+from unittest.mock import Mock
+
+import pytest
+
+from ixypy.affinity import CpuAllocator, Placement, PlacementException, apply_placement
+
+
+def device(local_cpus):
+    return Mock(local_cpus=Mock(return_value=local_cpus))
+
+
+def test_allocates_one_worker_per_cpu():
+    allocator = CpuAllocator([0, 1])
+
+    assert allocator.allocate('a').cpu == 0
+    assert allocator.allocate('b').cpu == 1
+    with pytest.raises(PlacementException):
+        allocator.allocate('c')
+
+
+def test_refuses_taken_cpu():
+    allocator = CpuAllocator([0, 1, 2])
+    allocator.allocate('a', cpu=1)
+
+    with pytest.raises(PlacementException):
+        allocator.allocate('b', cpu=1)
+
+
+def test_refuses_cpu_not_allowed():
+    with pytest.raises(PlacementException):
+        CpuAllocator([0, 1]).allocate('a', cpu=2)
+
+
+def test_release():
+    allocator = CpuAllocator([0])
+    placement = allocator.allocate('a')
+
+    allocator.release(placement)
+
+    assert allocator.allocate('b').cpu == 0
+
+
+def test_prefers_numa_local_cpus():
+    allocator = CpuAllocator(range(8), [device({4, 5}), device(None)])
+
+    placements = [allocator.allocate(name) for name in 'abc']
+
+    assert [placement.cpu for placement in placements] == [4, 5, 0]
+    assert [placement.numa_local for placement in placements] == [True, True, False]
+
+
+def test_unknown_numa_node():
+    placement = CpuAllocator([3], [device(None)]).allocate('a')
+
+    assert placement.numa_local is None
+
+
+def test_summary():
+    allocator = CpuAllocator([0, 1, 2], [device({0, 1})])
+    allocator.allocate('rx', cpu=2, fifo_priority=50)
+    allocator.allocate('tx')
+
+    assert allocator.summary() == 'tx=cpu0/other/local rx=cpu2/fifo:50/remote'
+
+
+def test_apply_placement():
+    affinity = os.sched_getaffinity(0)
+    placement = Placement('test', min(affinity))
+    try:
+        apply_placement(placement)
+
+        assert os.sched_getaffinity(0) == {placement.cpu}
+    finally:
+        os.sched_setaffinity(0, affinity)
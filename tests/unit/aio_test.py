@@ -0,0 +1,131 @@
+import asyncio
+from unittest.mock import Mock
+
+import pytest
+
+from ixypy.aio import AsyncPort
+
+
+class FakeDevice(object):
+    """Receives the queued packets and sends at most tx_room per call"""
+    def __init__(self, packets=(), tx_room=None):
+        self.rx_packets = list(packets)
+        self.tx_room = tx_room
+        self.sent = []
+        self.rx_calls = []
+
+    def rx_batch(self, queue_id, batch_size):
+        self.rx_calls.append(batch_size)
+        batch = self.rx_packets[:batch_size]
+        del self.rx_packets[:batch_size]
+        return batch
+
+    def tx_batch(self, buffers, queue_id=0):
+        count = len(buffers) if self.tx_room is None else min(self.tx_room, len(buffers))
+        self.sent += buffers[:count]
+        return count
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def test_merges_full_batches_into_bursts(loop):
+    device = FakeDevice(range(100))
+    stream = AsyncPort(device, batch_size=8, max_burst=20).rx()
+
+    bursts = [loop.run_until_complete(stream.__anext__()) for _ in range(5)]
+
+    assert bursts[0] == list(range(20))
+    assert [len(burst) for burst in bursts] == [20]*5
+    assert device.rx_calls[:3] == [8, 8, 4]
+
+
+def test_partial_batch_ends_burst(loop):
+    device = FakeDevice(range(10))
+    stream = AsyncPort(device, batch_size=8).rx()
+
+    burst = loop.run_until_complete(stream.__anext__())
+
+    assert burst == list(range(10))
+    assert device.rx_calls == [8, 8]
+    assert (stream.packets, stream.bursts) == (10, 1)
+
+
+def test_waits_for_packets_without_blocking_the_loop(loop):
+    device = FakeDevice()
+    port = AsyncPort(device, max_sleep=1e-3)
+    ticks = []
+
+    async def ticker():
+        for tick in range(5):
+            ticks.append(tick)
+            await asyncio.sleep(0)
+        device.rx_packets += [1, 2, 3]
+
+    async def receive():
+        async for burst in port.rx():
+            return burst
+
+    async def main():
+        return await asyncio.gather(receive(), ticker())
+
+    burst, _ = loop.run_until_complete(main())
+
+    assert burst == [1, 2, 3]
+    assert ticks == list(range(5))
+    assert port.rx().empty_polls >= 5
+
+
+def test_busy_stream_yields_to_the_loop(loop):
+    device = FakeDevice()
+    device.rx_batch = Mock(return_value=[1])
+    port = AsyncPort(device, max_busy_time=0)
+    other_ran = []
+
+    async def receive():
+        async for _ in port.rx():
+            if other_ran:
+                port.close()
+
+    async def other():
+        other_ran.append(True)
+
+    async def main():
+        await asyncio.gather(receive(), other())
+
+    loop.run_until_complete(main())
+
+    assert other_ran
+
+
+def test_close_ends_iteration(loop):
+    port = AsyncPort(FakeDevice())
+    port.close()
+
+    async def receive():
+        return [burst async for burst in port.rx()]
+
+    assert loop.run_until_complete(receive()) == []
+
+
+def test_send_waits_for_room(loop):
+    device = FakeDevice(tx_room=3)
+    sink = AsyncPort(device).tx(1)
+
+    loop.run_until_complete(sink.send(list(range(10))))
+
+    assert device.sent == list(range(10))
+    assert (sink.packets, sink.stalls) == (10, 1)
+
+
+def test_send_fast_path(loop):
+    device = FakeDevice()
+    sink = AsyncPort(device).tx()
+
+    loop.run_until_complete(sink.send([1, 2]))
+
+    assert (sink.packets, sink.stalls) == (2, 0)
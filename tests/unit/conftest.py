@@ -0,0 +1,34 @@
+import pytest
+
+from ixypy.mempool import Mempool
+
+
+class FakeDma(bytearray):
+    """Ordinary memory standing in for DmaMemory, with a made up physical address"""
+    physical_address = 0x200000
+
+
+@pytest.fixture()
+def mempool_size():
+    """Buffers of the mempool fixture, a module overrides it to get another size"""
+    return 8
+
+
+@pytest.fixture()
+def make_mempool():
+    """Creates preallocated mempools in FakeDma, they are freed after the test"""
+    mempools = []
+
+    def make(num_entries, buffer_size=2048):
+        mempool = Mempool(FakeDma(num_entries * buffer_size), buffer_size, num_entries)
+        mempool.preallocate_buffers()
+        mempools.append(mempool)
+        return mempool
+    yield make
+    for mempool in mempools:
+        mempool.free()
+
+
+@pytest.fixture()
+def mempool(make_mempool, mempool_size):
+    return make_mempool(mempool_size)
@@ -0,0 +1,109 @@
+from unittest.mock import Mock
+
+import pytest
+
+from ixypy.graph import Graph, Node, GraphException, TouchNode, EtherTypeNode, TxNode, DropNode
+
+
+class RecordNode(Node):
+    def __init__(self, name):
+        super().__init__(name)
+        self.vectors = []
+
+    def process(self, buffers):
+        self.vectors.append(buffers)
+        return ()
+
+
+class SplitNode(Node):
+    """Passes the first buffer to one node, the rest to the other"""
+    def process(self, buffers):
+        first, rest = self.next_nodes
+        return ((first, buffers[:1]), (rest, buffers[1:]))
+
+
+def test_runs_nodes_in_topological_order():
+    # added in reverse, the join node gets buffers from both branches
+    join = RecordNode('join')
+    graph = Graph([join,
+                   SplitNode('b', ['join', 'join']),
+                   SplitNode('a', ['b', 'join'])])
+
+    graph.enqueue('a', [1, 2, 3])
+    graph.dispatch()
+
+    assert join.vectors == [[2, 3, 1]]
+    assert [node.name for node in graph.order] == ['a', 'b', 'join']
+
+
+def test_counts_calls_and_packets():
+    record = RecordNode('record')
+    graph = Graph([record])
+    handle = graph.input('record')
+
+    handle([1, 2])
+    handle([3])
+
+    assert (record.calls, record.packets) == (2, 3)
+    assert record.time > 0
+    assert str(record).startswith('[record] 2 calls')
+    graph.reset_stats()
+    assert (record.calls, record.packets, record.time) == (0, 0, 0.0)
+
+
+def test_skips_nodes_without_buffers():
+    graph = Graph([SplitNode('split', ['first', 'rest']), RecordNode('first'), RecordNode('rest')])
+
+    graph.input('split')([1])
+
+    assert graph.nodes['first'].vectors == [[1]]
+    assert graph.nodes['rest'].calls == 0
+
+
+def test_unknown_next_node():
+    graph = Graph([TouchNode('touch', 'tx')])
+
+    with pytest.raises(GraphException):
+        graph.dispatch()
+
+
+def test_cycle():
+    graph = Graph([SplitNode('a', ['b', 'b']), SplitNode('b', ['a', 'a'])])
+
+    with pytest.raises(GraphException) as exception:
+        graph.dispatch()
+
+    assert 'a, b' in str(exception.value)
+
+
+def test_duplicate_node():
+    graph = Graph([RecordNode('a')])
+
+    with pytest.raises(GraphException):
+        graph.add(RecordNode('a'))
+
+
+def test_ether_type_node(mempool):
+    buffers = mempool.get_buffers(3)
+    for buffer, ether_type in zip(buffers, [b'\x08\x00', b'\x86\xdd', b'\x08\x06']):
+        buffer.data_buffer[12:14] = ether_type
+    graph = Graph([EtherTypeNode('classify', {0x0800: 'ipv4', 0x86DD: 'ipv6'}),
+                   RecordNode('ipv4'), RecordNode('ipv6'), RecordNode('drop')])
+
+    graph.input('classify')(buffers)
+
+    assert [graph.nodes[name].vectors for name in ['ipv4', 'ipv6', 'drop']] == [[buffers[:1]], [buffers[1:2]],
+                                                                                [buffers[2:]]]
+
+
+def test_forwarding_drops_what_is_not_sent(mempool):
+    device = Mock(tx_batch=Mock(return_value=2))
+    graph = Graph([TouchNode('touch', 'tx'), TxNode('tx', device, queue=1), DropNode()])
+    buffers = mempool.get_buffers(5)
+
+    graph.input('touch')(buffers)
+
+    device.tx_batch.assert_called_once_with(buffers, 1)
+    assert all(buffer.buffer[48] == 1 for buffer in buffers)
+    assert len(mempool._buffers) == 3 + 3
+    assert graph.nodes['drop'].packets == 3
@@ -0,0 +1,27 @@
+import threading
+from unittest.mock import Mock, patch
+
+import ixypy
+
+
+def slow_device(links_up):
+    def wait_for_link(timeout):
+        # Only returns once all devices are waiting, fails if they wait one after the other
+        links_up.wait()
+        return 10000
+    device = Mock()
+    device.wait_for_link.side_effect = wait_for_link
+    return device
+
+
+def test_init_devices_waits_for_links_concurrently():
+    links_up = threading.Barrier(4, timeout=10)
+    devices = [slow_device(links_up) for _ in range(4)]
+
+    with patch('ixypy.init_device', side_effect=devices) as init_device:
+        result = ixypy.init_devices(['0000:00:08.0', '0000:00:09.0', '0000:00:0a.0', '0000:00:0b.0'], 5)
+
+    assert result == devices
+    assert all(call[1]['wait_for_link'] is False for call in init_device.call_args_list)
+    for device in devices:
+        device.wait_for_link.assert_called_once_with(5)
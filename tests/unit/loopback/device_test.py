@@ -0,0 +1,202 @@
+import os
+from multiprocessing import get_context
+
+import pytest
+
+import ixypy
+from ixypy.loopback import device as loopback
+from ixypy.loopback.device import LoopbackDevice, Link, parse_address
+from ixypy.mempool import Mempool
+from ixypy.stats import Stats
+
+
+@pytest.fixture(autouse=True)
+def shm_dir(tmpdir, monkeypatch):
+    monkeypatch.setattr(loopback, 'SHM_DIR', str(tmpdir))
+    return tmpdir
+
+
+@pytest.fixture()
+def mempool_size():
+    return 64
+
+
+def open_pair(**options):
+    options.setdefault('ring_size', 8)
+    options.setdefault('num_buffers', 16)
+    port_0 = LoopbackDevice('test', 0, wait_for_link=False, **options)
+    port_1 = LoopbackDevice('test', 1, **options)
+    port_0.wait_for_link()
+    yield port_0, port_1
+    port_0.close()
+    port_1.close()
+
+
+@pytest.fixture()
+def pair():
+    yield from open_pair(speed=0)
+
+
+@pytest.fixture()
+def lossless_pair():
+    yield from open_pair(speed=0, lossless=True)
+
+
+def packets(mempool, count, size=60):
+    buffers = mempool.get_buffers(count)
+    for i, buffer in enumerate(buffers):
+        buffer.size = size
+        buffer.data_buffer[:size] = bytes([i]) * size
+    return buffers
+
+
+@pytest.mark.parametrize('address, expected', [
+    ('loop:bench:0', ('bench', 0, {})),
+    ('loop:a:b:1,speed=1000,lossless', ('a:b', 1, {'speed': 1000, 'lossless': True})),
+])
+def test_parse_address(address, expected):
+    assert parse_address(address) == expected
+
+
+@pytest.mark.parametrize('address', ['loop:bench', 'loop::0', 'loop:bench:0,fast'])
+def test_parse_invalid_address(address):
+    with pytest.raises(ValueError):
+        parse_address(address)
+
+
+def test_link_down_without_peer():
+    port = LoopbackDevice('alone', 0, wait_for_link=False)
+
+    assert port.get_link_speed() == 0
+    assert port.wait_for_link(timeout=0.01) == 0
+    port.close()
+
+
+def test_ports_are_connected(pair, mempool):
+    port_0, port_1 = pair
+    sent = packets(mempool, 3)
+
+    assert port_0.tx_batch(sent) == 3
+    received = port_1.rx_batch(0, 32)
+
+    assert [bytes(buffer.data_buffer[:60]) for buffer in received] == [bytes([i]) * 60 for i in range(3)]
+    assert all(buffer.size == 60 for buffer in received)
+    # the sent buffers are free again, the received ones belong to the peer's link
+    assert len(mempool._buffers) == 64
+    Mempool.free_to_pools(received)
+    assert port_1.rx_link.mempool.num_free == 16
+    assert port_0.rx_batch(0, 32) == []
+
+
+def test_drops_what_the_peer_has_no_room_for(pair, mempool):
+    port_0, port_1 = pair
+
+    assert port_0.tx_batch(packets(mempool, 10)) == 10
+
+    assert port_0.dropped == 2
+    assert len(port_1.rx_batch(0, 32)) == 8
+
+
+def test_lossless_refuses_what_the_peer_has_no_room_for(lossless_pair, mempool):
+    port_0, port_1 = lossless_pair
+    buffers = packets(mempool, 10)
+
+    assert port_0.tx_batch(buffers) == 8
+
+    assert port_0.dropped == 0
+    assert len(mempool._buffers) == 64 - 2
+
+
+def test_line_rate(mempool):
+    # 1 Mbit/s with a TX queue of 512 minimum sized frames (344 ms)
+    for port_0, port_1 in open_pair(speed=1, num_buffers=4096, ring_size=1024):
+        sent = 0
+        while True:
+            count = port_0.tx_batch(packets(mempool, 16, size=1000))
+            sent += count
+            Mempool.free_to_pools(port_1.rx_batch(0, 32))
+            if count < 16:
+                break
+
+        # 1024 bytes on the wire take 8.2 ms, the queue holds 42 of them
+        assert 40 <= sent <= 44
+
+
+def test_stats(pair, mempool):
+    port_0, port_1 = pair
+    port_0.tx_batch(packets(mempool, 2))
+    port_1.rx_batch(0, 32)
+    stats = Stats(port_0.pci_device)
+
+    port_0.read_stats(stats)
+    port_1.read_stats(stats)
+    port_0.read_stats(stats)
+
+    assert (stats.rx_packets, stats.tx_packets, stats.rx_bytes, stats.tx_bytes) == (2, 2, 120, 120)
+
+
+def test_reopened_peer(mempool):
+    port_0 = LoopbackDevice('reopen', 0, wait_for_link=False)
+    LoopbackDevice('reopen', 1).close()
+
+    assert port_0.get_link_speed() == 0
+    port_1 = LoopbackDevice('reopen', 1)
+    assert port_0.get_link_speed() == loopback.DEFAULT_SPEED
+    port_0.tx_batch(packets(mempool, 1))
+    assert len(port_1.rx_batch(0, 32)) == 1
+    port_0.close()
+    port_1.close()
+    assert Link.links == {}
+
+
+def test_sender_follows_reopened_peer(lossless_pair, mempool):
+    port_0, port_1 = lossless_pair
+    assert port_0.tx_batch(packets(mempool, 8)) == 8
+    port_1.close()
+    port_1 = LoopbackDevice('test', 1, speed=0, ring_size=8, num_buffers=16)
+
+    # The old link is full, which makes the sender look for a new one
+    buffers = packets(mempool, 4)
+    assert port_0.tx_batch(buffers) == 0
+    assert port_0.tx_batch(buffers) == 4
+
+    assert len(port_1.rx_batch(0, 32)) == 4
+    port_1.close()
+
+
+def receive_in_child(count):
+    port = LoopbackDevice('fork', 1, speed=0)
+    received = 0
+    while received < count:
+        buffers = port.rx_batch(0, 32)
+        received += len(buffers)
+        Mempool.free_to_pools(buffers)
+    port.close()
+    os._exit(0 if received == count else 1)
+
+
+def test_between_processes(mempool):
+    child = get_context('fork').Process(target=receive_in_child, args=(100,))
+    child.start()
+    port = LoopbackDevice('fork', 0, speed=0, lossless=True)
+    sent = 0
+    while sent < 100:
+        buffers = packets(mempool, min(16, 100 - sent))
+        count = port.tx_batch(buffers)
+        Mempool.free_to_pools(buffers[count:])
+        sent += count
+
+    child.join(5)
+    port.close()
+    assert child.exitcode == 0
+
+
+def test_init_device():
+    port_0 = ixypy.init_device('loop:init:0,speed=0', wait_for_link=False)
+    port_1 = ixypy.init_device('loop:init:1,lossless')
+
+    assert isinstance(port_0, LoopbackDevice)
+    assert (port_0.speed, port_1.lossless) == (0, True)
+    assert port_1.pci_device.address == 'loop:init:1'
+    port_0.close()
+    port_1.close()
@@ -0,0 +1,29 @@
+import pytest
+
+import memory
+from memory import DmaMemory
+
+
+@pytest.fixture()
+def huge_dir(tmpdir, monkeypatch):
+    # Not a hugetlbfs mount, so mapping fails like it does without free huge pages
+    monkeypatch.setattr(memory, 'HUGEPAGE_DIR', str(tmpdir))
+    return tmpdir
+
+
+@pytest.mark.parametrize('size, name', [
+    (4096, None),
+    (4096, 'failed'),
+    (4 << 20, 'too-big'),
+])
+def test_failed_allocation_leaves_no_file(huge_dir, size, name):
+    with pytest.raises(MemoryError):
+        DmaMemory(size, name=name)
+
+    assert huge_dir.listdir() == []
+
+
+def test_failed_named_allocation_can_be_retried(huge_dir):
+    for _ in range(2):
+        with pytest.raises(MemoryError):
+            DmaMemory(4096, name='retry')
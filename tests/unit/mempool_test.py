@@ -0,0 +1,135 @@
+import os
+import mmap
+
+import pytest
+
+from ixypy.mempool import Mempool, PacketBuffer, Offload, SharedMempool
+from ixypy.virtio.structures import VirtioNetworkHeader
+
+
+@pytest.fixture()
+def mempool_size():
+    return 4
+
+
+def test_stamp_header(mempool):
+    header = VirtioNetworkHeader(flags=1, header_len=42)
+
+    mempool.stamp_header(header)
+
+    for buff in mempool.get_buffers(4):
+        assert buff.header is header
+        assert buff.head_room_buffer[-len(header)] == 1
+        assert bytes(buff.data_buffer[:1]) == b'\x00'
+
+
+def test_free_buffer_clears_offload(mempool):
+    buff = mempool.get_buffer()
+    buff.offload = Offload(csum_start=34, csum_offset=16)
+
+    mempool.free_buffer(buff)
+
+    assert buff.offload is None
+
+
+def test_offload_equality():
+    assert Offload(csum_start=34, csum_offset=16) == Offload(csum_start=34, csum_offset=16)
+    assert Offload(csum_start=34, csum_offset=16) != Offload(csum_start=34, csum_offset=6)
+    assert Offload() != VirtioNetworkHeader()
+
+
+def test_new_buffer_has_no_header():
+    assert PacketBuffer(memoryview(bytearray(2048))).header is None
+
+
+class FileDma(mmap.mmap):
+    """Shared file mapping standing in for named hugepage memory"""
+    physical_address = 0x400000
+
+
+@pytest.fixture()
+def shared_memory(tmpdir):
+    size = SharedMempool.byte_size(8, 2048)
+    path = str(tmpdir.join('ixypy-shared-test'))
+    with open(path, 'wb') as fd:
+        fd.write(bytes(size))
+    with open(path, 'r+b') as fd:
+        dma = FileDma(fd.fileno(), size)
+    dma.path = path
+    return dma
+
+
+@pytest.fixture()
+def shared_mempool(shared_memory):
+    mempool = SharedMempool.format(shared_memory, 8, 2048, SharedMempool.identifier_for('test'))
+    yield mempool
+    mempool.free()
+
+
+def test_shared_buffers_have_index_and_address(shared_mempool):
+    buffs = shared_mempool.get_buffers(3)
+
+    assert [buff.index for buff in buffs] == [0, 1, 2]
+    offset = SharedMempool.buffers_offset_for(8, 2048)
+    assert offset % 2048 == 0
+    assert buffs[1].physical_address == FileDma.physical_address + offset + 2048
+    assert buffs[1].mempool_id == shared_mempool.identifier
+    assert shared_mempool.num_free == 5
+
+
+def test_shared_free_buffers(shared_mempool):
+    buffs = shared_mempool.get_buffers(8)
+    assert shared_mempool.get_buffers(1) == []
+
+    shared_mempool.free_buffers(buffs[2:4])
+
+    assert shared_mempool.num_free == 2
+    assert sorted(buff.index for buff in shared_mempool.get_buffers(8)) == [2, 3]
+
+
+def test_double_free(shared_mempool):
+    with pytest.raises(ValueError):
+        shared_mempool.free_buffer(shared_mempool.buffer(0))
+
+
+def test_attach_requires_pool(shared_memory):
+    with pytest.raises(ValueError):
+        SharedMempool.from_memory(shared_memory)
+
+
+def allocate_in_child(path, size, num_buffers):
+    with open(path, 'r+b') as fd:
+        dma = FileDma(fd.fileno(), size)
+    dma.path = path
+    mempool = SharedMempool.from_memory(dma)
+    buffs = mempool.get_buffers(num_buffers)
+    buffs[0].data_buffer[0] = 0x42
+    os._exit(0 if [buff.index for buff in buffs] == list(range(num_buffers)) else 1)
+
+
+def test_attach_from_other_process(shared_memory):
+    mempool = SharedMempool.format(shared_memory, 8, 2048, SharedMempool.identifier_for('test'))
+    # The child attaches by itself, it must not find the pool of the parent
+    del Mempool.pools[mempool.identifier]
+    try:
+        pid = os.fork()
+        if pid == 0:
+            allocate_in_child(shared_memory.path, len(shared_memory), 3)
+        _, status = os.waitpid(pid, 0)
+
+        assert os.WEXITSTATUS(status) == 0
+        assert mempool.num_free == 5
+        assert mempool.get_buffer().index == 3
+        assert mempool.buffer(0).data_buffer[0] == 0x42
+    finally:
+        Mempool.pools[mempool.identifier] = mempool
+        mempool.free()
+
+
+def test_get_buffer_from_empty_pool(mempool):
+    buffs = mempool.get_buffers(4)
+
+    assert mempool.get_buffer() is None
+
+    mempool.free_buffers(buffs)
+    assert len(mempool.get_buffers(4)) == 4
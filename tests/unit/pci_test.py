@@ -10,7 +10,7 @@ import pytest
 from pytest import raises
 
 from ixypy.pci import PCIAddress, PCIConfigurationReader, InvalidPCIAddressException, \
-    PCIDeviceController, PCIDevice
+    PCIDeviceController, PCIDevice, parse_cpulist
 
 
 class TestPCIAddress(object):
@@ -120,6 +120,55 @@ class TestPCIDevice(object):
 
         assert device.path() == '/sys/bus/pci/devices/0000:00:15.0'
 
+    def test_no_capabilities(self, pci_device):
+        device = PCIDevice(PCIAddress(), PCIDeviceController(pci_device.device_path))
+
+        assert device.capabilities() == []
+
+    def test_capabilities(self, pci_device):
+        # GIVEN a capability list 0x40 -> 0x50 -> 0x60
+        with open(pci_device.config_path, 'r+b') as config:
+            config.seek(6)
+            config.write(pack('<H', PCIDevice.capability_list_flag))
+            config.seek(0x40)
+            config.write(bytes([0x09, 0x50] + [0]*14 + [0x11, 0x60] + [0]*14 + [0x09, 0x00]))
+        device = PCIDevice(PCIAddress(), PCIDeviceController(pci_device.device_path))
+
+        # WHEN
+        capabilities = device.capabilities()
+
+        # THEN
+        assert [(cap.id, cap.offset) for cap in capabilities] == [(0x09, 0x40), (0x11, 0x50), (0x09, 0x60)]
+
+    def test_map_resource_bar(self, pci_device):
+        with open('{}/resource2'.format(pci_device.device_path), 'wb') as resource:
+            resource.write(bytes(4096))
+        device = PCIDevice(PCIAddress(), PCIDeviceController(pci_device.device_path))
+
+        assert len(device.map_resource(2)) == 4096
+
+    def test_local_cpus(self, pci_device):
+        with open('{}/local_cpulist'.format(pci_device.device_path), 'w') as cpulist:
+            cpulist.write('0-3,8\n')
+        device = PCIDevice(PCIAddress(), PCIDeviceController(pci_device.device_path))
+
+        assert device.local_cpus() == {0, 1, 2, 3, 8}
+
+    def test_unknown_local_cpus(self, pci_device):
+        device = PCIDevice(PCIAddress(), PCIDeviceController(pci_device.device_path))
+
+        assert device.local_cpus() is None
+
+
+@pytest.mark.parametrize('cpulist, cpus', [
+    ('0', {0}),
+    ('0-2,5', {0, 1, 2, 5}),
+    ('4-5,10-11\n', {4, 5, 10, 11}),
+    ('', set()),
+])
+def test_parse_cpulist(cpulist, cpus):
+    assert parse_cpulist(cpulist) == cpus
+
 
 def pack_config(fmt, config):
     config_tuple = (
@@ -5,6 +5,7 @@ from struct import unpack_from, pack_into
 import pytest
 
 from ixypy.register import Register, MmapRegister
+from ixypy.wait import IxyTimeoutException
 
 
 class MockRegister(Register):
@@ -116,3 +117,69 @@ def test_clear_flags(tmpdir):
 
     # then
     assert unpack_from('I', mem, offset)[0] & mask == 0
+
+
+def test_get_returns_int(tmpdir):
+    # given
+    mem, fd = get_mem(tmpdir)
+    reg = MmapRegister(mem)
+    pack_into('I', mem, 4, 0xDEADBEEF)
+
+    # when
+    value = reg.get(4)
+
+    # then
+    assert type(value) is int
+    assert value == 0xDEADBEEF
+
+
+def test_doorbell(tmpdir):
+    # given
+    mem, fd = get_mem(tmpdir)
+    reg = MmapRegister(mem)
+    offset = 16
+    doorbell = reg.doorbell(offset)
+
+    # when
+    doorbell.set(511)
+
+    # then
+    assert unpack_from('I', mem, offset)[0] == 511
+    assert doorbell.get() == reg.get(offset) == 511
+
+
+def test_wait_set_timeout(tmpdir):
+    # given
+    mem, fd = get_mem(tmpdir)
+    reg = MmapRegister(mem)
+
+    # then
+    with pytest.raises(IxyTimeoutException):
+        reg.wait_set(0, 0x1, timeout=0.01)
+
+
+@pytest.mark.parametrize('length, fmt', [(1, 'B'), (2, 'H'), (4, 'I')])
+def test_sized_access(tmpdir, length, fmt):
+    # given
+    mem, fd = get_mem(tmpdir)
+    reg = MmapRegister(mem)
+
+    # when
+    reg.set(20, 0x1FFFFFFFF, length)
+
+    # then
+    assert unpack_from(fmt, mem, 20)[0] == (1 << 8*length) - 1
+    assert reg.get(20, length) == (1 << 8*length) - 1
+
+
+def test_16_bit_doorbell(tmpdir):
+    # given
+    mem, fd = get_mem(tmpdir)
+    doorbell = MmapRegister(mem).doorbell(10, 2)
+
+    # when
+    doorbell.set(3)
+
+    # then
+    assert unpack_from('H', mem, 10)[0] == 3
+    assert unpack_from('I', mem, 8)[0] == 3 << 16
@@ -0,0 +1,90 @@
+import os
+import mmap
+from unittest.mock import Mock
+
+import pytest
+
+from ixypy.ring import PacketRing, RingException
+
+SIZE = 8
+
+
+def new_ring(size=SIZE):
+    return PacketRing(mmap.mmap(-1, PacketRing.byte_size(size)), size)
+
+
+def test_enqueue_dequeue():
+    ring = new_ring()
+
+    assert ring.enqueue([3, 1, 2]) == 3
+    assert len(ring) == 3
+    assert ring.dequeue(2) == [3, 1]
+    assert ring.dequeue(SIZE) == [2]
+    assert ring.dequeue(SIZE) == []
+
+
+def test_enqueue_when_full():
+    ring = new_ring()
+
+    assert ring.enqueue(list(range(SIZE + 2))) == SIZE
+    assert ring.enqueue([1]) == 0
+    assert ring.dequeue(SIZE + 2) == list(range(SIZE))
+
+
+def test_wrap_around():
+    ring = new_ring()
+    ring.enqueue(list(range(6)))
+    ring.dequeue(6)
+
+    assert ring.enqueue(list(range(10, 15))) == 5
+
+    assert ring.dequeue(SIZE) == list(range(10, 15))
+    assert ring.slots[0] == 12
+
+
+def test_size_must_be_power_of_two():
+    with pytest.raises(RingException):
+        PacketRing(mmap.mmap(-1, PacketRing.byte_size(6)), 6)
+
+
+def test_attach_to_existing_ring():
+    ring = new_ring()
+    ring.enqueue([5])
+
+    attached = PacketRing(ring.memory)
+
+    assert attached.size == SIZE
+    assert attached.dequeue(1) == [5]
+
+
+def test_no_ring_in_memory():
+    with pytest.raises(RingException):
+        PacketRing(mmap.mmap(-1, PacketRing.byte_size(SIZE)))
+
+
+def test_buffers():
+    ring = new_ring()
+    buffers = [Mock(index=i) for i in range(4)]
+    mempool = Mock()
+    mempool.buffer = lambda index: buffers[index]
+
+    ring.enqueue_buffers(buffers[2:])
+
+    assert ring.dequeue_buffers(mempool, SIZE) == buffers[2:]
+
+
+def test_between_processes():
+    ring = new_ring()
+    count = 1000
+    pid = os.fork()
+    if pid == 0:
+        sent = 0
+        while sent < count:
+            sent += ring.enqueue(list(range(sent, min(sent + 3, count))))
+        os._exit(0)
+    received = []
+    while len(received) < count:
+        received += ring.dequeue(4)
+    os.waitpid(pid, 0)
+
+    assert received == list(range(count))
@@ -0,0 +1,130 @@
+from unittest.mock import Mock
+
+import pytest
+
+from ixypy import scheduler
+from ixypy.scheduler import PollScheduler, PollStats, IdleBackoff
+from ixypy.stats import SharedStats
+
+
+def device(*batches):
+    """Device returning the batches from rx_batch, then nothing"""
+    batches = list(batches)
+    return Mock(rx_batch=Mock(side_effect=lambda queue, batch_size: batches.pop(0) if batches else []))
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    calls = []
+    monkeypatch.setattr(scheduler.time, 'sleep', calls.append)
+    monkeypatch.setattr(scheduler.os, 'sched_yield', lambda: calls.append('yield'))
+    return calls
+
+
+def test_round_robin():
+    poll_scheduler = PollScheduler()
+    dev_1, dev_2 = device([1, 2]), device([3])
+    received = []
+    poll_scheduler.register(dev_1, 0, received.append, batch_size=8)
+    task = poll_scheduler.register(dev_2, 1, received.append)
+
+    assert poll_scheduler.poll_once() == 3
+    assert poll_scheduler.poll_once() == 0
+
+    assert received == [[1, 2], [3]]
+    dev_2.rx_batch.assert_called_with(1, 32)
+    assert (task.packets, task.empty_polls) == (1, 1)
+
+
+def test_unregister():
+    poll_scheduler = PollScheduler()
+    task = poll_scheduler.register(device([1]), 0, Mock())
+
+    poll_scheduler.unregister(task)
+
+    assert poll_scheduler.poll_once() == 0
+
+
+def test_backoff_spins_yields_then_sleeps(sleeps):
+    backoff = IdleBackoff(spin_rounds=2, yield_rounds=1, min_sleep=1e-5, max_sleep=3e-5)
+
+    slept = [backoff.idle() for _ in range(6)]
+
+    assert slept == [False, False, False, True, True, True]
+    assert sleeps == ['yield', 1e-5, 2e-5, 3e-5]
+
+
+def test_backoff_reset(sleeps):
+    backoff = IdleBackoff(spin_rounds=0, yield_rounds=0, min_sleep=1e-5, max_sleep=1e-3)
+    backoff.idle()
+    backoff.idle()
+
+    backoff.reset()
+    backoff.idle()
+
+    assert sleeps == [1e-5, 2e-5, 1e-5]
+
+
+def test_busy_polls_without_max_sleep(sleeps):
+    backoff = IdleBackoff(spin_rounds=0, yield_rounds=0, max_sleep=0)
+
+    assert not any(backoff.idle() for _ in range(10))
+    assert sleeps == []
+
+
+def test_run_snaps_back_to_busy_polling(sleeps):
+    backoff = IdleBackoff(spin_rounds=1, yield_rounds=0, min_sleep=1e-5, max_sleep=1e-3)
+    poll_scheduler = PollScheduler(backoff)
+    # Three idle rounds, one with packets, then idle until stopped
+    batches = [[], [], [], [1], [], [], []]
+    dev = Mock(rx_batch=Mock(side_effect=lambda queue, batch_size: batches.pop(0)))
+    poll_scheduler.register(dev, 0, Mock())
+    poll_scheduler.every(0, lambda interval: poll_scheduler.stop() if not batches else None)
+
+    poll_scheduler.run()
+
+    assert sleeps == [1e-5, 2e-5, 1e-5, 2e-5]
+    stats = poll_scheduler.stats
+    assert (stats.rounds, stats.empty_rounds) == (7, 6)
+    assert stats.busy_time > 0
+    assert stats.idle_time >= stats.sleep_time > 0
+
+
+def test_timers():
+    poll_scheduler = PollScheduler(IdleBackoff(max_sleep=0))
+    intervals = []
+
+    def timer(interval):
+        intervals.append(interval)
+        if len(intervals) == 3:
+            poll_scheduler.stop()
+    poll_scheduler.every(0.001, timer)
+
+    poll_scheduler.run()
+
+    assert len(intervals) == 3
+    assert all(interval >= 0.001 for interval in intervals)
+
+
+def test_poll_stats_diff(capsys):
+    old = PollStats('worker')
+    new = PollStats('worker')
+    new.rounds, new.empty_rounds = 10, 4
+    new.busy_time, new.idle_time, new.sleep_time = 0.25, 0.75, 0.5
+
+    new.print_diff(old, 1)
+
+    assert capsys.readouterr().out == '[worker] busy 25.0 % idle 75.0 % sleeping 50.0 % empty rounds 4/10\n'
+
+
+def test_shared_poll_stats():
+    shared_stats = SharedStats(2, 1, PollStats.fields, 'd')
+    for worker in range(2):
+        stats = PollStats()
+        stats.rounds, stats.busy_time = 5, 0.5
+        shared_stats.publish(worker, 0, stats)
+    stats = PollStats()
+
+    shared_stats.read(0, stats)
+
+    assert (stats.rounds, stats.busy_time) == (10, 1.0)
@@ -0,0 +1,37 @@
+from multiprocessing import get_context
+from unittest.mock import Mock
+
+from ixypy.stats import Stats, SharedStats
+
+
+def publish_from_child(shared_stats, worker):
+    stats = Stats(Mock(), rxp=10 * (worker + 1), txp=worker, rxb=1000, txb=2000)
+    shared_stats.publish(worker, 1, stats)
+
+
+def test_shared_stats_sums_workers():
+    shared_stats = SharedStats(num_workers=3, num_devices=2)
+    for worker in range(3):
+        shared_stats.publish(worker, 0, Stats(Mock(), rxp=worker + 1, rxb=100))
+    stats = Stats(Mock())
+
+    shared_stats.read(0, stats)
+
+    assert (stats.rx_packets, stats.rx_bytes, stats.tx_packets) == (6, 300, 0)
+    shared_stats.read(1, stats)
+    assert stats.rx_packets == 0
+
+
+def test_shared_stats_across_processes():
+    shared_stats = SharedStats(num_workers=2, num_devices=2)
+    context = get_context('fork')
+    workers = [context.Process(target=publish_from_child, args=(shared_stats, worker)) for worker in range(2)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    stats = Stats(Mock())
+
+    shared_stats.read(1, stats)
+
+    assert (stats.rx_packets, stats.tx_packets, stats.rx_bytes, stats.tx_bytes) == (30, 1, 2000, 4000)
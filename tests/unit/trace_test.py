@@ -0,0 +1,74 @@
+from ixypy import trace
+from ixypy.ixgbe import types
+from ixypy.register import MmapRegister
+from ixypy.trace import RegisterNames, RegisterTrace, TracedRegister
+
+import pytest
+
+
+@pytest.fixture()
+def register():
+    return MmapRegister(bytearray(0x10000))
+
+
+def test_tracing_disabled_returns_register(register):
+    trace.disable_tracing()
+
+    assert trace.traced(register) is register
+
+
+def test_tracing_enabled_wraps_register(register):
+    trace.enable_tracing(16)
+    try:
+        assert isinstance(trace.traced(register), TracedRegister)
+    finally:
+        trace.disable_tracing()
+
+
+def test_register_names():
+    names = RegisterNames(types, 'IXGBE_')
+
+    assert names[types.IXGBE_CTRL] == 'IXGBE_CTRL'
+    assert names[types.IXGBE_LINKS] == 'IXGBE_LINKS'
+    assert names[types.IXGBE_RDT(3)] == 'IXGBE_RDT(3)'
+    assert names[0x0FFFC] == '0x0FFFC'
+
+
+def test_records_accesses(register):
+    ring = RegisterTrace(16)
+    reg = TracedRegister(register, ring, RegisterNames(types, 'IXGBE_'))
+
+    reg.set(types.IXGBE_FCTRL, 0x1)
+    reg.set_flags(types.IXGBE_FCTRL, 0x2)
+
+    records = list(ring.records())
+    assert [(op, name, value) for _, op, _, name, value, _ in records] == [
+        (trace.WRITE, 'IXGBE_FCTRL', 0x1),
+        (trace.READ, 'IXGBE_FCTRL', 0x1),
+        (trace.WRITE, 'IXGBE_FCTRL', 0x3),
+    ]
+    assert all(site.startswith('test_records_accesses:') for *_, site in records)
+    assert register.get(types.IXGBE_FCTRL) == 0x3
+
+
+def test_doorbell_is_traced(register):
+    ring = RegisterTrace(16)
+    reg = TracedRegister(register, ring, RegisterNames(types, 'IXGBE_'))
+    doorbell = reg.doorbell(types.IXGBE_TDT(0))
+
+    for i in range(3):
+        doorbell.set(i)
+
+    assert ring.per_register()[('IXGBE_TDT(0)', trace.WRITE)] == 3
+
+
+def test_ring_overwrites_oldest(register):
+    ring = RegisterTrace(4)
+    reg = TracedRegister(register, ring)
+
+    for i in range(10):
+        reg.set(0, i)
+
+    assert len(ring) == 4
+    assert ring.count == 10
+    assert [value for _, _, _, _, value, _ in ring.records()] == [6, 7, 8, 9]
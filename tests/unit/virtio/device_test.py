@@ -0,0 +1,374 @@
+from itertools import count
+from unittest.mock import Mock
+
+import pytest
+
+from ixypy.mempool import Mempool, Offload
+from ixypy.virtio.device import VirtioDevice
+from ixypy.virtio.structures import VRing, VirtioNetworkMergeableHeader, VirtioNetworkControl,\
+                                    PromiscuousModeCommand
+from ixypy.virtio.transport import VirtioTransport
+from ixypy.wait import IxyTimeoutException
+from ixypy.virtio.exception import VirtioException
+from ixypy.virtio import types
+
+from tests.unit.conftest import FakeDma
+
+QUEUE_SIZE = 8
+BUFFER_SIZE = 2048
+# The control queue follows the only queue pair
+CTRL_QUEUE = 2
+HOST_FEATURES = sum(1 << feature for feature in [types.VIRTIO_NET_F_CSUM,
+                                                 types.VIRTIO_NET_F_GUEST_CSUM,
+                                                 types.VIRTIO_NET_F_CTRL_VQ,
+                                                 types.VIRTIO_NET_F_CTRL_RX,
+                                                 types.VIRTIO_NET_F_MRG_RXBUF,
+                                                 types.VIRTIO_RING_F_INDIRECT_DESC])
+
+
+class FakeTransport(VirtioTransport):
+    """
+    Device side of split rings in FakeDma, found by their physical addresses
+
+    The device acknowledges control commands as soon as it is notified
+    about them, unless acknowledging is turned off.
+    """
+    def __init__(self, host_features=HOST_FEATURES):
+        self.status = 0
+        self.offered_features = host_features
+        self.features = 0
+        self.selected = 0
+        self.memory = {}
+        self.physical_addresses = count(0x200000, 0x100000)
+        self.rings = {}
+        self.doorbells = {}
+        self.acknowledging = True
+        self.commands = 0
+
+    def allocate(self, size):
+        dma = FakeDma(size)
+        dma.physical_address = next(self.physical_addresses)
+        self.memory[dma.physical_address] = dma
+        return dma
+
+    def get_status(self):
+        return self.status
+
+    def set_status(self, status):
+        self.status = status
+
+    def host_features(self):
+        return self.offered_features
+
+    def guest_features(self):
+        return self.features
+
+    def set_features(self, features):
+        self.features = features
+
+    def select_queue(self, index):
+        self.selected = index
+
+    def max_queue_size(self):
+        return QUEUE_SIZE
+
+    def notify_offset(self):
+        return 0
+
+    def enable_queue(self, size, desc_address, driver_address, device_address):
+        self.rings[self.selected] = VRing(memoryview(self.memory[desc_address]), size)
+
+    def doorbell(self, index):
+        doorbell = Mock()
+        if index == CTRL_QUEUE:
+            doorbell.set.side_effect = lambda value: self.acknowledging and self.acknowledge_commands()
+        self.doorbells[index] = doorbell
+        return doorbell
+
+    def acknowledge_commands(self):
+        """Marks all available commands used, the ack the driver wrote (VIRTIO_NET_OK) stays"""
+        ring = self.rings[CTRL_QUEUE]
+        while self.commands != ring.available.index:
+            head = ring.available.rings[self.commands % ring.size]
+            ring.used.rings[ring.used.index % ring.size] = (head, 1)
+            ring.used.index = (ring.used.index + 1) & 0xFFFF
+            self.commands = (self.commands + 1) & 0xFFFF
+
+
+class MemoryVirtioDevice(VirtioDevice):
+    """VirtioDevice allocating its rings and buffers in FakeDma"""
+    def _allocate_dma(self, size):
+        return self.transport.allocate(size)
+
+    def allocate_mempool(self, num_entries, entry_size=BUFFER_SIZE):
+        mempool = Mempool(self.transport.allocate(num_entries * entry_size), entry_size, num_entries)
+        mempool.preallocate_buffers()
+        return mempool
+
+
+@pytest.fixture()
+def transport(request):
+    """Offers HOST_FEATURES, parametrize it indirectly to offer others"""
+    return FakeTransport(getattr(request, 'param', HOST_FEATURES))
+
+
+@pytest.fixture()
+def device(transport):
+    """
+    A device with a mergeable RX queue, a TX queue with indirect descriptors
+    and a control queue, initialized like a real one through the transport
+    """
+    pci_device = Mock()
+    pci_device.has_driver.return_value = False
+    device = MemoryVirtioDevice(pci_device, transport=transport)
+    yield device
+    for vq in device.rx_queues + device.ctrl_queues:
+        vq.mempool.free()
+
+
+@pytest.fixture()
+def tx_mempool(make_mempool):
+    return make_mempool(4 * QUEUE_SIZE, BUFFER_SIZE)
+
+
+def receive(vq, descriptor_lengths, data, hdr_len, num_buffers=None):
+    """
+    Writes a packet across the next buffers like the device does
+
+    Args:
+        num_buffers: number written to the header, by default the number of buffers used
+    """
+    used = vq.vring.used
+    offset = 0
+    for i, length in enumerate(descriptor_lengths):
+        # The ring was filled in order
+        slot = (used.index + i) % vq.size
+        buffer = vq.buffers[slot]
+        start = buffer.data_offset - hdr_len
+        if i == 0:
+            header = VirtioNetworkMergeableHeader(num_buffers=len(descriptor_lengths) if num_buffers is None else num_buffers)
+            header.to_buffer(buffer.buffer, start)
+            payload = length - hdr_len
+            start += hdr_len
+        else:
+            payload = length
+        buffer.buffer[start:start + payload] = data[offset:offset + payload]
+        offset += payload
+        used.rings[slot] = (slot, length)
+    used.index += len(descriptor_lengths)
+
+
+def test_rx_batch_chains_full_mergeable_buffers(device):
+    vq = device.rx_queues[0]
+    # Fills the ring
+    assert device.rx_batch(0, 32) == []
+    hdr_len = len(device.net_hdr)
+    buffer_length = vq.vring.lengths[0]
+    data = bytes(range(256)) * (3 * buffer_length // 256 + 1)
+    data = data[:3 * buffer_length - hdr_len]
+
+    receive(vq, [buffer_length] * 3, data, hdr_len)
+    buffers = device.rx_batch(0, 32)
+
+    assert len(buffers) == 1
+    segments = list(buffers[0].segments())
+    assert len(segments) == 3
+    assert b''.join(bytes(segment.data_buffer[:segment.size]) for segment in segments) == data
+    assert device.rx_bytes == len(data)
+
+
+def test_rx_batch_reads_used_elements_for_the_batch_only(device):
+    vq = device.rx_queues[0]
+    hdr_len = len(device.net_hdr)
+    device.rx_batch(0, 32)
+    for _ in range(4):
+        receive(vq, [hdr_len + 60], bytes(60), hdr_len)
+    vq.used_entries = Mock(wraps=vq.used_entries)
+
+    assert len(device.rx_batch(0, 2)) == 2
+
+    vq.used_entries.assert_called_once_with(2)
+
+
+def test_rx_batch_reads_further_for_mergeable_packets(device):
+    vq = device.rx_queues[0]
+    hdr_len = len(device.net_hdr)
+    device.rx_batch(0, 32)
+    receive(vq, [hdr_len + 60, 60, 60], bytes(180), hdr_len)
+    receive(vq, [hdr_len + 60], bytes(60), hdr_len)
+
+    buffers = device.rx_batch(0, 1)
+
+    assert len(buffers) == 1
+    assert len(list(buffers[0].segments())) == 3
+    assert len(device.rx_batch(0, 1)) == 1
+
+
+@pytest.mark.parametrize('num_buffers, descriptors, dropped', [
+    # A packet has at least one buffer
+    (0, 1, 1),
+    # More buffers than the device used
+    (4, 2, 2),
+])
+def test_rx_batch_drops_packets_with_broken_num_buffers(device, num_buffers, descriptors, dropped):
+    vq = device.rx_queues[0]
+    hdr_len = len(device.net_hdr)
+    device.rx_batch(0, 32)
+    free_buffers = len(vq.mempool._buffers)
+    receive(vq, [hdr_len + 60] * descriptors, bytes((hdr_len + 60) * descriptors), hdr_len, num_buffers)
+    if dropped < descriptors:
+        receive(vq, [hdr_len + 60], bytes(60), hdr_len)
+
+    buffers = device.rx_batch(0, 32)
+
+    assert len(buffers) == descriptors - dropped
+    assert vq.num_free == 0
+    # The buffers of the dropped packet were replaced by fresh ones
+    assert len(vq.mempool._buffers) == free_buffers - len(buffers)
+    receive(vq, [hdr_len + 60], bytes(60), hdr_len)
+    assert len(device.rx_batch(0, 32)) == 1
+
+
+def test_refill_kicks_once(device, transport):
+    doorbell = transport.doorbells[0]
+
+    device.rx_batch(0, 32)
+
+    assert device.rx_queues[0].num_free == 0
+    doorbell.set.assert_called_once_with(0)
+    assert (device.kicks, device.suppressed_kicks) == (1, 0)
+
+
+def test_kick_suppressed_by_used_flags(device, transport):
+    device.rx_queues[0].vring.used.flags = types.VRING_USED_F_NO_NOTIFY
+
+    device.rx_batch(0, 32)
+
+    assert device.rx_queues[0].num_free == 0
+    transport.doorbells[0].set.assert_not_called()
+    assert (device.kicks, device.suppressed_kicks) == (0, 1)
+
+
+@pytest.mark.parametrize('transport', [HOST_FEATURES | 1 << types.VIRTIO_RING_F_EVENT_IDX], indirect=True)
+@pytest.mark.parametrize('avail_event, kicked', [
+    # The device wants to be notified once the entry at avail_event is available
+    (QUEUE_SIZE - 1, True),
+    (QUEUE_SIZE, False),
+])
+def test_kick_suppressed_by_event_index(device, transport, avail_event, kicked):
+    vq = device.rx_queues[0]
+    assert vq.event_idx
+    vq.vring.used.avail_event = avail_event
+
+    device.rx_batch(0, 32)
+
+    assert transport.doorbells[0].set.called == kicked
+    assert (device.kicks, device.suppressed_kicks) == ((1, 0) if kicked else (0, 1))
+
+
+def test_tx_batch_returns_descriptors_of_rejected_batch(device, tx_mempool):
+    vq = device.tx_queues[0]
+    buffers = tx_mempool.get_buffers(3 + VirtioDevice.MAX_TX_SEGMENTS)
+    for buffer in buffers:
+        buffer.size = 60
+    # One segment more than a table holds
+    for segment, next_segment in zip(buffers[2:], buffers[3:]):
+        segment.next_buffer = next_segment
+
+    with pytest.raises(VirtioException):
+        device.tx_batch(buffers[:3])
+
+    assert vq.num_free == QUEUE_SIZE
+    assert vq.vring.available.index == 0
+    assert device.tx_batch(buffers[:2]) == 2
+
+
+def test_offload_changed_in_place_is_written_again(device, tx_mempool):
+    buffer = tx_mempool.get_buffer()
+    buffer.offload = Offload(csum_start=34, csum_offset=16)
+    device._write_tx_header(buffer)
+
+    buffer.offload.csum_offset = 6
+    device._write_tx_header(buffer)
+
+    header = buffer.head_room_buffer[-len(device.net_hdr):]
+    # B B H H H ==> csum_offset at 8
+    assert header[8] == 6
+
+
+def test_initialization(device, transport):
+    assert device.mergeable_rx_buffers
+    assert device.tx_queues[0].indirect is not None
+    assert transport.features == HOST_FEATURES
+    assert transport.status & types.VIRTIO_CONFIG_STATUS_DRIVER_OK
+    # The promiscuous mode command
+    assert transport.commands == 1
+    assert not device.pending_commands
+
+
+def test_transport_requires_features():
+    transport = FakeTransport()
+    transport.required_features = 1 << types.VIRTIO_F_ANY_LAYOUT
+
+    with pytest.raises(VirtioException):
+        MemoryVirtioDevice(Mock(), transport=transport)
+
+
+def test_expired_command_does_not_block_the_control_queue(device, transport):
+    vq = device.ctrl_queues[0]
+    transport.acknowledging = False
+    expired = device.post_cmd(VirtioNetworkControl(PromiscuousModeCommand()), timeout=0)
+
+    with pytest.raises(IxyTimeoutException) as exception:
+        device.poll_ctrl_queue()
+    assert exception.value.timeout == 0
+
+    later = device.post_cmd(VirtioNetworkControl(PromiscuousModeCommand(on=False)), timeout=10)
+    assert device.poll_ctrl_queue() == []
+
+    # The device completes both commands after all
+    transport.acknowledge_commands()
+
+    assert device.poll_ctrl_queue() == [later]
+    assert not expired.completed
+    assert not device.pending_commands and not device.expired_commands
+    assert vq.num_free == QUEUE_SIZE
+    assert len(vq.mempool.get_buffers(QUEUE_SIZE)) == QUEUE_SIZE
+
+
+def test_post_cmd_without_buffers(device):
+    mempool = device.ctrl_queues[0].mempool
+    buffers = mempool.get_buffers(QUEUE_SIZE)
+
+    with pytest.raises(VirtioException):
+        device.post_cmd(VirtioNetworkControl(PromiscuousModeCommand()))
+
+    assert not device.pending_commands
+    mempool.free_buffers(buffers)
+
+
+def test_post_cmd_into_full_queue_keeps_the_buffer(device, transport):
+    vq = device.ctrl_queues[0]
+    transport.acknowledging = False
+    # Every command takes 3 descriptors
+    for _ in range(QUEUE_SIZE // 3):
+        device.post_cmd(VirtioNetworkControl(PromiscuousModeCommand()))
+    free_buffers = len(vq.mempool._buffers)
+
+    with pytest.raises(VirtioException):
+        device.post_cmd(VirtioNetworkControl(PromiscuousModeCommand()))
+
+    assert len(vq.mempool._buffers) == free_buffers
+    assert len(device.pending_commands) == QUEUE_SIZE // 3
+
+
+def test_send_cmd_timeout_expires_the_command(device, transport):
+    transport.acknowledging = False
+    device.CTRL_TIMEOUT = 0.01
+
+    with pytest.raises(IxyTimeoutException):
+        device.send_cmd(VirtioNetworkControl(PromiscuousModeCommand()))
+
+    assert not device.pending_commands
+    assert len(device.expired_commands) == 1
+    assert device.poll_ctrl_queue() == []
@@ -0,0 +1,150 @@
+from unittest.mock import Mock
+
+import pytest
+
+from ixypy.virtio import types
+from ixypy.virtio.packed import PackedRing, PackedVQueue, AVAIL, USED
+from ixypy.virtio.exception import VirtioException
+
+SIZE = 4
+
+
+def packed_queue(size=SIZE):
+    return PackedVQueue(memoryview(bytearray(PackedRing.byte_size(size))), size, 0, 0)
+
+
+def device_use(vq, position, length, wrap):
+    """Marks the descriptor at position as used like the device would"""
+    ring = vq.ring
+    ring.lengths[position] = length
+    ring.flags[position] = (AVAIL | USED) if wrap else 0
+
+
+def test_area_offsets():
+    assert PackedRing.area_offsets(256) == (0, 4096, 4100)
+    assert PackedRing.byte_size(256) == 4104
+
+
+def test_add_buffers_marks_descriptors_available():
+    vq = packed_queue()
+    buffers = [Mock(), Mock()]
+
+    old_index, new_index = vq.add_buffers(buffers, [0x1000, 0x2000], 64, types.VRING_DESC_F_WRITE)
+
+    assert (old_index, new_index) == (0, 2)
+    assert list(vq.ring.addresses[:2]) == [0x1000, 0x2000]
+    assert list(vq.ring.lengths[:2]) == [64, 64]
+    assert list(vq.ring.flags[:2]) == [AVAIL | types.VRING_DESC_F_WRITE]*2
+    assert vq.ring.flags[2] == 0
+    assert vq.num_free == SIZE - 2
+    assert [vq.buffers[buffer_id] for buffer_id in vq.ring.ids[:2]] == buffers
+
+
+def test_wrap_counter_flips():
+    vq = packed_queue()
+    vq.add_buffers([Mock()]*3, [1, 2, 3], 1)
+    for position in range(3):
+        device_use(vq, position, 1, wrap=1)
+    for _ in range(3):
+        vq.get_used()
+
+    old_index, new_index = vq.add_buffers([Mock()]*2, [4, 5], 1)
+
+    assert (old_index, new_index) == (-1, 1)
+    assert vq.avail_wrap == 0
+    # the last slot still belongs to the first lap, the first one to the second
+    assert vq.ring.flags[3] == AVAIL
+    assert vq.ring.flags[0] == USED
+
+
+def test_get_used():
+    vq = packed_queue()
+    buffers = [Mock(), Mock()]
+    vq.add_buffers(buffers, [0x1000, 0x2000], 64)
+
+    assert vq.get_used() is None
+    device_use(vq, 0, 42, wrap=1)
+
+    assert vq.num_used(SIZE) == 1
+    assert vq.get_used() == (buffers[0], 42)
+    assert vq.get_used() is None
+    assert vq.num_free == SIZE - 1
+
+
+def test_num_used_across_wrap():
+    vq = packed_queue()
+    vq.add_buffers([Mock()]*3, [1, 2, 3], 1)
+    for position in range(3):
+        device_use(vq, position, 1, wrap=1)
+        vq.get_used()
+    vq.add_buffers([Mock()]*3, [4, 5, 6], 1)
+    device_use(vq, 3, 1, wrap=1)
+    device_use(vq, 0, 1, wrap=0)
+
+    assert vq.num_used(SIZE) == 2
+    assert vq.num_used(1) == 1
+
+
+def test_used_entries():
+    vq = packed_queue()
+    vq.add_buffers([Mock()]*3, [1, 2, 3], 1)
+    device_use(vq, 0, 60, wrap=1)
+    device_use(vq, 1, 70, wrap=1)
+
+    count = vq.num_used(SIZE)
+    ids, lengths = vq.used_entries(count)
+    vq.release_used(ids)
+
+    assert lengths == [60, 70]
+    assert ids == [int(buffer_id) for buffer_id in vq.ring.ids[:2]]
+    assert vq.next_used == 2
+    assert vq.num_free == SIZE - 1
+
+
+def test_add_chain_uses_one_id():
+    vq = packed_queue()
+    buffer = Mock()
+
+    vq.add_chain(buffer, [(0x10, 2, 0), (0x12, 1, 0), (0x13, 1, types.VRING_DESC_F_WRITE)])
+
+    assert list(vq.ring.flags[:3]) == [AVAIL | types.VRING_DESC_F_NEXT,
+                                       AVAIL | types.VRING_DESC_F_NEXT,
+                                       AVAIL | types.VRING_DESC_F_WRITE]
+    assert len(set(vq.ring.ids[:3])) == 1
+    # the device writes a single used descriptor for the chain
+    device_use(vq, 0, 1, wrap=1)
+    assert vq.has_used()
+    assert vq.get_used() == (buffer, 1)
+    assert vq.next_used == 3
+    assert vq.num_free == SIZE
+
+
+def test_overflow():
+    vq = packed_queue()
+
+    with pytest.raises(VirtioException):
+        vq.add_buffers([Mock()]*(SIZE + 1), list(range(SIZE + 1)), 1)
+
+
+@pytest.mark.parametrize('flags, off_wrap, old_index, new_index, expected', [
+    (types.VRING_PACKED_EVENT_FLAG_ENABLE, 0, 0, 1, True),
+    (types.VRING_PACKED_EVENT_FLAG_DISABLE, 0, 0, 1, False),
+    (types.VRING_PACKED_EVENT_FLAG_DESC, 1 << 15 | 1, 0, 2, True),
+    (types.VRING_PACKED_EVENT_FLAG_DESC, 1 << 15 | 2, 0, 2, False),
+    # event in the previous lap
+    (types.VRING_PACKED_EVENT_FLAG_DESC, 3, -1, 1, True),
+])
+def test_needs_notification(flags, off_wrap, old_index, new_index, expected):
+    vq = packed_queue()
+    vq.ring.device_event['flags'] = flags
+    vq.ring.device_event['off_wrap'] = off_wrap
+
+    assert vq.needs_notification(old_index, new_index) == expected
+
+
+def test_disable_interrupts():
+    vq = packed_queue()
+
+    vq.disable_interrupts()
+
+    assert vq.ring.driver_event['flags'][0] == types.VRING_PACKED_EVENT_FLAG_DISABLE
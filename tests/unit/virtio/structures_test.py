@@ -1,14 +1,23 @@
 import struct
 from unittest.mock import Mock
 
-from ixypy.virtio.structures import VRing, VRingDescriptor, Available, RingList,\
-                                    VRingUsedElement, VRingUsed, VirtioNetworkControl,\
-                                    PromiscuousModeCommand
-
+from ixypy.virtio.structures import VRing, Available, VRingUsed, VirtioNetworkControl,\
+                                    PromiscuousModeCommand, VQueue, MultiQueueCommand,\
+                                    VirtioNetworkMergeableHeader, IndirectTables, VirtioNetworkHeader,\
+                                    AllMulticastCommand, MacTableCommand, VlanFilterCommand
+
+from ixypy.virtio.types import VRING_USED_F_NO_NOTIFY, VIRTIO_NET_CTRL_MQ, VIRTIO_NET_CTRL_MQ_VQ_PAIRS_SET,\
+                               VRING_DESC_F_NEXT, VRING_DESC_F_WRITE, VIRTIO_NET_HDR_F_NEEDS_CSUM, VIRTIO_NET_HDR_GSO_TCPV4,\
+                               VIRTIO_NET_CTRL_RX, VIRTIO_NET_CTRL_RX_ALLMULTI, VIRTIO_NET_CTRL_MAC,\
+                               VIRTIO_NET_CTRL_MAC_TABLE_SET, VIRTIO_NET_CTRL_VLAN, VIRTIO_NET_CTRL_VLAN_DEL,\
+                               VIRTIO_NET_ERR
+from ixypy.mempool import Offload
 from ixypy.virtio.exception import VirtioException, BufferSizeException
 
 import pytest
 
+from tests.unit.conftest import FakeDma
+
 
 class TestVirtioNetworkControl(object):
     def test_write_net_ctrl_to_buffer(self):
@@ -38,16 +47,174 @@ class TestVirtioNetworkControl(object):
 
         assert len(net_ctrl) == 4
 
+    def test_promisc_off(self):
+        buffer = memoryview(bytearray(4))
+
+        VirtioNetworkControl(PromiscuousModeCommand(on=False)).to_buffer(buffer)
+
+        assert buffer[2] == 0
+
+    def test_read_ack(self):
+        buffer = memoryview(bytearray(4))
+        net_ctrl = VirtioNetworkControl(AllMulticastCommand())
+        net_ctrl.to_buffer(buffer)
+        assert not net_ctrl.completed
+
+        buffer[3] = VIRTIO_NET_ERR
+
+        assert net_ctrl.read_ack(buffer) == VIRTIO_NET_ERR
+        assert net_ctrl.completed
+        assert not net_ctrl.ok
+
+
+class TestRxFilterCommands(object):
+    def test_allmulti_command(self):
+        buffer = memoryview(bytearray(4))
+
+        VirtioNetworkControl(AllMulticastCommand(on=True)).to_buffer(buffer)
+
+        assert bytes(buffer) == bytes([VIRTIO_NET_CTRL_RX, VIRTIO_NET_CTRL_RX_ALLMULTI, 1, 0])
+
+    def test_mac_table_command(self):
+        net_ctrl = VirtioNetworkControl(MacTableCommand(['52:54:00:12:34:56'], [b'\x01\x00\x5e\x00\x00\x01']))
+        buffer = memoryview(bytearray(len(net_ctrl)))
+
+        net_ctrl.to_buffer(buffer)
+
+        assert len(net_ctrl) == 2 + 4 + 6 + 4 + 6 + 1
+        assert bytes(buffer[:2]) == bytes([VIRTIO_NET_CTRL_MAC, VIRTIO_NET_CTRL_MAC_TABLE_SET])
+        assert struct.unpack_from('<I', buffer, 2)[0] == 1
+        assert bytes(buffer[6:12]) == bytes([0x52, 0x54, 0x00, 0x12, 0x34, 0x56])
+        assert struct.unpack_from('<I', buffer, 12)[0] == 1
+        assert bytes(buffer[16:22]) == bytes([0x01, 0x00, 0x5e, 0x00, 0x00, 0x01])
+
+    def test_empty_mac_table(self):
+        assert MacTableCommand().bytes() == bytes(8)
+
+    def test_invalid_mac(self):
+        with pytest.raises(VirtioException):
+            MacTableCommand(['52:54:00:12:34'])
+
+    def test_vlan_filter_command(self):
+        buffer = memoryview(bytearray(5))
+
+        VirtioNetworkControl(VlanFilterCommand(100, add=False)).to_buffer(buffer)
+
+        assert struct.unpack('<B B H B', buffer) == (VIRTIO_NET_CTRL_VLAN, VIRTIO_NET_CTRL_VLAN_DEL, 100, 0)
+
+    def test_invalid_vlan(self):
+        with pytest.raises(VirtioException):
+            VlanFilterCommand(4096)
+
+
+class TestMultiQueueCommand(object):
+    def test_write_mq_command(self):
+        buffer = memoryview(bytearray(10))
+        net_ctrl = VirtioNetworkControl(MultiQueueCommand(4))
+
+        net_ctrl.to_buffer(buffer)
+
+        assert len(net_ctrl) == 5
+        assert struct.unpack_from('B B H B', buffer, 0) == (VIRTIO_NET_CTRL_MQ, VIRTIO_NET_CTRL_MQ_VQ_PAIRS_SET, 4, 0)
+
+
+class TestVirtioNetworkMergeableHeader(object):
+    def test_header_in_head_room(self):
+        head_room = memoryview(bytearray(40))
+        pkt_buf = Mock(head_room_buffer=head_room)
+        header = VirtioNetworkMergeableHeader(flags=1, num_buffers=3)
+
+        header.to_buffer(head_room[-len(header):])
+
+        assert len(header) == 12
+        assert VirtioNetworkMergeableHeader.num_buffers_in(pkt_buf) == 3
+        assert head_room[-12] == 1
+
+
+class TestOffloadHeader(object):
+    def test_checksum_offload(self):
+        buffer = bytearray(10)
+        header = VirtioNetworkHeader(header_len=42)
+
+        header.offload_to_buffer(Offload(csum_start=34, csum_offset=16), buffer)
+
+        assert struct.unpack('B B H H H H', buffer) == (VIRTIO_NET_HDR_F_NEEDS_CSUM, 0, 0, 0, 34, 16)
+
+    def test_segmentation_offload(self):
+        buffer = bytearray(12)
+        header = VirtioNetworkMergeableHeader(num_buffers=3)
+        offload = Offload(csum_start=34, csum_offset=16, gso_type=VIRTIO_NET_HDR_GSO_TCPV4, gso_size=1448, header_len=54)
+
+        header.offload_to_buffer(offload, buffer)
+
+        assert struct.unpack('B B H H H H H', buffer) == (VIRTIO_NET_HDR_F_NEEDS_CSUM, VIRTIO_NET_HDR_GSO_TCPV4,
+                                                          54, 1448, 34, 16, 0)
+
+    def test_no_checksum(self):
+        buffer = bytearray(b'\xFF'*10)
+
+        VirtioNetworkHeader().offload_to_buffer(Offload(), buffer)
+
+        assert buffer == bytearray(10)
+
+
+class TestIndirectTables(object):
+    queue_size = 4
+    max_segments = 2
+
+    def tables(self):
+        header = VirtioNetworkHeader(flags=1)
+        dma = FakeDma(IndirectTables.byte_size(self.queue_size, self.max_segments, len(header)))
+        return IndirectTables(dma, self.queue_size, self.max_segments, header), dma
+
+    @staticmethod
+    def packet(*segments):
+        pkt_buf = Mock()
+        pkt_buf.segments.return_value = [Mock(data_addr=address, size=size) for address, size in segments]
+        return pkt_buf
+
+    def test_shared_header(self):
+        tables, dma = self.tables()
+
+        assert tables.header_address == dma.physical_address + self.queue_size * 3 * 16
+        assert dma[self.queue_size * 3 * 16] == 1
+
+    def test_write_table(self):
+        tables, dma = self.tables()
+
+        address, length = tables.write(2, self.packet((0x2000, 60), (0x3000, 100)))
+
+        table_offset = 2 * 3 * 16
+        assert address == dma.physical_address + table_offset
+        assert length == 3 * 16
+        entries = [struct.unpack_from('Q I H H', dma, table_offset + i * 16) for i in range(3)]
+        assert entries == [(tables.header_address, 10, VRING_DESC_F_NEXT, 1),
+                           (0x2000, 60, VRING_DESC_F_NEXT, 2),
+                           (0x3000, 100, 0, 0)]
+
+    def test_write_table_with_own_header(self):
+        tables, dma = self.tables()
+
+        tables.write(1, self.packet((0x2000, 60)), header_address=0x1FF6)
+
+        assert struct.unpack_from('Q I H H', dma, 3 * 16) == (0x1FF6, 10, VRING_DESC_F_NEXT, 1)
+
+    def test_too_many_segments(self):
+        tables, _ = self.tables()
+
+        with pytest.raises(VirtioException):
+            tables.write(0, self.packet((0x2000, 1), (0x3000, 1), (0x4000, 1)))
+
 
 class TestVRing(object):
     size = 256
 
     def test_size_calculation(self):
-        assert VRing.byte_size(self.size) == 10244
+        assert VRing.byte_size(self.size) == 10246
         assert VRing.descriptor_table_size(self.size) == 4096
-        assert VRing.available_queue_size(self.size) == 516
-        assert VRing.used_queue_size(self.size) == 2052
-        assert VRing.padding(self.size) == 3580
+        assert VRing.available_queue_size(self.size) == 518
+        assert VRing.used_queue_size(self.size) == 2054
+        assert VRing.padding(self.size) == 3578
 
     def test_descriptors_creation(self):
         buff = memoryview(bytearray(VRing.byte_size(self.size)))
@@ -63,69 +230,160 @@ class TestVRing(object):
             VRing(buff, self.size)
 
 
-class TestVRingDescriptor(object):
-    data_format = 'Q I H H'
-    length = 120
-    address = 1233
-    flags = 99
-    next_descriptor = 123
+class TestVQueue(object):
+    size = 8
 
-    def test_ring_descriptor_read(self):
-        data = bytearray(struct.pack(self.data_format,
-                                     self.address,
-                                     self.length,
-                                     self.flags,
-                                     self.next_descriptor))
+    def vqueue(self):
+        buff = memoryview(bytearray(VRing.byte_size(self.size)))
+        return VQueue(buff, self.size, 0, 0)
 
-        descriptor = VRingDescriptor(memoryview(data))
+    def test_take_free_in_order(self):
+        vq = self.vqueue()
 
-        assert descriptor.length == self.length
-        assert descriptor.address == self.address
-        assert descriptor.flags == self.flags
-        assert descriptor.next_descriptor == self.next_descriptor
+        assert vq.take_free(self.size) == list(range(self.size))
+        assert vq.num_free == 0
+
+    def test_overflow(self):
+        vq = self.vqueue()
+        vq.take_free(self.size)
+
+        with pytest.raises(VirtioException):
+            vq.take_free(1)
+
+    def test_return_free(self):
+        vq = self.vqueue()
+        vq.take_free(1)
+        indices = vq.take_free(3)
+
+        vq.return_free(indices)
+
+        assert vq.num_free == self.size - 1
+        assert vq.take_free(3) == indices
+
+    def test_needs_notification(self):
+        vq = self.vqueue()
+
+        assert vq.needs_notification(0, 1)
+        vq.vring.used.flags = VRING_USED_F_NO_NOTIFY
+        assert not vq.needs_notification(0, 1)
+
+    @pytest.mark.parametrize('avail_event, old_index, new_index, expected', [
+        (0, 0, 1, True),
+        (3, 0, 4, True),
+        (4, 0, 4, False),
+        (10, 4, 8, False),
+        (0xFFFF, 0xFFFE, 2, True),
+        (1, 0xFFFE, 1, False),
+    ])
+    def test_needs_notification_event_idx(self, avail_event, old_index, new_index, expected):
+        vq = self.vqueue()
+        vq.event_idx = True
+        vq.vring.used.flags = VRING_USED_F_NO_NOTIFY
+        vq.vring.used.avail_event = avail_event
+
+        assert vq.needs_notification(old_index, new_index) == expected
+
+    def test_hold_off_interrupts(self):
+        vq = self.vqueue()
+        vq.event_idx = True
+        vq.used_last_index = 0x8005
 
-    def test_ring_descriptor_write(self):
-        data = bytearray(struct.pack(self.data_format, 0, 0, 0, 0))
+        vq.hold_off_interrupts()
 
-        descriptor = VRingDescriptor(memoryview(data))
-        descriptor.address = self.address
-        descriptor.length = self.length
-        descriptor.flags = self.flags
-        descriptor.next_descriptor = self.next_descriptor
+        assert vq.vring.available.used_event == 0x0004
 
-        values = struct.unpack(self.data_format, data)
-        assert values[0] == self.address
-        assert values[1] == self.length
-        assert values[2] == self.flags
-        assert values[3] == self.next_descriptor
+    def test_free_descriptor(self):
+        vq = self.vqueue()
+        index, = vq.take_free(1)
+        vq.vring.addresses[index] = 0x1000
+        vq.vring.lengths[index] = 64
 
-    def test_create_descriptor(self):
-        data = bytearray(struct.pack(self.data_format, 1, 1, 1, 1))
+        vq.free_descriptor(index)
 
-        VRingDescriptor.create_descriptor(memoryview(data))
+        assert vq.num_free == self.size
+        assert vq.vring.addresses[index] == 0
+        assert vq.vring.lengths[index] == 0
+        assert vq.take_free(1) == [index]
 
-        assert all(item == 0 for item in struct.unpack(self.data_format, data))
+    def test_add_buffers(self):
+        vq = self.vqueue()
+        buffers = [Mock(), Mock(), Mock()]
 
+        old_index, new_index = vq.add_buffers(buffers, [0x1000, 0x2000, 0x3000], 64, VRING_DESC_F_WRITE)
 
-class TestRingList(object):
-    def test_ring_list(self):
-        ring_list_size = 10
-        fmt = '{:d}H'.format(ring_list_size)
-        ring_values = range(10)
-        reversed_ring_values = ring_values[::-1]
-        data = bytearray(struct.pack(fmt, *range(10)))
+        assert (old_index, new_index) == (0, 3)
+        assert vq.vring.available.index == 3
+        assert list(vq.vring.available.rings[:3]) == [0, 1, 2]
+        assert list(vq.vring.addresses[:3]) == [0x1000, 0x2000, 0x3000]
+        assert vq.vring.descriptors[2].address == 0x3000
+        assert list(vq.vring.lengths[:3]) == [64]*3
+        assert list(vq.vring.flags[:3]) == [VRING_DESC_F_WRITE]*3
+        assert vq.buffers[:3] == buffers
+        assert vq.num_free == self.size - 3
 
-        ring_list = RingList(memoryview(data), ring_list_size)
+    def test_publish_across_available_index_wrap(self):
+        vq = self.vqueue()
+        vq.vring.available.index = 0xFFFF
 
-        for i in range(10):
-            assert ring_list[i] == i
-        for i in range(10):
-            ring_list[i] = reversed_ring_values[i]
-            assert struct.unpack_from('H', data, self._offset(i))[0] == reversed_ring_values[i]
+        old_index, new_index = vq.add_buffers([Mock(), Mock()], [1, 2], 1)
 
-    @staticmethod
-    def _offset(index):
-        return struct.calcsize('{:d}H'.format(index))
+        assert (old_index, new_index) == (0xFFFF, 0x10001)
+        assert vq.vring.available.index == 1
+        # 0xFFFF is the last ring slot, 0x10000 the first one
+        assert vq.vring.available.rings[self.size - 1] == 0
+        assert vq.vring.available.rings[0] == 1
+
+    def test_add_buffers_overflow(self):
+        vq = self.vqueue()
+
+        with pytest.raises(VirtioException):
+            vq.add_buffers([Mock()]*(self.size + 1), list(range(self.size + 1)), 1)
+        assert vq.num_free == self.size
+
+    def test_used_entries_across_index_wrap(self):
+        vq = self.vqueue()
+        vq.add_buffers([Mock()]*3, [1, 2, 3], 1)
+        vq.used_last_index = 0xFFFE
+        used = vq.vring.used
+        for i, (buffer_id, length) in enumerate([(2, 60), (0, 70), (1, 80)]):
+            used.rings[(0xFFFE + i) % self.size] = (buffer_id, length)
+        used.index = 1
+
+        assert vq.num_used(self.size) == 3
+        assert vq.num_used(2) == 2
+        assert vq.used_entries(3) == ([2, 0, 1], [60, 70, 80])
+
+        vq.release_used([2, 0])
+
+        assert vq.used_last_index == 0
+        assert vq.num_used(self.size) == 1
+        assert vq.num_free == self.size - 1
+
+    def test_add_chain(self):
+        vq = self.vqueue()
+        buffer = Mock()
+
+        vq.add_chain(buffer, [(0x10, 2, 0), (0x12, 1, 0), (0x13, 1, VRING_DESC_F_WRITE)])
+
+        assert vq.vring.available.index == 1
+        assert vq.vring.available.rings[0] == 0
+        assert list(vq.vring.flags[:3]) == [VRING_DESC_F_NEXT, VRING_DESC_F_NEXT, VRING_DESC_F_WRITE]
+        assert list(vq.vring.next_descriptors[:2]) == [1, 2]
+        assert vq.num_free == self.size - 3
+
+    def test_get_used_frees_chain(self):
+        vq = self.vqueue()
+        buffer = Mock()
+        vq.add_chain(buffer, [(0x10, 2, 0), (0x12, 1, 0), (0x13, 1, VRING_DESC_F_WRITE)])
+        assert vq.get_used() is None
+
+        vq.vring.used.rings[0] = (0, 1)
+        vq.vring.used.index = 1
+
+        assert vq.get_used() == (buffer, 1)
+        assert not vq.has_used()
+        assert vq.num_free == self.size
+        assert vq.buffers[0] is None
 
 
 class TestAvailable(object):
@@ -165,32 +423,6 @@ class TestAvailable(object):
             assert value == self.rings[i]
 
 
-class TestVRingElementTest(object):
-    data_format = 'H xx I'
-    id = 15
-    length = 55
-
-    def test_used_element_read(self):
-        data = bytearray(struct.pack(self.data_format, self.id, self.length))
-
-        used_element = VRingUsedElement(memoryview(data))
-
-        assert used_element.id == self.id
-        assert used_element.length == self.length
-
-    def test_used_element_write(self):
-        data = bytearray(struct.pack(self.data_format, 0, 0))
-
-        used_element = VRingUsedElement(memoryview(data))
-        used_element.id = self.id
-        used_element.length = self.length
-
-        actual_values = struct.unpack(self.data_format, data)
-
-        assert actual_values[0] == self.id
-        assert actual_values[1] == self.length
-
-
 class TestVRingUsed(object):
     size = 10
     flags = 234
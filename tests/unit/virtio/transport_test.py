@@ -0,0 +1,154 @@
+from struct import pack, pack_into, unpack_from
+
+import pytest
+
+from ixypy.pci import PCIAddress, PCIDevice, PCIDeviceController
+from ixypy.virtio import types
+from ixypy.virtio.structures import VRing
+from ixypy.virtio.transport import transport_for, VirtioCapability, ModernTransport, LegacyTransport
+from ixypy.virtio.exception import VirtioException
+
+BAR = 4
+BAR_SIZE = 0x4000
+COMMON_OFFSET = 0x0
+ISR_OFFSET = 0x1000
+DEVICE_OFFSET = 0x2000
+NOTIFY_OFFSET = 0x3000
+NOTIFY_MULTIPLIER = 4
+
+
+def virtio_cap(next_offset, cfg_type, offset, length, notify_off_multiplier=None):
+    cap_len = 16 if notify_off_multiplier is None else 20
+    cap = pack('<BBBBBB2xII', 0x09, next_offset, cap_len, cfg_type, BAR, 0, offset, length)
+    if notify_off_multiplier is not None:
+        cap += pack('<I', notify_off_multiplier)
+    return cap
+
+
+def write_config(path, device_id, capabilities):
+    config = bytearray(256)
+    pack_into('<HH', config, 0, 0x1af4, device_id)
+    if capabilities:
+        # status register, capability list present
+        pack_into('<H', config, 6, PCIDevice.capability_list_flag)
+        config[0x34] = 0x40
+        offset = 0x40
+        for cap in capabilities:
+            config[offset:offset + len(cap)] = cap
+            offset += 0x18
+    with open(path, 'wb') as fd:
+        fd.write(bytes(config))
+
+
+@pytest.fixture()
+def modern_device(tmpdir):
+    """
+    Software model of a modern virtio-net device, its BAR is a plain file so
+    every register reads back what was written last
+    """
+    write_config(str(tmpdir.join('config')), types.VIRTIO_PCI_MODERN_DEVICE_ID, [
+        virtio_cap(0x58, types.VIRTIO_PCI_CAP_COMMON_CFG, COMMON_OFFSET, 0x38),
+        virtio_cap(0x70, types.VIRTIO_PCI_CAP_ISR_CFG, ISR_OFFSET, 0x1),
+        virtio_cap(0x88, types.VIRTIO_PCI_CAP_DEVICE_CFG, DEVICE_OFFSET, 0xC),
+        virtio_cap(0x00, types.VIRTIO_PCI_CAP_NOTIFY_CFG, NOTIFY_OFFSET, 0x1000, NOTIFY_MULTIPLIER),
+    ])
+    tmpdir.join('resource{:d}'.format(BAR)).write_binary(bytes(BAR_SIZE))
+    return PCIDevice(PCIAddress(), PCIDeviceController(str(tmpdir)))
+
+
+def read_bar(pci_device, offset, fmt):
+    with open('{}/resource{:d}'.format(pci_device.pci_controller.device_path, BAR), 'rb') as resource:
+        return unpack_from(fmt, resource.read(), offset)[0]
+
+
+def test_read_capabilities(modern_device):
+    capabilities = VirtioCapability.read_all(modern_device)
+
+    assert sorted(capabilities) == [1, 2, 3, 4]
+    notify = capabilities[types.VIRTIO_PCI_CAP_NOTIFY_CFG]
+    assert (notify.bar, notify.offset, notify.length) == (BAR, NOTIFY_OFFSET, 0x1000)
+    assert notify.notify_off_multiplier == NOTIFY_MULTIPLIER
+
+
+def test_modern_transport_is_preferred(modern_device):
+    assert isinstance(transport_for(modern_device), ModernTransport)
+
+
+def test_legacy_transport_without_capabilities(tmpdir):
+    write_config(str(tmpdir.join('config')), types.VIRTIO_PCI_LEGACY_DEVICE_ID, [])
+    tmpdir.join('resource0').write_binary(bytes(32))
+
+    transport = transport_for(PCIDevice(PCIAddress(), PCIDeviceController(str(tmpdir))))
+
+    assert isinstance(transport, LegacyTransport)
+
+
+def test_modern_device_id_without_capabilities(tmpdir):
+    write_config(str(tmpdir.join('config')), types.VIRTIO_PCI_MODERN_DEVICE_ID, [])
+
+    with pytest.raises(VirtioException):
+        transport_for(PCIDevice(PCIAddress(), PCIDeviceController(str(tmpdir))))
+
+
+def test_status(modern_device):
+    transport = transport_for(modern_device)
+
+    transport.reset()
+    transport.add_status(types.VIRTIO_CONFIG_STATUS_ACK)
+    transport.add_status(types.VIRTIO_CONFIG_STATUS_DRIVER)
+
+    expected = types.VIRTIO_CONFIG_STATUS_ACK | types.VIRTIO_CONFIG_STATUS_DRIVER
+    assert read_bar(modern_device, COMMON_OFFSET + types.VIRTIO_PCI_COMMON_STATUS, 'B') == expected
+
+
+def test_set_features_sets_features_ok(modern_device):
+    transport = transport_for(modern_device)
+    features = (1 << types.VIRTIO_F_VERSION_1) | (1 << types.VIRTIO_NET_F_CTRL_VQ)
+
+    transport.set_features(features)
+
+    # the model keeps the last written word only, which is the high one
+    assert read_bar(modern_device, COMMON_OFFSET + types.VIRTIO_PCI_COMMON_GFSELECT, 'I') == 1
+    assert read_bar(modern_device, COMMON_OFFSET + types.VIRTIO_PCI_COMMON_GF, 'I') == features >> 32
+    assert transport.get_status() & types.VIRTIO_CONFIG_STATUS_FEATURES_OK
+
+
+def test_host_features_are_64_bit(modern_device):
+    transport = transport_for(modern_device)
+    transport.common_cfg.set32(types.VIRTIO_PCI_COMMON_DF, 0x3)
+
+    assert transport.host_features() == 0x3 | (0x3 << 32)
+
+
+def test_enable_queue(modern_device):
+    transport = transport_for(modern_device)
+    address = 0x123456789000
+    size = 256
+
+    transport.select_queue(2)
+    transport.enable_queue(size, *[address + offset for offset in VRing.area_offsets(size)])
+
+    def common(offset, fmt='I'):
+        return read_bar(modern_device, COMMON_OFFSET + offset, fmt)
+    assert common(types.VIRTIO_PCI_COMMON_Q_SELECT, 'H') == 2
+    assert common(types.VIRTIO_PCI_COMMON_Q_SIZE, 'H') == size
+    assert common(types.VIRTIO_PCI_COMMON_Q_DESCLO, 'Q') == address
+    assert common(types.VIRTIO_PCI_COMMON_Q_AVAILLO, 'Q') == address + 16 * size
+    assert common(types.VIRTIO_PCI_COMMON_Q_USEDLO, 'Q') == address + VRing.used_offset(size)
+    assert common(types.VIRTIO_PCI_COMMON_Q_ENABLE, 'H') == 1
+
+
+def test_doorbell_writes_queue_notify_address(modern_device):
+    transport = transport_for(modern_device)
+    transport.common_cfg.set16(types.VIRTIO_PCI_COMMON_Q_NOFF, 3)
+
+    transport.doorbell(5).set(5)
+
+    assert read_bar(modern_device, NOTIFY_OFFSET + 3 * NOTIFY_MULTIPLIER, 'H') == 5
+
+
+def test_read_device_config(modern_device):
+    transport = transport_for(modern_device)
+    transport.device_cfg.set16(types.VIRTIO_NET_CONFIG_MAX_VIRTQUEUE_PAIRS, 4)
+
+    assert transport.read_device_config(types.VIRTIO_NET_CONFIG_MAX_VIRTQUEUE_PAIRS, 2) == 4
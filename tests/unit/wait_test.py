@@ -0,0 +1,22 @@
+from itertools import count
+
+import pytest
+
+from ixypy.wait import wait_until, IxyTimeoutException
+
+
+def test_returns_when_condition_holds():
+    polls = count()
+
+    # Sleeps after the second poll, but only for a short time
+    elapsed = wait_until(lambda: next(polls) == 5, timeout=10, spin_count=2, max_sleep=1e-4)
+
+    assert next(polls) == 6
+    assert 0 <= elapsed < 10
+
+
+def test_timeout():
+    with pytest.raises(IxyTimeoutException) as exception:
+        wait_until(lambda: False, timeout=0.01, description='nothing')
+
+    assert 'nothing' in str(exception.value)